@@ -21,6 +21,7 @@ def get_long_desc():
 
 
 requires = [
+    'futures; python_version=="2.7"',
     'requests>=2.14.0',
     'six',
 ]
@@ -56,6 +57,9 @@ setup_params = dict(
         'testing:python_version=="3.4"': ['pandas~=0.19.0'],
         'testing:python_version=="2.7" or python_version>="3.5"': ['pandas'],
         'testing': tests_requires,
+        'async:python_version>="3.5"': ['aiohttp'],
+        'streaming': ['ijson>=3.1'],
+        'arrow': ['pyarrow'],
     },
     zip_safe=True,
     entry_points={},
@@ -0,0 +1,313 @@
+"""Asyncio support for pycrunch, on top of aiohttp.
+
+AsyncElementSession sends its requests with aiohttp, but hands each
+reply to an ElementResponseHandler as a requests.Response, exactly like
+ElementSession does; the same status dispatch, parsers and Element
+classes therefore apply, and awaiting e.g. session.get(url) returns a
+Response with the usual .payload.
+
+Payloads parsed by an AsyncElementSession refer to it as their .session.
+Since Document navigation and methods are synchronous, use the coroutine
+functions of this module on those payloads instead:
+
+    >>> async with AsyncElementSession(token=key, site_url=url) as session:
+    ...     root = await session.root
+    ...     datasets = await follow(root, "datasets")
+    ...     entities = await asyncio.gather(
+    ...         *[fetch(tupl) for tupl in datasets.index.values()]
+    ...     )
+
+This module requires Python 3.5+ and aiohttp (pip install pycrunch[async]).
+"""
+
+import asyncio
+import json
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+import requests
+import six
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from yarl import URL as YURL
+
+from pycrunch import elements, jsoncodec
+from pycrunch.progress import DefaultProgressTracking, poll_intervals
+from pycrunch.shoji import TaskError, TaskProgressTimeoutError, retry_after
+
+from .version import __version__
+
+
+class AsyncElementResponseHandler(elements.ElementResponseHandler):
+    """An ElementResponseHandler for AsyncElementSession.
+
+    Logging in again on a 401 needs I/O, which AsyncElementSession.request
+    performs itself before dispatching the response here. Any 401 which
+    still reaches this handler is returned as is, as for API key sessions.
+    """
+
+    def status_401(self, r):
+        login_url = r.json()["urls"]["login_url"]
+        if r.request.url == login_url:
+            raise ValueError("Log in was not successful.")
+        return r
+
+
+class AsyncElementSession(object):
+    """An asyncio counterpart of ElementSession.
+
+    The constructor arguments are those of ElementSession. The underlying
+    aiohttp.ClientSession is created on first use, inside the running
+    event loop; call `await session.close()` (or use the session as an
+    async context manager) to release its connections.
+    """
+
+    headers = {
+        "Accept-Encoding": "gzip",
+        "user-agent": "pycrunch/%s" % __version__,
+    }
+    handler_class = AsyncElementResponseHandler
+    verify = True
+    # Response caching (see lemonpy.ResponseCache) is not supported here.
+    cache = None
+    # Set to True to parse response payloads lazily; see parse_element.
+    lazy_parsing = False
+    # The codec for all JSON sent and received; see pycrunch.jsoncodec.
+    # None means jsoncodec.default_codec.
+    json_codec = None
+
+    def __init__(
+        self,
+        email=None,
+        password=None,
+        token=None,
+        site_url=None,
+        progress_tracking=None,
+    ):
+        if not site_url and token:
+            raise ValueError("Must include a `site_url` host to connect to")
+        self.token = token
+        self.site_url = site_url
+        self.domain = urlparse(site_url).netloc if site_url else None
+        self.progress_tracking = progress_tracking or DefaultProgressTracking()
+        if self.token:
+            self.credentials = {"api_key": token}
+        else:
+            self.credentials = {"email": email, "password": password}
+        self.headers = dict(self.__class__.headers)
+        self.handler = self.handler_class(self)
+        self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    @property
+    def client(self):
+        """The aiohttp.ClientSession for this session, created on first use."""
+        if self._client is None:
+            self._client = aiohttp.ClientSession(trust_env=True)
+            if self.token:
+                domain = self.domain or "local.crunch.io"
+                self._client.cookie_jar.update_cookies(
+                    {"token": self.token}, YURL("https://%s/" % domain)
+                )
+        return self._client
+
+    @property
+    def root(self):
+        """Awaitable: the payload of self.site_url."""
+        if not self.site_url:
+            raise ValueError("Session must be initialized with `site_url`")
+        return self._payload(self.get(self.site_url))
+
+    @staticmethod
+    async def _payload(coro):
+        return (await coro).payload
+
+    async def request(self, method, url, data=None, headers=None, **kwargs):
+        """Send a request and return its parsed requests.Response."""
+        r = await self._send(method, url, data=data, headers=headers, **kwargs)
+        if r.status_code == 401 and not self.token:
+            login_url = r.json()["urls"]["login_url"]
+            if r.request.url != login_url:
+                # Log in, then repeat the request; the cookie jar of the
+                # client session keeps the new session cookie.
+                login_r = await self.post(
+                    login_url,
+                    headers={"Content-Type": "application/json"},
+                    data=json.dumps(self.credentials),
+                )
+                r2 = await self._send(
+                    method, url, data=data, headers=headers, **kwargs
+                )
+                r2.history.append(r)
+                r2.history.append(login_r)
+                r = r2
+        return self.handler(r)
+
+    async def _send(self, method, url, data=None, headers=None, **kwargs):
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        if not self.verify:
+            kwargs.setdefault("ssl", False)
+        async with self.client.request(
+            method, url, data=data, headers=all_headers, **kwargs
+        ) as resp:
+            content = await resp.read()
+        r = self._build_response(resp, content, all_headers, data)
+        r.history = [
+            self._build_response(prev, b"", all_headers, None)
+            for prev in resp.history
+        ]
+        return r
+
+    @staticmethod
+    def _build_response(resp, content, headers, data):
+        """Return the given aiohttp response as a requests.Response."""
+        r = requests.Response()
+        r.status_code = resp.status
+        r.reason = resp.reason
+        r.headers = CaseInsensitiveDict(resp.headers)
+        r.url = str(resp.url)
+        r.encoding = get_encoding_from_headers(r.headers)
+        r._content = content
+        r.request = requests.Request(
+            resp.method, str(resp.request_info.url), headers=headers,
+            data=data if isinstance(data, (six.string_types, bytes)) else None,
+        ).prepare()
+        return r
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, data=None, **kwargs):
+        return await self.request("POST", url, data=data, **kwargs)
+
+    async def put(self, url, data=None, **kwargs):
+        return await self.request("PUT", url, data=data, **kwargs)
+
+    async def patch(self, url, data=None, **kwargs):
+        return await self.request("PATCH", url, data=data, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+
+class UnsafeAsyncElementSession(AsyncElementSession):
+    """An AsyncElementSession which disables SSL/TLS verification.
+
+    This is meant to be used for development purposes only.
+    """
+
+    verify = False
+
+    def __init__(self, *args, **kwargs):
+        super(UnsafeAsyncElementSession, self).__init__(*args, **kwargs)
+        if self.token:
+            self.headers["Authorization"] = "Bearer {}".format(self.token)
+
+
+# ---------------------- Awaitable Document helpers ----------------------- #
+
+
+async def follow(doc, key, qs=None, **kwargs):
+    """Awaitable Document.follow: GET the payload of the requested link."""
+    url = doc._follow_url(key, qs)
+    kwargs.setdefault("headers", {})
+    kwargs["headers"].setdefault("Accept", "application/json, */*")
+    return (await doc.session.get(url, **kwargs)).payload
+
+
+async def refresh(doc):
+    """Awaitable Document.refresh: GET doc.self, update doc and return it."""
+    r = await doc.session.get(doc.self)
+    if r.payload is None:
+        raise TypeError("Response could not be parsed.", r)
+
+    doc.clear()
+    doc.update(r.payload)
+    return doc
+
+
+def _json_kwargs(doc, data, kwargs):
+    kwargs.setdefault("headers", {})
+    kwargs["headers"].setdefault("Content-Type", "application/json")
+    if not isinstance(data, six.string_types):
+        data = jsoncodec.session_codec(doc.session).dumps(data)
+    return data
+
+
+async def post(doc, data, **kwargs):
+    """Awaitable Document.post."""
+    data = _json_kwargs(doc, data, kwargs)
+    return await doc.session.post(doc.self, data, **kwargs)
+
+
+async def put(doc, data, **kwargs):
+    """Awaitable Document.put."""
+    data = _json_kwargs(doc, data, kwargs)
+    return await doc.session.put(doc.self, data, **kwargs)
+
+
+async def patch(doc, data, **kwargs):
+    """Awaitable Document.patch."""
+    data = _json_kwargs(doc, data, kwargs)
+    return await doc.session.patch(doc.self, data, **kwargs)
+
+
+async def delete(doc):
+    """Awaitable Document.delete."""
+    return await doc.session.delete(doc.self)
+
+
+async def fetch(tupl, **kwargs):
+    """Awaitable shoji.Tuple.fetch: GET and return the Tuple's Entity."""
+    r = await tupl.session.get(tupl.entity_url.absolute, **kwargs)
+    if r.payload is None:
+        raise TypeError("Response could not be parsed.", r)
+    return r.payload
+
+
+async def wait_progress(r, session, progress_tracker=None, entity=None):
+    """Awaitable shoji.wait_progress.
+
+    Polls the progress URL of the given 202 response, sleeping without
+    blocking the event loop, until it completes, fails (TaskError), or the
+    progress tracker times out (TaskProgressTimeoutError).
+    """
+    progress_url = r.payload["value"]
+
+    if progress_tracker is None:
+        progress_tracker = session.progress_tracking
+
+    timeout = progress_tracker.timeout
+    progress_state = progress_tracker.start_progress()
+    intervals = poll_intervals(progress_tracker)
+    begin = time.time()
+    while timeout is None or time.time() - begin < timeout:
+        prog_r = await session.get(progress_url)
+        progress = prog_r.payload["value"]
+        progress_tracker.on_progress(progress_state, progress)
+        if progress["progress"] == -1:
+            # Completed due to error
+            raise TaskError(progress["message"])
+        elif progress["progress"] == 100:
+            # Completed with success
+            break
+        delay = next(intervals)
+        server_delay = retry_after(prog_r)
+        if server_delay is not None:
+            delay = server_delay
+        await asyncio.sleep(delay)
+    else:
+        # Loop completed due to timeout
+        raise TaskProgressTimeoutError(entity, r, timeout=timeout)
@@ -0,0 +1,139 @@
+"""Read the rows of a Crunch dataset as Apache Arrow record batches.
+
+The columns of each page of the dataset's crunch:table fragment are
+converted straight to Arrow arrays, without building Python lists of
+values or pandas objects in between:
+
+    >>> from pycrunch import arrowlib
+    >>> for batch in arrowlib.iter_record_batches(dataset):
+    ...     ...
+    >>> arrowlib.write_parquet(dataset, "dataset.parquet")
+
+Categorical variables become ordered dictionary arrays of their
+non-missing category names, numeric variables float64 arrays, datetime
+variables timestamp[ms] arrays and text variables string arrays; missing
+cells are null. Each field has the id of its Crunch variable as its
+b"crunch:id" metadata.
+
+This module requires pyarrow (pip install pycrunch[arrow]).
+"""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pycrunch.tables import (
+    TablePager, category_codes, float_array, id_array, object_array
+)
+
+ROWCHUNKSIZE = 1000
+PAGE_WINDOW = 4
+
+
+def array_from_variable(col, vardef, type=None):
+    """Return the given Crunch column and variable def as a pyarrow.Array.
+
+    The pyarrow 'type' is only used for variables other than categorical,
+    numeric, datetime and text ones, whose type is otherwise inferred from
+    the values.
+    """
+    if vardef.type == 'categorical':
+        categories = [cat for cat in vardef['categories'] if not cat['missing']]
+        codes = category_codes(id_array(col), [cat['id'] for cat in categories])
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes, mask=codes < 0, type=pa.int32()),
+            pa.array([cat['name'] for cat in categories], type=pa.string()),
+            ordered=True
+        )
+    elif vardef.type == 'numeric':
+        values = float_array(col)
+        return pa.array(values, mask=np.isnan(values))
+    elif vardef.type == 'datetime':
+        # NumPy parses ISO-8601 values of any resolution ("2020-03"...).
+        values = np.array(object_array(col), dtype='datetime64[ms]')
+        return pa.array(values, from_pandas=True)
+    elif vardef.type == 'text':
+        return pa.array(object_array(col), type=pa.string())
+
+    return pa.array(object_array(col), type=type)
+
+
+def record_batch(page, schema=None):
+    """Return a pyarrow.RecordBatch of the given crunch:table payload.
+
+    Its columns are in the order of `schema` if given (as returned by
+    .schema of a previous batch), else in that of the page's data.
+    """
+    metadata = page.metadata
+    if schema is None:
+        varids = list(page.data)
+    else:
+        varids = [field.metadata[b'crunch:id'].decode('utf-8') for field in schema]
+
+    arrays = []
+    fields = []
+    for i, varid in enumerate(varids):
+        vardef = metadata[varid]
+        type = None if schema is None else schema.field(i).type
+        array = array_from_variable(page.data[varid], vardef, type)
+        arrays.append(array)
+        fields.append(pa.field(
+            vardef.alias, array.type,
+            metadata={b'crunch:id': varid.encode('utf-8')}
+        ))
+
+    if schema is None:
+        schema = pa.schema(fields)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def iter_record_batches(dataset, chunksize=ROWCHUNKSIZE, window=PAGE_WINDOW,
+                        adaptive=True):
+    """Yield the rows of the given Crunch Dataset as pyarrow.RecordBatches.
+
+    Each batch holds one page of the dataset's table fragment, in order;
+    see tables.TablePager for 'chunksize', 'window' and 'adaptive'. All
+    batches have the schema of the first one.
+    """
+    schema = None
+    pager = TablePager(
+        dataset, chunksize=chunksize, window=window, adaptive=adaptive
+    )
+    for page in pager:
+        batch = record_batch(page, schema)
+        schema = batch.schema
+        yield batch
+
+
+def table(dataset, **kwargs):
+    """Return a pyarrow.Table of the rows of the given Crunch Dataset.
+
+    The keyword arguments are those of iter_record_batches.
+    """
+    batches = list(iter_record_batches(dataset, **kwargs))
+    return pa.Table.from_batches(batches)
+
+
+def write_parquet(dataset, where, chunksize=ROWCHUNKSIZE, window=PAGE_WINDOW,
+                  adaptive=True, **writer_kwargs):
+    """Write the rows of the given Crunch Dataset to a Parquet file.
+
+    The 'where' argument is a path or file-like object; 'writer_kwargs'
+    are passed to pyarrow.parquet.ParquetWriter. Each page of rows is
+    written as soon as it arrives, so only a window of pages is ever
+    held in memory. Return the number of rows written.
+    """
+    numrows = 0
+    writer = None
+    try:
+        for batch in iter_record_batches(
+            dataset, chunksize=chunksize, window=window, adaptive=adaptive
+        ):
+            if writer is None:
+                writer = pq.ParquetWriter(where, batch.schema, **writer_kwargs)
+            writer.write_batch(batch)
+            numrows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return numrows
@@ -1,85 +1,166 @@
 """
 CSV support for Crunch.
 
-The two functions, rows_as_csv_file* should be kept in sync.
-The differing behavior cannot be factored out due to
-the underlying stdlib csv module implementation and
-performance characteristics of Python function calls.
+Rows are encoded lazily, a chunk of UTF-8 bytes at a time, as they are
+read from the returned file: memory use does not grow with the number
+of rows, and the file can be streamed as the body of a request.
 """
 
 from __future__ import unicode_literals
 
-import io
 import csv
+import io
+import itertools
+
 import six
 
+# About how many bytes of CSV to encode at a time.
+CHUNKSIZE = 64 * 1024
+# How many rows to hand to the csv writer at a time.
+ROWS_PER_WRITE = 256
 
-def rows_as_csv_file(rows):
-    """Return rows (iterable of lists of cells) as a CSV file open
-    in binary mode.
 
-    Any cells in the given
-    rows which contain None will be emitted as an empty cell in the CSV
-    (nothing between the commas), which Crunch interprets as {"?": -1},
-    the "No Data" system missing value.
+class _EmptyCell(float):
+    """A number which the csv module writes as nothing at all.
+
+    Being a number, it is not quoted under QUOTE_NONNUMERIC, and its repr,
+    which the csv module writes for floats, is empty.
+    """
+
+    def __repr__(self):
+        return str()
+
+    __str__ = __repr__
+
+
+EMPTY_CELL = _EmptyCell()
+
+# The sentinel for None cells on Python 2, whose csv module formats
+# floats itself; it is removed from each encoded chunk.
+_SENTINEL = str("__CSV_SENTINEL_NONE__")
+
+
+def _empty_none(row):
+    """Return the given row with EMPTY_CELL for each None cell."""
+    if len(row) == 1 and row[0] is None:
+        # The csv module quotes a lone empty cell (""), which is an empty
+        # string, not No Data: write an empty line instead.
+        return []
+    return [EMPTY_CELL if cell is None else cell for cell in row]
+
+
+def iter_csv_chunks(rows, none_as_empty=True, chunksize=CHUNKSIZE):
+    """Yield the given rows (iterable of lists of cells) as CSV, in UTF-8 bytes.
+
+    Strings are quoted and numbers are not. If 'none_as_empty' is True,
+    None cells are emitted as empty cells (nothing between the commas),
+    which Crunch interprets as {"?": -1}, the "No Data" system missing
+    value; otherwise they are emitted as (quoted) empty strings.
+
+    Each chunk holds whole rows, and about 'chunksize' bytes.
     """
-    # Write to a StringIO because it joins lines as we go
-    # and a .read() of it (like requests.post will do) does not make a copy.
     out = io.StringIO() if six.PY3 else io.BytesIO()
+    writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+
+    if six.PY2:
+        none_cell = _SENTINEL
+
+        def convert(row):
+            return [
+                none_cell if cell is None and none_as_empty
+                else cell.encode('utf-8') if isinstance(cell, six.text_type)
+                else cell
+                for cell in row
+            ]
+        rows = six.moves.map(convert, rows)
+    elif none_as_empty:
+        rows = six.moves.map(_empty_none, rows)
+
+    rows = iter(rows)
+    while True:
+        before = out.tell()
+        writer.writerows(itertools.islice(rows, ROWS_PER_WRITE))
+        # Every row writes at least its line terminator.
+        done = out.tell() == before
+        if out.tell() >= chunksize or (done and out.tell()):
+            chunk = out.getvalue()
+            out.seek(0)
+            out.truncate()
+            if six.PY3:
+                yield chunk.encode('utf-8')
+            else:
+                yield chunk.replace(str('"' + _SENTINEL + '"'), str())
+        if done:
+            break
+
+
+class ChunkStream(io.RawIOBase):
+    """A read-only, binary file of the given iterable of bytes chunks.
+
+    The chunks are consumed as the file is read, so only one of them is
+    ever held in memory.
+    """
 
-    sentinel = "__CSV_SENTINEL_NONE__"
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b''
+        self._pos = 0
 
-    class EphemeralWriter():
-        def write(self, line):
-            line = line.replace(str('"' + sentinel + '"'), str())
-            out.write(line)
-    pipe = EphemeralWriter()
+    def readable(self):
+        return True
 
-    writer = csv.writer(pipe, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
-    for row in rows:
-        row = [sentinel if cell is None else cell for cell in row]
-        row = [
-            cell.encode('utf-8')
-            if six.PY2 and isinstance(cell, six.text_type) else cell
-            for cell in row
-        ]
-        writer.writerow(row)
+    def readinto(self, b):
+        while self._pos >= len(self._chunk):
+            self._chunk = next(self._chunks, None)
+            self._pos = 0
+            if self._chunk is None:
+                self._chunk = b''
+                return 0
+        n = min(len(b), len(self._chunk) - self._pos)
+        b[:n] = self._chunk[self._pos:self._pos + n]
+        self._pos += n
+        return n
 
-    out.seek(0)
 
-    if six.PY3:
-        out = io.BytesIO(out.getvalue().encode('utf-8'))
+class CSVStream(ChunkStream):
+    """A read-only, binary file of the CSV of the given rows.
+
+    The rows are encoded by iter_csv_chunks as the file is read, so only
+    about a chunk of the CSV is ever held in memory.
+    """
+
+    def __init__(self, rows, none_as_empty=True, chunksize=CHUNKSIZE):
+        super(CSVStream, self).__init__(
+            iter_csv_chunks(rows, none_as_empty, chunksize)
+        )
 
-    return out
+
+def rows_as_csv_file(rows):
+    """Return rows (iterable of lists of cells) as a CSV file open
+    in binary mode.
+
+    Any cells in the given
+    rows which contain None will be emitted as an empty cell in the CSV
+    (nothing between the commas), which Crunch interprets as {"?": -1},
+    the "No Data" system missing value.
+
+    The rows are encoded as the file is read (see CSVStream); it can be
+    passed as the data of a request to stream it.
+    """
+    return io.BufferedReader(CSVStream(rows), buffer_size=CHUNKSIZE)
 
 
 def rows_as_csv_file_clean(rows):
     """Return rows (iterable of lists of cells) as a CSV file open
     in binary mode.
 
-    Duplicate of rows_as_csv_file except
+    Same as rows_as_csv_file except
     None values are emitted
     normally by the Python csv library, which means as (quoted) empty strings.
     Use this function if the rows contain no None values or
     if None values are only used for "text" types and the empty
     string is a suitable representation for those values.
     """
-    # Write to a StringIO because it joins lines as we go
-    # and a .read() of it (like requests.post will do) does not make a copy.
-    out = io.StringIO() if six.PY3 else io.BytesIO()
-
-    writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
-    for row in rows:
-        row = [
-            cell.encode('utf-8')
-            if six.PY2 and isinstance(cell, six.text_type) else cell
-            for cell in row
-        ]
-        writer.writerow(row)
-
-    out.seek(0)
-
-    if six.PY3:
-        out = io.BytesIO(out.getvalue().encode('utf-8'))
-
-    return out
+    return io.BufferedReader(
+        CSVStream(rows, none_as_empty=False), buffer_size=CHUNKSIZE
+    )
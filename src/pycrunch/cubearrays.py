@@ -0,0 +1,130 @@
+"""The result of a crunch:cube query as NumPy arrays.
+
+The result of a cube query holds each measure as a flat list of cells,
+one per combination of the elements of its dimensions, in row-major
+order. Cube converts each such list to an n-dimensional array, shaped by
+the dimensions, in a single pass:
+
+    >>> cube = cubes.fetch_cube(dataset, ["gender", "age"], as_cube=True,
+    ...                         count=cubes.count())
+    >>> cube.shape
+    (3, 8)
+    >>> cube.dimensions[0].labels
+    ['Male', 'Female', 'No Data']
+    >>> cube.measures["count"]
+    array([[ 12.,  20., ...
+
+Missing cells of measures (e.g. the mean of no values) are NaN, and
+True in the measure's missing mask. Each dimension tells which of its
+elements are missing (e.g. the "No Data" category); valid() selects the
+non-missing elements of every dimension of an array.
+
+This module requires NumPy.
+"""
+
+import numpy as np
+
+from pycrunch.tables import float_array
+
+
+def _element_label(value):
+    """Return the label of the value of an element of an enum dimension."""
+    if isinstance(value, dict):
+        if "references" in value:
+            # A subvariable.
+            return value["references"].get("name")
+        if "?" in value:
+            return None
+        return value.get("name")
+    if isinstance(value, list):
+        # A [lower, upper) bin.
+        return "%s-%s" % tuple(value)
+    return value
+
+
+class CubeDimension(object):
+    """A dimension of a Cube.
+
+    Its `ids`, `labels` and `missing` mask follow the order of the
+    dimension's categories (or elements): that of the cube's axis.
+    """
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+        references = dimension.get("references", {})
+        self.alias = references.get("alias")
+        self.name = references.get("name")
+
+        vtype = dimension["type"]
+        if "categories" in vtype:
+            elements = vtype["categories"]
+            self.labels = [cat.get("name") for cat in elements]
+        else:
+            elements = vtype.get("elements", [])
+            self.labels = [_element_label(el.get("value")) for el in elements]
+        self.type = vtype.get("subtype", vtype)["class"]
+        self.ids = np.array([el.get("id") for el in elements])
+        self.missing = np.array(
+            [bool(el.get("missing")) for el in elements], dtype=bool
+        )
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return "<CubeDimension %s (%s, %d elements)>" % (
+            self.alias, self.type, len(self)
+        )
+
+
+class Cube(object):
+    """The result of a crunch:cube query, as NumPy arrays.
+
+    The `result` is the "result" member of the value of the crunch:cube
+    View (see cubes.fetch_cube). Attributes:
+
+     * dimensions: a list of CubeDimension, one per axis.
+     * shape: the tuple of the lengths of the dimensions.
+     * counts: the unweighted counts, as an int64 array of that shape.
+     * measures: a dict of {name: float64 array of that shape}; missing
+       cells are NaN.
+     * missing: a dict of {name: boolean array}, True for the missing
+       cells of that measure.
+     * n: the number of rows in the cube.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.dimensions = [CubeDimension(dim) for dim in result["dimensions"]]
+        self.shape = tuple(len(dim) for dim in self.dimensions)
+        self.n = result.get("n")
+
+        self.counts = np.array(result.get("counts", []), dtype=np.int64)
+        if self.counts.size:
+            self.counts = self.counts.reshape(self.shape)
+
+        self.measures = {}
+        self.missing = {}
+        for name, measure in result.get("measures", {}).items():
+            values = float_array(measure["data"]).reshape(self.shape)
+            self.measures[name] = values
+            self.missing[name] = np.isnan(values)
+
+    def valid(self, array):
+        """Return the given array of this cube's shape without missing elements.
+
+        That is, without the rows (columns...) of the missing elements of
+        each dimension, such as the "No Data" category.
+        """
+        return array[np.ix_(*[~dim.missing for dim in self.dimensions])]
+
+    @property
+    def valid_counts(self):
+        """The unweighted counts of the non-missing elements of every dimension."""
+        return self.valid(self.counts)
+
+    def __repr__(self):
+        return "<Cube %s: %s>" % (
+            "x".join(str(dim.alias) for dim in self.dimensions),
+            ", ".join(sorted(self.measures))
+        )
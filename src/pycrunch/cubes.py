@@ -2,12 +2,20 @@
 
 import six
 
-from pycrunch import elements
+from pycrunch import elements, jsoncodec
 
 
-def fetch_cube(dataset, dimensions, weight=None, filter=None, **measures):
+def fetch_cube(dataset, dimensions, weight=None, filter=None, as_cube=False,
+               **measures):
     """Return a shoji.View containing a crunch:cube.
 
+    If as_cube is True, return its result as a cubearrays.Cube instead:
+    its measures are NumPy arrays, shaped by the dimensions. That requires
+    NumPy.
+
+    The response is requested with stream=True, so sessions which
+    set stream_parsing parse it incrementally as it arrives.
+
     The dataset entity is used to look up its views.cube URL.
     The dimensions must be a list of either strings, which are assumed to be
     URL's of variable Entities to be fetched and analyzed according to type,
@@ -42,14 +50,20 @@ def fetch_cube(dataset, dimensions, weight=None, filter=None, **measures):
     if weight is not None:
         cube_query['weight'] = weight
 
-    params = {"query": cube_query.json}
+    codec = jsoncodec.session_codec(dataset.session)
+    params = {"query": codec.dumps(cube_query, separators=(",", ":"))}
     if filter is not None:
-        params['filter'] = elements.JSONObject(filter).json
+        params['filter'] = codec.dumps(filter, separators=(",", ":"))
 
-    return dataset.session.get(
+    view = dataset.session.get(
         dataset.views.cube,
-        params=params
+        params=params,
+        stream=True
     ).payload
+    if as_cube:
+        from pycrunch.cubearrays import Cube
+        return Cube(view.value["result"])
+    return view
 
 
 class DimensionsPreparer(object):
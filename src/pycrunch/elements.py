@@ -27,7 +27,12 @@ import warnings
 import six
 from requests.utils import get_environ_proxies
 
-from pycrunch import lemonpy
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from pycrunch import jsoncodec, lemonpy
 from pycrunch.progress import DefaultProgressTracking
 
 from .version import __version__
@@ -47,9 +52,70 @@ omitted = object()
 class JSONObject(dict):
     """A base class for JSON objects."""
 
+    # Set on instances built by a lazy parse_element: their members are then
+    # kept as decoded (plain dicts and lists) until first read.
+    _lazy_session = omitted
+
+    def __getitem__(self, key):
+        v = dict.__getitem__(self, key)
+        if self._lazy_session is not omitted:
+            v = self._parse_member(key, v)
+        return v
+
+    def get(self, key, default=None):
+        v = dict.get(self, key, omitted)
+        if v is omitted:
+            return default
+        if self._lazy_session is not omitted:
+            v = self._parse_member(key, v)
+        return v
+
+    def _parse_member(self, key, v):
+        t = type(v)
+        if t is dict or t is list:
+            v = parse_element(self._lazy_session, v, lazy=True)
+            dict.__setitem__(self, key, v)
+        return v
+
+    def _parse_members(self):
+        if self._lazy_session is not omitted:
+            for key, v in list(dict.items(self)):
+                self._parse_member(key, v)
+
+    def values(self):
+        self._parse_members()
+        return dict.values(self)
+
+    def items(self):
+        self._parse_members()
+        return dict.items(self)
+
+    def pop(self, key, *default):
+        self._parse_members()
+        return dict.pop(self, key, *default)
+
+    def update(self, *args, **kwargs):
+        other = args[0] if args else None
+        if isinstance(other, JSONObject) and other._lazy_session is not omitted:
+            # Its members may not be parsed yet: neither will ours be.
+            self._lazy_session = other._lazy_session
+        dict.update(self, *args, **kwargs)
+
+    if six.PY2:
+
+        def itervalues(self):
+            self._parse_members()
+            return dict.itervalues(self)
+
+        def iteritems(self):
+            self._parse_members()
+            return dict.iteritems(self)
+
     @property
     def json(self):
-        return json.dumps(self, indent=None, separators=(",", ":"))
+        # Not getattr: that would find a "session" member in a plain JSONObject.
+        codec = jsoncodec.session_codec(self.__dict__.get("session"))
+        return codec.dumps(self, separators=(",", ":"))
 
     @property
     def pretty(self):
@@ -73,6 +139,7 @@ class JSONObject(dict):
 
     def copy(self):
         """Return a (shallow) copy of self."""
+        self._parse_members()
         return self.__class__(**self)
 
 
@@ -100,30 +167,58 @@ class Element(JSONObject):
 
     def copy(self):
         """Return a (shallow) copy of self."""
+        self._parse_members()
         return self.__class__(self.session, **self)
 
 
 elements = {}
 
 
-def parse_element(session, j):
-    """Recursively replace dict with appropriate subclasses of JSONObjects."""
+def parse_element(session, j, lazy=False):
+    """Recursively replace dict with appropriate subclasses of JSONObjects.
+
+    If `lazy` is True, only the outermost dict (or each dict in the outermost
+    list) is replaced; members which are themselves dicts or lists are
+    parsed the same way only when first read from their JSONObject, via
+    item or attribute access, get(), values() or items(). Large payloads of
+    which only some branches are used then cost neither the time nor the
+    memory of rebuilding every other branch.
+    """
     t = type(j)
     if t is dict:
-        for k, v in list(six.iteritems(j)):
-            j[k] = parse_element(session, v)
+        if not lazy:
+            for k, v in list(six.iteritems(j)):
+                j[k] = parse_element(session, v)
 
         elem = j.get("element", None)
         if elem in elements:
-            return elements[elem](session, **j)
+            obj = elements[elem](session, **j)
         else:
-            return JSONObject(**j)
+            obj = JSONObject(**j)
+        if lazy:
+            _mark_lazy(obj, session)
+        return obj
     elif t is list:
-        return [parse_element(session, i) for i in j]
+        if not lazy:
+            return [parse_element(session, i) for i in j]
+        # Parse in place: most lists in large payloads are columns of scalars.
+        for i, v in enumerate(j):
+            tv = type(v)
+            if tv is dict or tv is list:
+                j[i] = parse_element(session, v, lazy=True)
+        return j
     else:
         return j
 
 
+def _mark_lazy(obj, session):
+    """Mark obj, and the JSONObjects its constructor made, as lazily parsed."""
+    obj._lazy_session = session
+    for v in dict.values(obj):
+        if isinstance(v, JSONObject) and v._lazy_session is omitted:
+            _mark_lazy(v, session)
+
+
 class Document(Element):
     """A base class for complete Documents classified by 'element'.
 
@@ -198,6 +293,13 @@ class Document(Element):
 
     def follow(self, key, qs=None, **kwargs):
         """GET the payload of the requested collection URL."""
+        url = self._follow_url(key, qs)
+        kwargs.setdefault("headers", {})
+        kwargs["headers"].setdefault("Accept", "application/json, */*")
+        return self.session.get(url, **kwargs).payload
+
+    def _follow_url(self, key, qs=None):
+        """Return the URL which self.follow(key, qs) requests."""
         url = None
         for collname in self.navigation_collections:
             coll = self.get(collname, {})
@@ -221,9 +323,7 @@ class Document(Element):
         if qs is not None:
             # Remove any existing qs, such as for URI Templates.
             url = url.rsplit("?", 1)[0] + "?" + qs
-        kwargs.setdefault("headers", {})
-        kwargs["headers"].setdefault("Accept", "application/json, */*")
-        return self.session.get(url, **kwargs).payload
+        return url
 
     def refresh(self):
         """GET self.self, update self with its payload and return self."""
@@ -239,21 +339,21 @@ class Document(Element):
         kwargs.setdefault("headers", {})
         kwargs["headers"].setdefault("Content-Type", "application/json")
         if not isinstance(data, six.string_types):
-            data = json.dumps(data)
+            data = jsoncodec.session_codec(self.session).dumps(data)
         return self.session.post(self.self, data, *args, **kwargs)
 
     def put(self, data, *args, **kwargs):
         kwargs.setdefault("headers", {})
         kwargs["headers"].setdefault("Content-Type", "application/json")
         if not isinstance(data, six.string_types):
-            data = json.dumps(data)
+            data = jsoncodec.session_codec(self.session).dumps(data)
         return self.session.put(self.self, data, *args, **kwargs)
 
     def patch(self, data, *args, **kwargs):
         kwargs.setdefault("headers", {})
         kwargs["headers"].setdefault("Content-Type", "application/json")
         if not isinstance(data, six.string_types):
-            data = json.dumps(data)
+            data = jsoncodec.session_codec(self.session).dumps(data)
         return self.session.patch(self.self, data, *args, **kwargs)
 
     def delete(self):
@@ -265,11 +365,37 @@ class Document(Element):
 
 def parse_json_element_from_response(session, r):
     """Return the appropriate Element instance if possible, otherwise JSON."""
-    if not r.text:
+    streamed = getattr(r, "streamed", False)
+    if streamed and getattr(session, "stream_parsing", False) and ijson is not None:
+        return parse_json_element_from_stream(session, r)
+
+    # Decode the bytes directly, skipping the intermediate r.text string.
+    if not r.content:
+        return JSONObject()
+    j = jsoncodec.session_codec(session).loads(r.content)
+
+    return parse_element(session, j, lazy=getattr(session, "lazy_parsing", False))
+
+
+def parse_json_element_from_stream(session, r):
+    """Return the Element of a streamed Response, parsed as it arrives.
+
+    The body is decoded incrementally from the socket by ijson, so that
+    neither the raw bytes nor the text of the body are ever held in memory
+    next to the decoded payload; for large crunch:table or cube responses
+    that cuts peak memory to about a third. The body is consumed: r.content
+    is not available afterward.
+    """
+    if r.headers.get("Content-Length") == "0":
         return JSONObject()
-    j = r.json()
 
-    return parse_element(session, j)
+    r.raw.decode_content = True
+    j = next(ijson.items(r.raw, "", use_float=True))
+    # Drain any trailing whitespace so the connection can be reused.
+    r.raw.read()
+    r.raw.release_conn()
+
+    return parse_element(session, j, lazy=getattr(session, "lazy_parsing", False))
 
 
 class ElementResponseHandler(lemonpy.ResponseHandler):
@@ -299,6 +425,14 @@ class ElementResponseHandler(lemonpy.ResponseHandler):
             data=json.dumps(self.session.credentials),
         )
 
+        body = r.request.body
+        if body is not None and not isinstance(body, (six.string_types, bytes)):
+            # A streamed body (a generator or file) was used up by the
+            # first attempt and cannot be sent again. We're logged in now,
+            # so the caller can retry the whole request.
+            self.parse_payload(r)
+            raise lemonpy.ClientError(r)
+
         # Repeat the request now that we've logged in. What a hack.
         r.request.headers["Cookie"] = login_r.headers["Set-Cookie"]
         env_proxies = get_environ_proxies(r.request.url, no_proxy=None)
@@ -315,6 +449,14 @@ class ElementSession(lemonpy.Session):
 
     headers = {"user-agent": "pycrunch/%s" % __version__}
     handler_class = ElementResponseHandler
+    # Set to True to parse response payloads lazily; see parse_element.
+    lazy_parsing = False
+    # Set to True to parse the payloads of requests made with stream=True
+    # as they arrive; see parse_json_element_from_stream. Needs ijson.
+    stream_parsing = False
+    # The codec for all JSON sent and received; see pycrunch.jsoncodec.
+    # None means jsoncodec.default_codec.
+    json_codec = None
 
     def __init__(
         self,
@@ -1,7 +1,50 @@
 # coding: utf-8
+"""Export Crunch datasets, and download the exported files.
+
+export_dataset exports a single dataset and waits for the export to
+complete. To export many datasets at once, use an ExportManager: it POSTs
+all exports concurrently, waits for all of their progress together (see
+shoji.ProgressMultiplexer), and downloads each exported file as soon as
+it is ready, straight to disk (see download):
+
+    >>> manager = ExportManager("/data/weekly", max_workers=16)
+    >>> for ds in datasets:
+    ...     manager.add(ds, {"where": {"function": "select", ...}},
+    ...                 filename=ds.body.name + ".csv")
+    >>> paths = manager.run()
+
+An exported file can also be read as it streams in, without touching
+disk, and decompressed on the fly if it is gzipped (see open_export):
+
+    >>> url = export_dataset(ds, {})
+    >>> df = pandas.read_csv(open_export(ds.session, url))
+"""
+import io
+import itertools
 import json
+import os
+import zlib
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+)
+
+from . import jsoncodec
+from .csvlib import ChunkStream
 from .lemonpy import URL
-from .shoji import wait_progress
+from .shoji import DEFAULT_MAX_WORKERS, progress_multiplexer, wait_progress
+
+# How many bytes of a download to read and write at a time.
+CHUNK_SIZE = 1024 * 1024
+# How many bytes of a download to request per HTTP range request.
+PART_SIZE = 64 * 1024 * 1024
+
+
+def _post_export(dataset, options, format):
+    """POST the export of the given dataset; return (response, file URL)."""
+    session = dataset.session
+    endpoint = dataset.export.views[format]
+    r = session.post(endpoint, jsoncodec.session_codec(session).dumps(options))
+    return r, URL(r.headers['Location'], '')
 
 
 def export_dataset(dataset, options, format='csv', progress_tracker=None):
@@ -14,10 +57,7 @@ def export_dataset(dataset, options, format='csv', progress_tracker=None):
     :param format: Export format, CSV or SPSS
     :return: URL instance containing the url for the final file download
     """
-    session = dataset.session
-    endpoint = dataset.export.views[format]
-    r = session.post(endpoint, json.dumps(options))
-    dest_file = URL(r.headers['Location'], '')
+    r, dest_file = _post_export(dataset, options, format)
     if r.status_code == 202:
         try:
             progress_url = r.payload['value']  # noqa
@@ -27,5 +67,440 @@ def export_dataset(dataset, options, format='csv', progress_tracker=None):
             pass
         else:
             # We have a progress_url, wait for completion
-            wait_progress(r, session, progress_tracker)
+            wait_progress(r, dataset.session, progress_tracker)
     return dest_file
+
+
+def start_export(dataset, options, format='csv', progress_tracker=None):
+    """
+    Starts exporting a Crunch dataset in the desired format, without waiting.
+
+    Same as export_dataset, but returns as soon as the export is accepted,
+    with a concurrent.futures.Future of the URL of the exported file. The
+    progress of the export is followed by shoji.progress_multiplexer, along
+    with that of any other pending export.
+    """
+    r, dest_file = _post_export(dataset, options, format)
+    if r.status_code == 202:
+        try:
+            progress_url = r.payload['value']  # noqa
+        except Exception:
+            pass
+        else:
+            return progress_multiplexer.add(
+                r, dataset.session, progress_tracker, entity=dest_file
+            )
+    future = Future()
+    future.set_result(dest_file)
+    return future
+
+
+class DownloadJournal(object):
+    """The parts of a ranged download already written to its partial file.
+
+    It is stored as JSON next to the partial file: the URL, total length
+    and part size of the download, and the indexes of the completed parts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.url = None
+        self.length = None
+        self.part_size = None
+        self.done = set()
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        self.url = stored['url']
+        self.length = stored['length']
+        self.part_size = stored['part_size']
+        self.done = set(stored['done'])
+
+    def matches(self, url, length, part_size):
+        return (url, length, part_size) == (self.url, self.length, self.part_size)
+
+    def parts(self):
+        """Return the number of parts of the download."""
+        return (self.length + self.part_size - 1) // self.part_size
+
+    def complete(self, url, part_size):
+        """Whether every part of the given download is already written."""
+        return (
+            (url, part_size) == (self.url, self.part_size)
+            and len(self.done) == self.parts()
+        )
+
+    def reset(self, url, length, part_size):
+        self.url = url
+        self.length = length
+        self.part_size = part_size
+        self.done = set()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'url': self.url,
+                'length': self.length,
+                'part_size': self.part_size,
+                'done': sorted(self.done),
+            }, f)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _content_length(r):
+    """Return the total length from the Content-Range of a 206 response."""
+    content_range = r.headers.get('Content-Range', '')
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        raise IOError("Unsupported Content-Range: %r" % content_range)
+
+
+def _expected_length(r):
+    """Return the Content-Length of the body of response r, or None.
+
+    None if unknown, or if the body is sent with a Content-Encoding, in
+    which case the length is that of the encoded body.
+    """
+    length = r.headers.get('Content-Length')
+    if length is None or r.headers.get('Content-Encoding'):
+        return None
+    return int(length)
+
+
+def _iter_content(r, chunk_size, expected=None):
+    """Yield the body of the streamed response r, checking its length."""
+    received = 0
+    try:
+        for chunk in r.iter_content(chunk_size):
+            received += len(chunk)
+            yield chunk
+    finally:
+        r.close()
+    if expected is not None and received != expected:
+        raise IOError(
+            "Received %d bytes instead of %d from %s" % (received, expected, r.url)
+        )
+
+
+def _write_response(r, f, chunk_size, expected=None):
+    """Write the body of the streamed response r to f; return its length."""
+    written = 0
+    for chunk in _iter_content(r, chunk_size, expected):
+        f.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def download(session, url, path, parallel=1, part_size=PART_SIZE,
+             chunk_size=CHUNK_SIZE, retries=2):
+    """Download the given URL to the given file path; return the path.
+
+    The body is streamed to disk, 'chunk_size' bytes at a time, into
+    path + '.part', which is renamed to path once complete. If the server
+    supports HTTP range requests, the file is requested in parts of
+    'part_size' bytes, 'parallel' at a time, and each failed part is
+    retried up to 'retries' times. The completed parts are recorded in
+    path + '.part.json' (see DownloadJournal), so that calling download
+    again after an interruption only requests the missing parts.
+
+    Servers without range support send the whole file in one response,
+    which cannot be resumed.
+    """
+    partial = path + '.part'
+    journal = DownloadJournal(partial + '.json')
+    if journal.complete(url, part_size) and os.path.exists(partial):
+        # Interrupted after its last part was written: nothing is left to
+        # request, and a range past the end would only be refused (416).
+        return _complete(partial, path, journal)
+
+    # Ask for the first part: a 206 reply tells the total length.
+    first = session.get(
+        url, stream=True, headers={'Range': 'bytes=0-%d' % (part_size - 1)}
+    )
+    if first.status_code != 206:
+        with open(partial, 'wb') as f:
+            _write_response(first, f, chunk_size, _expected_length(first))
+        return _complete(partial, path, journal)
+
+    length = _content_length(first)
+    if not (journal.matches(url, length, part_size) and os.path.exists(partial)):
+        journal.reset(url, length, part_size)
+        with open(partial, 'wb') as f:
+            f.truncate(length)
+        journal.save()
+
+    def fetch(index):
+        start = index * part_size
+        end = min(start + part_size, length) - 1
+        for attempt in range(retries + 1):
+            try:
+                if index == 0 and attempt == 0:
+                    r = first
+                else:
+                    r = session.get(
+                        url, stream=True,
+                        headers={'Range': 'bytes=%d-%d' % (start, end)}
+                    )
+                with open(partial, 'r+b') as f:
+                    f.seek(start)
+                    _write_response(r, f, chunk_size, end - start + 1)
+                return
+            except Exception:
+                if attempt == retries:
+                    raise
+
+    parts = [
+        index for index in range(journal.parts())
+        if index not in journal.done
+    ]
+    if 0 not in parts:
+        first.close()
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = dict((executor.submit(fetch, index), index) for index in parts)
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                future.result()
+            except Exception as exc:
+                failures[index] = exc
+            else:
+                journal.done.add(index)
+                journal.save()
+    if failures:
+        raise DownloadError(url, failures)
+
+    return _complete(partial, path, journal)
+
+
+def _complete(partial, path, journal):
+    """Move the partial file of a finished download into place."""
+    journal.remove()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(partial, path)
+    return path
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def gunzip_chunks(chunks):
+    """Yield the decompressed bytes of the given chunks of gzip data.
+
+    Concatenated gzip members, as written by e.g. parallel compressors,
+    are decompressed in turn. Raise IOError if the data is truncated.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            # Anything past the end of a member is the start of the next.
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.flush()
+    if data:
+        yield data
+    if not getattr(decompressor, 'eof', True):
+        raise IOError("The gzip data is truncated.")
+
+
+def iter_export(session, url, chunk_size=CHUNK_SIZE, decompress=True):
+    """Yield the bytes of the exported file at the given URL, chunk by chunk.
+
+    The file is streamed through the given session, and the number of bytes
+    received is checked against its Content-Length (IOError if they differ).
+    If 'decompress' is True and the file is gzipped, its decompressed bytes
+    are yielded instead.
+    """
+    r = session.get(url, stream=True)
+    chunks = _iter_content(r, chunk_size, _expected_length(r))
+    if not decompress:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    # Read enough of the file to tell whether it is gzipped.
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(GZIP_MAGIC):
+            break
+    rest = itertools.chain([head], chunks)
+    if head.startswith(GZIP_MAGIC):
+        rest = gunzip_chunks(rest)
+    for chunk in rest:
+        if chunk:
+            yield chunk
+
+
+def open_export(session, url, chunk_size=CHUNK_SIZE, decompress=True):
+    """Return the exported file at the given URL as a binary file, open to read.
+
+    The file is read from the network as it is read; see iter_export. It
+    can be passed as is to pandas.read_csv, or wrapped in io.TextIOWrapper
+    for the csv module. Only about a chunk of it is held in memory.
+    """
+    return io.BufferedReader(
+        ChunkStream(iter_export(session, url, chunk_size, decompress)),
+        buffer_size=chunk_size
+    )
+
+
+def download_export(session, url, dest, chunk_size=CHUNK_SIZE, decompress=True):
+    """Stream the exported file at the given URL to 'dest'; return its size.
+
+    The 'dest' is a file path or a writable binary file; see iter_export for
+    the other arguments. A path is written as path + '.part' first, and
+    renamed once the file is complete.
+    """
+    if hasattr(dest, 'write'):
+        size = 0
+        for chunk in iter_export(session, url, chunk_size, decompress):
+            dest.write(chunk)
+            size += len(chunk)
+        return size
+
+    partial = dest + '.part'
+    try:
+        with open(partial, 'wb') as f:
+            size = download_export(session, url, f, chunk_size, decompress)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    if os.path.exists(dest):
+        os.remove(dest)
+    os.rename(partial, dest)
+    return size
+
+
+class DownloadError(IOError):
+    """Some parts of a download failed; download() again to resume it.
+
+    The 'failures' attribute is a dict of {part index: exception}.
+    """
+
+    def __init__(self, url, failures):
+        super(DownloadError, self).__init__(
+            "%d parts of %s could not be downloaded." % (len(failures), url)
+        )
+        self.url = url
+        self.failures = failures
+
+
+class ExportError(ValueError):
+    """Some of the exports of an ExportManager failed.
+
+    The 'failures' attribute is a dict of {path: exception}, and 'paths'
+    the list of the paths of the files which were downloaded.
+    """
+
+    def __init__(self, failures, paths):
+        super(ExportError, self).__init__(
+            "%d of %d exports failed." % (len(failures), len(failures) + len(paths))
+        )
+        self.failures = failures
+        self.paths = paths
+
+
+class ExportManager(object):
+    """Export many datasets concurrently, and download the exported files.
+
+    Exports are queued with add(), and performed by run(): up to
+    'max_workers' threads POST the exports, and then download each file,
+    to the given directory, as soon as its export is complete. Meanwhile,
+    the progress of all pending exports is polled from a single thread.
+    The 'parallel', 'part_size' and 'retries' arguments are those of
+    download, for each file.
+    """
+
+    def __init__(self, directory, max_workers=DEFAULT_MAX_WORKERS, parallel=1,
+                 part_size=PART_SIZE, retries=2, progress_tracker=None):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.parallel = parallel
+        self.part_size = part_size
+        self.retries = retries
+        self.progress_tracker = progress_tracker
+        self.exports = []
+
+    def add(self, dataset, options=None, format='csv', filename=None):
+        """Queue the export of the given dataset; return the path of its file.
+
+        The file name defaults to the dataset id and the format.
+        """
+        if options is None:
+            options = {}
+        if filename is None:
+            filename = '%s.%s' % (dataset.body.id, format)
+        path = os.path.join(self.directory, filename)
+        self.exports.append((dataset, options, format, path))
+        return path
+
+    def _start(self, dataset, options, format):
+        return start_export(dataset, options, format, self.progress_tracker)
+
+    def _download(self, dataset, url, path):
+        return download(
+            dataset.session, url, path, parallel=self.parallel,
+            part_size=self.part_size, retries=self.retries
+        )
+
+    def run(self):
+        """Perform all queued exports; return the list of downloaded paths.
+
+        If any export or download fails, the others are completed
+        nonetheless, and ExportError is raised at the end. The failed
+        exports stay queued, so that calling run() again retries them.
+        """
+        exports, self.exports = self.exports, []
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        paths = []
+        failures = {}
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for export in exports:
+                dataset, options, format, path = export
+                future = executor.submit(self._start, dataset, options, format)
+                pending[future] = ('start', export)
+
+            while pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, export = pending.pop(future)
+                    dataset, options, format, path = export
+                    try:
+                        result = future.result()
+                    except Exception as exc:
+                        failures[path] = exc
+                        self.exports.append(export)
+                        continue
+                    if stage == 'start':
+                        # The Future of the progress of the export.
+                        pending[result] = ('export', export)
+                    elif stage == 'export':
+                        future = executor.submit(self._download, dataset, result, path)
+                        pending[future] = ('download', export)
+                    else:
+                        paths.append(result)
+
+        if failures:
+            raise ExportError(failures, paths)
+        return paths
@@ -1,11 +1,233 @@
+import hashlib
+import io
 import json
 import mimetypes
 import os
+import threading
 import time
+import uuid
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import six
 
-from pycrunch import csvlib, shoji
+from pycrunch import csvlib, jsoncodec, progress, shoji
+
+
+def multipart_body(name, filename, chunks, mimetype, data=None):
+    """Return a (body, content type) pair for a streamed multipart/form-data POST.
+
+    The body is an iterator of bytes: the given 'data' fields (a dict),
+    then the file part named 'name', whose content is the given iterable
+    of bytes chunks, yielded as they come. Pass it as the data of a
+    request to upload the file without holding it in memory.
+    """
+    boundary = uuid.uuid4().hex
+
+    def body():
+        for key, value in sorted((data or {}).items()):
+            yield (
+                '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                % (boundary, key, value)
+            ).encode('utf-8')
+        yield (
+            '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            'Content-Type: %s\r\n\r\n'
+            % (boundary, name, filename, mimetype or 'application/octet-stream')
+        ).encode('utf-8')
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+        yield ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+
+    return body(), 'multipart/form-data; boundary=%s' % boundary
+
+
+def iter_chunks(fp):
+    """Return the given string, bytes, open file or iterable as bytes chunks.
+
+    Text, from a file opened in text mode say, is encoded to UTF-8.
+    """
+    if isinstance(fp, six.text_type):
+        fp = fp.encode('utf-8')
+    if isinstance(fp, bytes):
+        return iter([fp])
+    if hasattr(fp, 'read'):
+        # Read up to an empty chunk, whether b'' or (in text mode) ''.
+        chunks = iter(lambda: fp.read(READ_SIZE) or None, None)
+    else:
+        chunks = iter(fp)
+    return (
+        chunk.encode('utf-8') if isinstance(chunk, six.text_type) else chunk
+        for chunk in chunks
+    )
+
+
+def gzip_chunks(chunks, level=6):
+    """Yield the given iterable of bytes chunks gzip-compressed, as it goes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# The default size, in bytes, of the shards of append_csv_sharded.
+SHARD_SIZE = 64 * 1024 * 1024
+# How many bytes of a file to read at a time while splitting it.
+READ_SIZE = 1024 * 1024
+
+
+def _row_end(buf, start, quotes):
+    """Return the index after the first row end in buf at or after start, or -1.
+
+    A row ends at a newline outside quotes: one preceded by an even
+    number of quote characters in buf (which starts at a row boundary).
+    The 'quotes' argument is the count of quotes in buf[:start].
+    """
+    while True:
+        pos = buf.find(b'\n', start)
+        if pos == -1:
+            return -1
+        quotes += buf.count(b'"', start, pos)
+        if quotes % 2 == 0:
+            return pos + 1
+        start = pos + 1
+
+
+def iter_csv_shards(fp, shard_size=SHARD_SIZE):
+    """Yield the given CSV file (or bytes) as shards of whole rows, in order.
+
+    Each shard is a bytes CSV of its own: the header row of the file,
+    then about 'shard_size' bytes of its next rows. Rows are never split,
+    even if quoted values hold newlines.
+    """
+    for offset, shard in _iter_csv_shards(fp, shard_size):
+        yield shard
+
+
+def _iter_csv_shards(fp, shard_size):
+    """Yield (offset in the file of its rows, shard) for iter_csv_shards."""
+    if isinstance(fp, six.text_type):
+        fp = fp.encode('utf-8')
+    if isinstance(fp, bytes):
+        fp = io.BytesIO(fp)
+
+    def read():
+        return fp.read(READ_SIZE)
+
+    buf = bytearray()
+    header = None
+    offset = 0
+    eof = False
+    while True:
+        # Find the end of the header, or of the next shard of rows.
+        target = 0 if header is None else shard_size
+        end = -1
+        if len(buf) > target:
+            end = _row_end(buf, target, buf.count(b'"', 0, target))
+        if end == -1:
+            block = b'' if eof else read()
+            if block:
+                buf += block
+                continue
+            eof = True
+            if not buf:
+                break
+            end = len(buf)
+
+        if header is None:
+            header = bytes(buf[:end])
+            if not header.endswith(b'\n'):
+                header += b'\n'
+        else:
+            yield offset, header + bytes(buf[:end])
+        offset += end
+        del buf[:end]
+
+
+class UploadJournal(object):
+    """A JSON file recording the progress of a sharded append.
+
+    For each shard whose upload was acknowledged, the journal holds its
+    offset and length in the file, the SHA-256 digest of its content, and
+    its Source URL; and, once created, the URL of its Batch. It is saved
+    (atomically) after each such step, so that the append can be resumed
+    from there after a failure, even by another process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.shards = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.shards = json.load(f)["shards"]
+
+    def save(self):
+        tmp = "%s.tmp" % self.path
+        with open(tmp, "w") as f:
+            json.dump({"shards": self.shards}, f)
+        if os.name == "nt" and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def get(self, index, offset, shard):
+        """Return the journal entry of the given shard, or None.
+
+        Raise ValueError if the journal has an entry for the index which
+        does not match the shard: the file has changed since.
+        """
+        entry = self.shards.get(str(index))
+        if entry is None:
+            return None
+        if (
+            entry["offset"] != offset
+            or entry["length"] != len(shard)
+            or entry["sha256"] != hashlib.sha256(shard).hexdigest()
+        ):
+            raise ValueError(
+                "Shard %d does not match the upload journal %s: "
+                "the file has changed." % (index, self.path)
+            )
+        return entry
+
+    def record_source(self, index, offset, shard, source_url):
+        with self.lock:
+            self.shards[str(index)] = {
+                "offset": offset,
+                "length": len(shard),
+                "sha256": hashlib.sha256(shard).hexdigest(),
+                "source": source_url,
+                "batch": None,
+            }
+            self.save()
+
+    def record_batch(self, index, batch_url):
+        with self.lock:
+            self.shards[str(index)]["batch"] = batch_url
+            self.save()
+
+
+class UploadError(ValueError):
+    """Some of the shards of a sharded append could not be uploaded.
+
+    The 'failures' attribute is a dict of {shard index: exception}, and
+    'sources' is the list of the Source URLs of all shards, in order, with
+    None for the failed ones. No batch has been created.
+    """
+
+    def __init__(self, failures, sources):
+        super(UploadError, self).__init__(
+            "%d of %d shards could not be uploaded." % (len(failures), len(sources))
+        )
+        self.failures = failures
+        self.sources = sources
 
 
 class Importer(object):
@@ -17,23 +239,31 @@ class Importer(object):
     If 0, then any undefined columns present in the CSV are ignored,
     and any undefined category ids generate new "missing" categories
     with the given id.
+
+    If 'compress' is True, CSV sources are uploaded gzip-compressed, as
+    "<filename>.gz" files of type application/gzip, which the sources
+    endpoint decompresses. The compressed body is streamed as it is made.
     """
 
     def __init__(self, retries=40, frequency=0.25,
                  backoff_rate=1.1, backoff_max=30, strict=None,
-                 progress_tracker=None):
+                 progress_tracker=None, compress=False):
         self.retries = retries
         self.frequency = frequency
         self.backoff_rate = backoff_rate
         self.backoff_max = backoff_max
         self.strict = strict
         self.progress_tracker = progress_tracker
+        self.compress = compress
 
     def wait_for_batch_status(self, batch, status):
         """Wait for the given status(es) and return the batch. Error if not reached."""
         if isinstance(status, six.string_types):
             status = [status]
 
+        intervals = progress.backoff_intervals(
+            self.frequency, self.backoff_rate, self.backoff_max
+        )
         for trial in range(self.retries):
             new_batch = batch.session.get(batch.self).payload
             st = new_batch.body['status']
@@ -44,23 +274,39 @@ class Importer(object):
             elif st in status:
                 return new_batch
             else:
-                time.sleep(self.frequency)
-                if self.frequency < self.backoff_max:
-                    self.frequency *= self.backoff_rate
-                    if self.frequency > self.backoff_max:
-                        self.frequency = self.backoff_max
+                time.sleep(next(intervals))
         else:
             raise ValueError("The batch did not reach the '%s' state in the "
                              "given time. Please check again later." % status)
 
     def add_source(self, ds, filename, fp, mimetype, data=None):
-        """Create a new Source on the given dataset and return its URL."""
+        """Create a new Source on the given dataset and return its URL.
+
+        The 'fp' is a string or open file, or else an iterator of bytes
+        chunks, which is streamed in the request body; see multipart_body.
+        If self.compress is True, CSV is compressed on the way.
+        """
         sources_url = ds.user_url.catalogs['sources']
+        if self.compress and mimetype == 'text/csv':
+            fp = gzip_chunks(iter_chunks(fp))
+            filename += '.gz'
+            mimetype = 'application/gzip'
         # Don't call Catalog.post here (which would force application/json);
-        # we want requests.Session to set multipart/form-data with a boundary.
-        new_source_url = ds.session.post(
-            sources_url, files={"uploaded_file": (filename, fp, mimetype)}, data=data
-        ).headers["Location"]
+        # we want multipart/form-data with a boundary.
+        if isinstance(fp, (six.string_types, bytes)) or hasattr(fp, 'read'):
+            # requests.Session sets the boundary, but reads fp in full.
+            r = ds.session.post(
+                sources_url, files={"uploaded_file": (filename, fp, mimetype)},
+                data=data
+            )
+        else:
+            body, content_type = multipart_body(
+                "uploaded_file", filename, fp, mimetype, data
+            )
+            r = ds.session.post(
+                sources_url, data=body, headers={"Content-Type": content_type}
+            )
+        new_source_url = r.headers["Location"]
 
         if self.strict is not None:
             r = ds.session.get(new_source_url)
@@ -84,14 +330,21 @@ class Importer(object):
         return ds.batches.create(batch, progress_tracker=self.progress_tracker).refresh()
 
     def append_rows(self, ds, rows):
-        """Append the given rows of Python values. Return the new Batch."""
-        f = csvlib.rows_as_csv_file(rows)
-        return self.append_csv_string(ds, f)
+        """Append the given rows of Python values. Return the new Batch.
+
+        The rows are encoded to CSV as they are uploaded, so memory use
+        does not grow with their number.
+        """
+        chunks = csvlib.iter_csv_chunks(rows)
+        return self.append_csv_string(ds, chunks)
     # Deprecated spelling:
     create_batch_from_rows = append_rows
 
     def append_csv_string(self, ds, csv_file, filename=None):
-        """Append the given CSV string or open file. Return its Batch."""
+        """Append the given CSV string or open file. Return its Batch.
+
+        The CSV may also be an iterator of bytes chunks; see add_source.
+        """
         if filename is None:
             filename = 'upload.csv'
 
@@ -122,6 +375,125 @@ class Importer(object):
         source_url = self.add_source(ds, filename, open(path, 'rb'), mimetype)
         return self.create_batch_from_source(ds, source_url)
 
+    def append_dataframe(self, ds, df, filename=None,
+                         chunksize=None):
+        """Append the rows of the given pandas DataFrame. Return the new Batch.
+
+        The columns of the DataFrame are matched to the dataset's variables
+        by alias. Those of categorical variables may hold category names
+        (or ids), which are converted to ids per the dataset's metadata.
+        The CSV is encoded in chunks of 'chunksize' rows, and streamed to
+        the server as it is; see pandaslib.iter_dataframe_csv_chunks.
+        """
+        from pycrunch import pandaslib
+
+        if filename is None:
+            filename = 'upload.csv'
+        if chunksize is None:
+            chunksize = pandaslib.CSV_ROWCHUNKSIZE
+
+        # The table fragment with no rows holds just the variable definitions.
+        metadata = ds.session.get(
+            "%s?limit=0" % ds.fragments['table']
+        ).payload['metadata']
+        chunks = pandaslib.iter_dataframe_csv_chunks(df, metadata, chunksize=chunksize)
+        source_url = self.add_source(ds, filename, chunks, 'text/csv')
+        return self.create_batch_from_source(ds, source_url)
+
+    def append_csv_sharded(self, ds, csv_file, filename=None,
+                           shard_size=SHARD_SIZE, max_workers=None,
+                           shard_retries=2, journal=None):
+        """Append the given CSV string, bytes or open file, in shards.
+
+        The CSV is split into shards of whole rows (see iter_csv_shards),
+        each of which is uploaded as a Source of its own, by a pool of
+        'max_workers' threads (default: shoji.DEFAULT_MAX_WORKERS). Each shard
+        is streamed in its request body, and only about one shard per thread
+        is read ahead, so memory stays bounded.
+        A failed upload is retried, for that shard only, up to
+        'shard_retries' times.
+
+        If every shard was uploaded, a Batch is then created for each of
+        them in order, and the list of Batches is returned. Otherwise,
+        UploadError is raised and no Batch is created.
+
+        If 'journal' is the path of a file, the progress of the append is
+        recorded there (see UploadJournal), and a call with the same file,
+        shard_size and journal resumes it: the shards already uploaded are
+        not sent again, and the Batches already created are not created
+        again. A shard whose checksum no longer matches raises ValueError.
+        The journal is removed once all Batches are created.
+        """
+        if filename is None:
+            filename = 'upload.csv'
+        if max_workers is None:
+            max_workers = shoji.DEFAULT_MAX_WORKERS
+        base, ext = os.path.splitext(filename)
+        if journal is not None:
+            journal = UploadJournal(journal)
+
+        def upload(index, offset, shard):
+            shard_filename = '%s.part%04d%s' % (base, index, ext)
+            for attempt in range(shard_retries + 1):
+                try:
+                    # Stream it: posting files= would copy the whole shard.
+                    source_url = self.add_source(
+                        ds, shard_filename, iter_chunks(shard), 'text/csv'
+                    )
+                    break
+                except Exception:
+                    if attempt == shard_retries:
+                        raise
+            if journal is not None:
+                journal.record_source(index, offset, shard, source_url)
+            return source_url
+
+        sources = []
+        batches = []
+        failures = {}
+
+        def collect(done):
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    sources[index] = future.result()
+                except Exception as exc:
+                    failures[index] = exc
+
+        pending = {}
+        shards = _iter_csv_shards(csv_file, shard_size)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for index, (offset, shard) in enumerate(shards):
+                entry = None
+                if journal is not None:
+                    entry = journal.get(index, offset, shard)
+                if entry is not None:
+                    sources.append(entry["source"])
+                    batches.append(entry["batch"])
+                    continue
+                if len(pending) >= max_workers:
+                    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                sources.append(None)
+                batches.append(None)
+                pending[executor.submit(upload, index, offset, shard)] = index
+            collect(wait(pending)[0])
+
+        if failures:
+            raise UploadError(failures, sources)
+
+        for index, url in enumerate(sources):
+            if batches[index] is None:
+                batch = self.create_batch_from_source(ds, url)
+                if journal is not None:
+                    journal.record_batch(index, batch.self)
+            else:
+                batch = ds.session.get(batches[index]).payload
+            batches[index] = batch
+        if journal is not None:
+            journal.remove()
+        return batches
+
     def stream_rows(self, ds, values):
         """Send a data row (or list of rows) to the given dataset's stream.
 
@@ -137,11 +509,219 @@ class Importer(object):
         """
         if isinstance(values, dict):
             values = [values]
+        codec = jsoncodec.session_codec(ds.session)
         return ds.session.post(
             ds.fragments.stream,
-            data="\n".join([json.dumps(row, indent=None) for row in values])
+            data="\n".join([codec.dumps(row) for row in values])
         )
 
+    def stream_writer(self, ds, **kwargs):
+        """Return a StreamWriter for the given dataset, which appends with self.
+
+        The keyword arguments are those of StreamWriter.
+        """
+        return StreamWriter(ds, importer=self, **kwargs)
+
+    def append_pending_stream(self, ds):
+        """Append the rows sent to the dataset's stream so far. Return the Batch."""
+        batch = shoji.Entity(ds.session, body={'stream': None, 'type': 'ldjson'})
+        return ds.batches.create(batch, progress_tracker=self.progress_tracker).refresh()
+
+
+class StreamWriter(object):
+    """Send rows to a dataset's stream in batches, from a background thread.
+
+    Rows given to write() are buffered, and all the buffered rows are sent
+    in one POST (as Importer.stream_rows does) once there are 'max_rows'
+    of them, or 'max_bytes' of JSON, or the oldest one has waited for
+    'max_age' seconds. A single thread sends them, one request at a time,
+    so a single pooled connection of the session is used throughout. If
+    'compress' is True, request bodies are gzip-compressed.
+
+    If 'append_every' is a number of seconds, the rows sent to the stream
+    are also appended to the dataset (see Importer.append_pending_stream)
+    that often, and once more on close().
+
+    Any error in the background thread is raised by the next call to
+    write() (once its row is buffered) or flush(); the rows which could
+    not be sent are kept, and the thread sends nothing more until then.
+    close() sends them once more, and may be called again if that fails.
+    Use the writer as a context manager, or call close(), to send the last
+    rows:
+
+        >>> with importer.stream_writer(ds, max_age=0.5) as writer:
+        ...     for event in events:
+        ...         writer.write(event)
+    """
+
+    def __init__(self, ds, max_rows=1000, max_bytes=1024 * 1024, max_age=1.0,
+                 compress=False, append_every=None, importer=None):
+        self.ds = ds
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.append_every = append_every
+        self.importer = importer or Importer()
+
+        self.url = ds.fragments.stream
+        self.codec = jsoncodec.session_codec(ds.session)
+        self._lines = []
+        self._nbytes = 0
+        self._oldest = None
+        self._unappended = 0
+        self._last_append = time.time()
+        self._error = None
+        self._stopping = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, row):
+        """Buffer the given row, a dict of {variable_id: value} in Crunch I/O format."""
+        line = self.codec.dumps(row)
+        with self._cond:
+            if self._stopping:
+                raise ValueError("I/O operation on closed StreamWriter.")
+            if not self._lines:
+                # Wake the thread up to wait for max_age instead.
+                self._oldest = time.time()
+                self._cond.notify()
+            self._lines.append(line)
+            self._nbytes += len(line) + 1
+            if self._full():
+                self._cond.notify()
+        self._raise_error()
+
+    def write_rows(self, rows):
+        """Buffer each of the given rows."""
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        """Send all buffered rows now."""
+        self._raise_error()
+        while self._lines:
+            self._send_buffer()
+
+    def close(self):
+        """Send all buffered rows, append them if 'append_every', and stop."""
+        with self._cond:
+            if self._closed:
+                return
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        # Retry whatever the thread failed to send, rather than only raise
+        # its error: the connection may be back by now.
+        self._error = None
+        self.flush()
+        if self.append_every is not None and self._unappended:
+            self._append()
+        self._closed = True
+
+    def _full(self):
+        return len(self._lines) >= self.max_rows or self._nbytes >= self.max_bytes
+
+    def _timeout(self):
+        """Return how long the thread may wait before some rows are due."""
+        now = time.time()
+        deadlines = []
+        if self._lines:
+            deadlines.append(self._oldest + self.max_age)
+        if self.append_every is not None and self._unappended:
+            deadlines.append(self._last_append + self.append_every)
+        if not deadlines:
+            return None
+        return max(min(deadlines) - now, 0)
+
+    def _take(self):
+        """Remove and return the next max_rows buffered lines."""
+        lines = self._lines[:self.max_rows]
+        del self._lines[:self.max_rows]
+        if self._lines:
+            self._nbytes -= sum(len(line) + 1 for line in lines)
+        else:
+            self._nbytes = 0
+        return lines
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if self._error is not None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._timeout()
+                    if self._full() or timeout == 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopping:
+                    return
+            try:
+                self._send_buffer()
+            except Exception as exc:
+                self._error = exc
+                continue
+            try:
+                if (
+                    self.append_every is not None and self._unappended
+                    and time.time() - self._last_append >= self.append_every
+                ):
+                    self._append()
+            except Exception as exc:
+                self._error = exc
+
+    def _restore(self, lines):
+        """Put back the given unsent lines at the front of the buffer."""
+        self._lines[:0] = lines
+        self._nbytes += sum(len(line) + 1 for line in lines)
+        self._oldest = time.time()
+
+    def _send_buffer(self):
+        """Send the next buffered rows; on error, put them back and raise."""
+        # Taking and sending under _send_lock keeps the rows in order.
+        with self._send_lock:
+            with self._cond:
+                lines = self._take()
+            if not lines:
+                return
+            body = "\n".join(lines).encode('utf-8')
+            headers = {}
+            if self.compress:
+                body = b''.join(gzip_chunks([body]))
+                headers["Content-Encoding"] = "gzip"
+            try:
+                self.ds.session.post(self.url, data=body, headers=headers)
+            except Exception:
+                with self._cond:
+                    self._restore(lines)
+                raise
+            self._unappended += len(lines)
+
+    def _append(self):
+        with self._send_lock:
+            self.importer.append_pending_stream(self.ds)
+            self._unappended = 0
+            self._last_append = time.time()
+
+    def _raise_error(self):
+        if self._error is not None:
+            with self._cond:
+                error, self._error = self._error, None
+                self._cond.notify()
+            if error is not None:
+                raise error
+
 
 importer = Importer()
 """A default Importer."""
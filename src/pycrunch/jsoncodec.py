@@ -0,0 +1,143 @@
+"""Pluggable JSON encoders and decoders.
+
+All the JSON which pycrunch decodes from responses, and encodes for
+request bodies and queries, goes through the codec of the session
+involved: its `json_codec` attribute. The default is JSONCodec, which
+uses the standard library json module. Faster third-party libraries can
+be used instead, when installed:
+
+    >>> from pycrunch import jsoncodec
+    >>> site.session.json_codec = jsoncodec.get_codec("orjson")
+
+or, picking the fastest installed one:
+
+    >>> site.session.json_codec = jsoncodec.get_codec("auto")
+
+Codecs decode straight from the response bytes, without first decoding
+them to text. Objects without a session (plain JSONObjects) use the
+module-wide `default_codec`, which set_default_codec replaces.
+"""
+
+import json
+import sys
+
+import six
+
+codecs = {}
+
+
+def register(codec_class):
+    """Register the given JSONCodec subclass under its .name; return it."""
+    codecs[codec_class.name] = codec_class
+    return codec_class
+
+
+@register
+class JSONCodec(object):
+    """A codec using the standard library json module.
+
+    This is the base class for other codecs, and their fallback.
+    Subclasses name the module they need as .module; get_codec
+    only returns those whose module can be imported.
+    """
+
+    name = "json"
+    module = "json"
+
+    def __init__(self):
+        self.lib = __import__(self.module)
+
+    def loads(self, s):
+        """Return the value of the given JSON text, or UTF-8 encoded bytes."""
+        if isinstance(s, bytes) and sys.version_info[:2] in ((3, 4), (3, 5)):
+            s = s.decode("utf-8")
+        return json.loads(s)
+
+    def dumps(self, obj, separators=None):
+        """Return the given value as JSON text."""
+        return json.dumps(obj, separators=separators)
+
+    @classmethod
+    def available(cls):
+        try:
+            __import__(cls.module)
+        except ImportError:
+            return False
+        return True
+
+
+@register
+class OrjsonCodec(JSONCodec):
+    """A codec using orjson, which always emits compact, UTF-8 JSON."""
+
+    name = "orjson"
+    module = "orjson"
+
+    def loads(self, s):
+        return self.lib.loads(s)
+
+    def dumps(self, obj, separators=None):
+        return self.lib.dumps(obj, option=self.lib.OPT_NON_STR_KEYS).decode("utf-8")
+
+
+@register
+class UjsonCodec(JSONCodec):
+    """A codec using ujson."""
+
+    name = "ujson"
+    module = "ujson"
+
+    def loads(self, s):
+        return self.lib.loads(s)
+
+    def dumps(self, obj, separators=None):
+        # ujson is always compact, and escapes "/" unless told otherwise.
+        return self.lib.dumps(obj, escape_forward_slashes=False)
+
+
+@register
+class SimdjsonCodec(JSONCodec):
+    """A codec decoding with pysimdjson; it encodes with the json module."""
+
+    name = "simdjson"
+    module = "simdjson"
+
+    def loads(self, s):
+        return self.lib.loads(s)
+
+
+# Fastest first.
+preference = ["orjson", "simdjson", "ujson", "json"]
+
+
+def get_codec(name="auto"):
+    """Return a new instance of the named codec.
+
+    If the name is "auto", return the first codec in `preference`
+    whose library can be imported. Raise ImportError if the named
+    codec's library is not installed.
+    """
+    if name == "auto":
+        for name in preference:
+            if codecs[name].available():
+                break
+    return codecs[name]()
+
+
+default_codec = JSONCodec()
+
+
+def set_default_codec(codec):
+    """Set the codec used by objects with no session; a codec or name."""
+    global default_codec
+    if isinstance(codec, six.string_types):
+        codec = get_codec(codec)
+    default_codec = codec
+
+
+def session_codec(session):
+    """Return the JSONCodec of the given session, or the default one."""
+    codec = getattr(session, "json_codec", None)
+    if isinstance(codec, JSONCodec):
+        return codec
+    return default_codec
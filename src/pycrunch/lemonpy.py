@@ -1,6 +1,13 @@
 from __future__ import division
 
+import base64
+import collections
+import hashlib
+import json
 import logging
+import os
+import tempfile
+import threading
 
 import six
 from six.moves import urllib
@@ -70,6 +77,8 @@ class ResponseHandler(object):
         self.session = session
 
     def __call__(self, r, *args, **kwargs):
+        # Tell parsers whether the body is still unread on the socket.
+        r.streamed = kwargs.get("stream", False)
         code = r.status_code
 
         # First, try the specific response status code
@@ -98,8 +107,39 @@ class ResponseHandler(object):
         parser = self.parsers.get(ct)
         r.payload = parser(self.session, r) if parser else None
 
+    def cache_payload(self, r):
+        """Store the body of the given GET Response in session.cache.
+
+        Only complete 200 responses which carry a validator (an ETag or a
+        Last-Modified header) are stored, since nothing else can be
+        revalidated later. Bodies which were parsed as they streamed in,
+        and never held in memory, are not stored either.
+        """
+        cache = self.session.cache
+        if (
+            cache is None
+            or r.status_code != 200
+            or r.request.method != "GET"
+            or r.payload is None
+            or not r._content_consumed
+        ):
+            return
+
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if not (etag or last_modified):
+            return
+
+        cache.set(cache_key(r.request), {
+            "etag": etag,
+            "last_modified": last_modified,
+            "content_type": r.headers.get("Content-Type", ""),
+            "content": r.content,
+        })
+
     def status_2xx(self, r):
         self.parse_payload(r)
+        self.cache_payload(r)
         return r
 
     # status_201 = status_2xx # The caller must look up r.headers["Location"]
@@ -121,6 +161,29 @@ class ResponseHandler(object):
         self.parse_payload(r)
         return r
 
+    def status_304(self, r):
+        # Not Modified: only sent in reply to the conditional headers
+        # which Session.send adds from a cached entry, so reuse it.
+        cache = self.session.cache
+        entry = cache.get(cache_key(r.request)) if cache is not None else None
+        if entry is None:
+            # The entry was evicted while the request was in flight;
+            # repeat it without the validators to get a complete response.
+            request = r.request.copy()
+            request.headers.pop("If-None-Match", None)
+            request.headers.pop("If-Modified-Since", None)
+            return self.session.send(request)
+
+        # Parse the stored body afresh, so that no change to a returned
+        # payload can alter the next one. That is cheaper than copying a
+        # parsed payload, and keeps lazily parsed payloads lazy.
+        r._content = entry["content"]
+        r.headers["Content-Type"] = entry["content_type"]
+        # Parse the stored body, not the (empty) one on the socket.
+        r.streamed = False
+        self.parse_payload(r)
+        return r
+
     def status_4xx(self, r):
         self.parse_payload(r)
         raise ClientError(r)
@@ -130,6 +193,142 @@ class ResponseHandler(object):
         raise ServerError(r)
 
 
+def cache_key(request):
+    """Return the response cache key for the given PreparedRequest."""
+    return (request.url, request.headers.get("Accept", ""))
+
+
+class ResponseCache(object):
+    """Base class for Session response caches.
+
+    Set an instance as Session.cache to have GET responses which carry an
+    ETag or Last-Modified header stored, keyed by (URL, Accept header).
+    Later GETs of the same key are then sent with If-None-Match and/or
+    If-Modified-Since, and a 304 Not Modified reply is answered from the
+    cache, skipping the body transfer; the stored body is parsed again.
+
+    Entries are dicts with "etag", "last_modified", "content_type" and
+    "content" (the raw body) members.
+    """
+
+    def get(self, key):
+        """Return the entry for the given key, or None."""
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(ResponseCache):
+    """An in-memory, least-recently-used ResponseCache.
+
+    The cache is bounded by the total size in bytes of the response bodies
+    it holds.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Re-insert as the most recently used.
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        entry = dict(entry, size=len(entry["content"]))
+        with self._lock:
+            self._pop(key)
+            if entry["size"] > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += entry["size"]
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old["size"]
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class DiskCache(ResponseCache):
+    """A ResponseCache which stores response bodies as files in a directory.
+
+    Entries survive the process, so they can be shared between runs or
+    between the processes of a job.
+
+    Each entry is a JSON file, with the body base64-encoded; nothing read
+    from the directory is ever unpickled or executed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _filename(self, key):
+        digest = hashlib.sha1(("\n".join(key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, digest)
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), "r") as f:
+                entry = json.load(f)
+            if not isinstance(entry, dict) or entry.pop("key", None) != list(key):
+                # A hash collision, or a file not written by this class.
+                return None
+            entry["content"] = base64.b64decode(entry["content"])
+        except (IOError, OSError, ValueError, TypeError, KeyError):
+            return None
+        return entry
+
+    def set(self, key, entry):
+        entry = dict(entry, key=list(key))
+        entry["content"] = base64.b64encode(entry["content"]).decode("ascii")
+        # Write to a temporary file first so readers never see a partial entry.
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        filename = self._filename(key)
+        if os.name == "nt" and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp, filename)
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+
+
 def make_cookie(name, value, domain):
     '''
         Makes a cookie with provided name and value.
@@ -160,6 +359,8 @@ class Session(requests.Session):
         "Accept-Encoding": "gzip",
     }
     handler_class = ResponseHandler
+    cache = None
+    """An optional ResponseCache for GET responses; see ResponseCache."""
 
     def __init__(self):
         super(Session, self).__init__()
@@ -173,6 +374,16 @@ class Session(requests.Session):
 
         self.hooks["response"] = self.handler_class(self)
 
+    def send(self, request, **kwargs):
+        if self.cache is not None and request.method == "GET":
+            entry = self.cache.get(cache_key(request))
+            if entry is not None:
+                if entry.get("etag"):
+                    request.headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    request.headers["If-Modified-Since"] = entry["last_modified"]
+        return super(Session, self).send(request, **kwargs)
+
 
 class URL(str):
     """A subclass of str for URL's. self.absolute = urljoin(self.base, self)."""
@@ -1,31 +1,171 @@
+import collections
+import csv
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
 import six
-from pandas import DataFrame, Categorical, Series, to_datetime
+from pandas import (
+    DataFrame, Categorical, RangeIndex, Series, __version__ as pandas_version,
+    api, concat, isnull, to_datetime
+)
+
+from pycrunch import tables
+from pycrunch.tables import (
+    TablePager, category_codes, float_array, id_array, object_array
+)
+
+_PANDAS_VERSION = tuple(int(n) for n in re.findall(r'\d+', pandas_version)[:2])
+
+# A UTC offset ending a datetime value, such as "Z" or "+02:00".
+_UTC_OFFSET = re.compile(r'T.*(Z|[+-]\d\d:?\d\d)$')
+
+if _PANDAS_VERSION >= (2, 0):
+    # Values may be of different resolutions ("2020-03", "2020-03-01T...").
+    _TO_DATETIME_FORMAT = {'format': 'ISO8601'}
+else:
+    _TO_DATETIME_FORMAT = {}
 
 
 def series_from_variable(col, vardef):
-    """Return the given Crunch column and variable def as a Pandas Series."""
-    col = [None if (isinstance(item, dict) and list(item.keys()) == ['?']) else item
-           for item in col]
+    """Return the given Crunch column and variable def as a Pandas Series.
 
+    Categorical columns are built straight from their category ids, as
+    the codes of an ordered Categorical of the non-missing categories;
+    missing cells and missing categories are NaN. Numeric columns
+    become float64 Series, with missing cells as NaN, and datetime columns
+    datetime64[ns] Series, with missing cells as NaT; if any value has a
+    UTC offset, the Series is tz-aware, in UTC.
+    """
     if vardef.type == 'categorical':
-        cats = dict((c['id'], c['name']) for c in vardef['categories'])
-        col = [None if val is None else cats[val] for val in col]
-        return Categorical(
-            col,
-            categories=[cat['name'] for cat in vardef['categories']
-                        if not cat['missing']],
+        categories = [cat for cat in vardef['categories'] if not cat['missing']]
+        codes = category_codes(id_array(col), [cat['id'] for cat in categories])
+        return Categorical.from_codes(
+            codes,
+            categories=[cat['name'] for cat in categories],
             ordered=True
         )
+    elif vardef.type == 'numeric':
+        return Series(float_array(col))
     elif vardef.type == 'datetime':
-        return to_datetime(Series(col))
+        values = object_array(col)
+        if any(
+            isinstance(v, six.string_types) and _UTC_OFFSET.search(v)
+            for v in values
+        ):
+            return to_datetime(
+                Series(values), utc=True, **_TO_DATETIME_FORMAT
+            ).astype('datetime64[ns, UTC]')
+        # NumPy parses ISO-8601 values of any resolution ("2020-03"...).
+        return Series(np.array(values, dtype='datetime64[ns]'))
 
-    return Series(col)
+    return Series(object_array(col))
+
+
+def missing_codes_from_variable(col, series):
+    """Return the missing codes of the given Crunch column as an int array.
+
+    The `series` is that returned by series_from_variable for the column:
+    its null cells are the missing ones. See tables.missing_codes.
+    """
+    return tables.missing_codes(col, isnull(series))
+
+
+def _convert_columns(columns, metadata, missing_codes=False):
+    """Return ({alias: Series}, {alias: missing codes}) for the given columns.
+
+    The `columns` are raw Crunch columns keyed by variable id, as in the
+    "data" of a crunch:table, and `metadata` their variable definitions.
+    """
+    data = {}
+    codes = {}
+    for varid, col in six.iteritems(columns):
+        vardef = metadata[varid]
+        data[vardef.alias] = series_from_variable(col, vardef)
+        if missing_codes:
+            codes[vardef.alias] = missing_codes_from_variable(
+                col, data[vardef.alias]
+            )
+    return data, codes
 
 
 ROWCHUNKSIZE = 1000
+PAGE_WINDOW = 4
+
+
+def _cache_entry(df, metadata, codes):
+    """Return the (arrays, info) to store in a TableCache for the given df."""
+    arrays = {}
+    columns = []
+    for alias in df.columns:
+        series = df[alias]
+        column = {'alias': alias}
+        if hasattr(series, 'cat'):
+            column['categories'] = list(series.cat.categories)
+            arrays['values:' + alias] = series.cat.codes.values
+        else:
+            arrays['values:' + alias] = series.values
+        if codes:
+            arrays['missing:' + alias] = codes[alias]
+        columns.append(column)
+    info = {
+        'columns': columns,
+        'metadata': metadata,
+        'missing_codes': bool(codes),
+    }
+    return arrays, info
+
 
+def _dataframe_from_cache(arrays, info, variables, missing_codes):
+    """Return the DataFrame for the given TableCache entry (see dataframe)."""
+    columns = collections.OrderedDict(
+        (column['alias'], column) for column in info['columns']
+    )
+    if variables is None:
+        variables = list(columns)
+    for variable in variables:
+        if variable not in columns:
+            raise KeyError('No variable with alias: %s' % variable)
+
+    data = collections.OrderedDict()
+    for alias in variables:
+        values = arrays['values:' + alias]
+        if 'categories' in columns[alias]:
+            data[alias] = Categorical.from_codes(
+                values, categories=columns[alias]['categories'], ordered=True
+            )
+        else:
+            data[alias] = Series(values, copy=False)
+    # Keep each column in its own (memory-mapped) block.
+    df = DataFrame(data, copy=False)
+
+    aliases = set(variables)
+    df.metadata = dict(
+        (varid, vardef) for varid, vardef in six.iteritems(info['metadata'])
+        if vardef['alias'] in aliases
+    )
+    if missing_codes:
+        df.missing_codes = dict(
+            (alias, arrays['missing:' + alias]) for alias in variables
+        )
+    return df
 
-def dataframe(dataset, variables=None):
+
+def _fetch_table(pager):
+    """Return the ({id: column}, metadata) of all the pages of a TablePager."""
+    all_data = {}
+    for t in pager:
+        for name, value in six.iteritems(t.data):
+            if name not in all_data:
+                all_data[name] = []
+            all_data[name].extend(value)
+    return all_data, t.metadata
+
+
+def dataframe(dataset, variables=None, chunksize=ROWCHUNKSIZE,
+              window=PAGE_WINDOW, adaptive=True, missing_codes=False,
+              cache=None):
     """Return a Pandas DataFrame for the given Crunch Dataset Entity object.
     Retrieve a dataset using pycrunch.get_dataset("dataset name or id").
 
@@ -34,54 +174,299 @@ def dataframe(dataset, variables=None):
     variables will be included in the DataFrame. If omitted or None,
     all variables are included.
 
+    Selected variables are fetched one by one, from their "values" view,
+    with up to 'window' variables downloading concurrently.
+
+    All variables are fetched from the table fragment in pages of rows,
+    starting at 'chunksize' rows, with up to 'window' pages requested
+    concurrently. Unless 'adaptive' is False, the page size then adapts
+    to the observed response times; see tables.TablePager.
+
     The returned DataFrame has an extra "metadata" attribute on it:
     a dict of Crunch variable definitions for each Series (keyed by id).
+
+    If 'missing_codes' is True, it also has a "missing_codes" attribute:
+    a dict of the missing code of each cell of each Series (keyed by alias),
+    as compact int arrays; see missing_codes_from_variable. That avoids
+    fetching the raw values again to tell missing reasons apart.
+
+    If a tablecache.TableCache is given as 'cache', the whole table of the
+    dataset is stored there once fetched, and loaded from there instead of
+    the server (memory-mapped) for as long as the dataset is unchanged,
+    whether or not 'variables' are selected.
     """
+    if isinstance(variables, six.string_types):
+        variables = [variables]
+
+    key = None
+    if cache is not None:
+        key = cache.key(dataset)
+        cached = cache.get(key)
+        if cached is not None:
+            arrays, info = cached
+            if info['missing_codes'] or not missing_codes:
+                return _dataframe_from_cache(
+                    arrays, info, variables, missing_codes
+                )
+
     data = {}
+    codes = {}
 
     if variables is None:
-        numrows = dataset.summary.value.unweighted.total
-        seenrows = 0
-        all_data = {}
-        while True:
-            t = dataset.session.get(
-                "%s?offset=%d&limit=%d" %
-                (dataset.fragments['table'], seenrows, ROWCHUNKSIZE)
-            ).payload
-            for name, value in six.iteritems(t.data):
-                if name not in all_data:
-                    all_data[name] = []
-                all_data[name].extend(value)
-            seenrows += ROWCHUNKSIZE
-            if seenrows > numrows:
-                break
-
-        metadata = t.metadata
+        all_data, metadata = _fetch_table(TablePager(
+            dataset, chunksize=chunksize, window=window, adaptive=adaptive
+        ))
 
         # Convert to Series
-        for varid, col in six.iteritems(all_data):
-            vardef = t.metadata[varid]
-            data[vardef.alias] = series_from_variable(col, vardef)
+        data, codes = _convert_columns(all_data, metadata, missing_codes)
     else:
-        metadata = {}
-        if not isinstance(variables, list):
-            variables = list(variables)
+        variables = list(variables)
 
-        var_catalog = dataset.variables
+        tuples = dataset.variables.by('alias')
         for variable in variables:
-            try:
-                t = var_catalog.by('alias')[variable].entity
-            except KeyError:
+            if variable not in tuples:
                 raise KeyError('No variable with alias: %s' % variable)
-            vardef = t.body
-            value = dataset.session.get(t.views['values']).payload['value']
-            data[vardef.alias] = series_from_variable(value, vardef)
-            metadata[vardef.id] = vardef
+
+        def fetch(variable):
+            t = tuples[variable].entity
+            value = dataset.session.get(
+                t.views['values'], stream=True
+            ).payload['value']
+            return t.body, value
+
+        # Convert each variable as it arrives, while the others download.
+        metadata = {}
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            futures = dict(
+                (executor.submit(fetch, variable), variable)
+                for variable in variables
+            )
+            for future in as_completed(futures):
+                vardef, value = future.result()
+                alias = futures[future]
+                data[alias] = series_from_variable(value, vardef)
+                if missing_codes:
+                    codes[alias] = missing_codes_from_variable(value, data[alias])
+                metadata[vardef.id] = vardef
+        data = collections.OrderedDict(
+            (variable, data[variable]) for variable in variables
+        )
 
     df = DataFrame(data)
 
     # Attach the crunch:table metadata object to the df
     # so consumers can have both.
     df.metadata = metadata
+    if missing_codes:
+        df.missing_codes = codes
+    if key is not None and variables is None:
+        cache.set(key, *_cache_entry(df, metadata, codes))
 
     return df
+
+
+def iter_dataframes(dataset, variables=None, chunksize=ROWCHUNKSIZE,
+                    window=PAGE_WINDOW, missing_codes=False):
+    """Yield the rows of the given Crunch Dataset as a series of DataFrames.
+
+    Each DataFrame holds one page of (at most) 'chunksize' rows of the
+    dataset's table fragment, in order, indexed by row number; only
+    'window' pages are in memory (or in flight) at once, so a dataset of
+    any size can be streamed elsewhere with flat memory use. Categorical
+    Series have the same categories in every DataFrame, so they concatenate.
+
+    If the 'variables' argument is given and not None, it should be a
+    single variable alias, or a list of such, in which case only those
+    variables will be included in the DataFrames, in that order.
+
+    Each DataFrame has the "metadata" (and, if 'missing_codes' is True,
+    the "missing_codes") attribute described in dataframe().
+    """
+    if isinstance(variables, six.string_types):
+        variables = [variables]
+
+    offset = 0
+    pager = TablePager(dataset, chunksize=chunksize, window=window)
+    for t in pager:
+        metadata = t.metadata
+        columns = t.data
+        if variables is not None:
+            ids = dict(
+                (vardef.alias, varid) for varid, vardef in six.iteritems(metadata)
+            )
+            missing = [alias for alias in variables if alias not in ids]
+            if missing:
+                raise KeyError('No variable with alias: %s' % missing[0])
+            metadata = dict((ids[alias], metadata[ids[alias]]) for alias in variables)
+            columns = dict((varid, columns[varid]) for varid in metadata)
+
+        data, codes = _convert_columns(columns, metadata, missing_codes)
+        df = DataFrame(data, columns=variables)
+        df.index = RangeIndex(offset, offset + len(df))
+        offset += len(df)
+
+        df.metadata = metadata
+        if missing_codes:
+            df.missing_codes = codes
+        yield df
+
+
+def sync_dataframe(dataset, cache, chunksize=ROWCHUNKSIZE, window=PAGE_WINDOW,
+                   adaptive=True, missing_codes=False):
+    """Return a DataFrame of the given Crunch Dataset, synced through 'cache'.
+
+    This is dataframe(dataset, cache=cache) for a dataset which grows by
+    appended batches (see importing.Importer): when the dataset has changed
+    since it was cached, only the rows appended since are fetched, from
+    the table fragment, and merged with the cached ones.
+
+    To that end, the cache also records the list of the dataset's batches.
+    The cached rows are reused only if none of those batches was deleted,
+    at least one was added, and the variable definitions are unchanged;
+    otherwise the whole table is fetched again. Edits to the values of
+    existing rows made together with an append are NOT detected: use
+    dataframe() for datasets whose rows are edited.
+    """
+    key = cache.key(dataset)
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            arrays, info = cached
+            if info['missing_codes'] or not missing_codes:
+                return _dataframe_from_cache(arrays, info, None, missing_codes)
+
+    pager_kwargs = dict(chunksize=chunksize, window=window, adaptive=adaptive)
+    batches = sorted(six.text_type(url) for url in dataset.batches.index)
+
+    df = None
+    previous = None if key is None else cache.find(key[0])
+    if previous is not None:
+        arrays, info = cache.get(previous)
+        if (
+            info.get('batches') is not None
+            and set(info['batches']) < set(batches)
+            and (info['missing_codes'] or not missing_codes)
+        ):
+            df = _append_rows(dataset, arrays, info, missing_codes, pager_kwargs)
+
+    if df is None:
+        df = dataframe(dataset, missing_codes=missing_codes, **pager_kwargs)
+
+    if key is not None:
+        arrays, info = _cache_entry(
+            df, df.metadata, getattr(df, 'missing_codes', None)
+        )
+        info['batches'] = batches
+        cache.set(key, arrays, info)
+
+    return df
+
+
+def _append_rows(dataset, arrays, info, missing_codes, pager_kwargs):
+    """Return the cached DataFrame plus the rows of the dataset after it.
+
+    Return None if the variable definitions have changed since.
+    """
+    cached = _dataframe_from_cache(arrays, info, None, missing_codes)
+    pager = TablePager(dataset, offset=len(cached), **pager_kwargs)
+    all_data, metadata = _fetch_table(pager)
+    if metadata != info['metadata']:
+        return None
+
+    data, codes = _convert_columns(all_data, metadata, missing_codes)
+    df = concat([cached, DataFrame(data)[cached.columns]], ignore_index=True)
+    df.metadata = metadata
+    if missing_codes:
+        df.missing_codes = dict(
+            (alias, np.concatenate([cached.missing_codes[alias], codes[alias]]))
+            for alias in cached.columns
+        )
+    return df
+
+
+# How many rows of a DataFrame to encode as CSV at a time.
+CSV_ROWCHUNKSIZE = 10000
+# Written by DataFrame.to_csv for missing cells, and then removed, since
+# it cannot write them as empty, unquoted cells.
+_NA_SENTINEL = "__CSV_SENTINEL_NA__"
+# DataFrame.to_csv's line_terminator argument was renamed in pandas 1.5.
+if _PANDAS_VERSION >= (1, 5):
+    _TO_CSV_LINETERMINATOR = {'lineterminator': '\n'}
+else:
+    _TO_CSV_LINETERMINATOR = {'line_terminator': '\n'}
+
+
+def category_ids(series, vardef):
+    """Return the given Series of category names as an Int64 array of ids.
+
+    The ids are those of the categories of the given Crunch categorical
+    variable definition. Integer Series are taken to hold ids already.
+    Missing cells are <NA>; a name which is not that of any category
+    raises ValueError.
+
+    This requires pandas 0.24+, for its nullable integer arrays.
+    """
+    from pandas import array
+
+    if api.types.is_integer_dtype(series.dtype):
+        return array(series, dtype='Int64')
+
+    ids = dict((cat['name'], cat['id']) for cat in vardef['categories'])
+    if isinstance(series.dtype, api.types.CategoricalDtype):
+        # Map each category once, then take by code.
+        names = series.cat.categories
+        codes = series.cat.codes.values
+        # Only the categories in use must be known.
+        used = np.bincount(codes[codes >= 0], minlength=len(names)) > 0
+        unknown = [
+            name for name, in_use in zip(names, used)
+            if in_use and name not in ids
+        ]
+        mapped = array([ids.get(name) for name in names], dtype='Int64')
+        result = mapped.take(codes, allow_fill=True)
+    else:
+        result = array(series.map(ids), dtype='Int64')
+        unknown = series[result.isna() & series.notnull().values].unique()
+    if len(unknown):
+        raise ValueError(
+            "Unknown categories for variable %s: %s"
+            % (vardef['alias'], ", ".join(str(name) for name in unknown))
+        )
+    return result
+
+
+def iter_dataframe_csv_chunks(df, metadata=None, chunksize=CSV_ROWCHUNKSIZE):
+    """Yield the given DataFrame as Crunch CSV, in chunks of UTF-8 bytes.
+
+    The header holds the column names, which should be variable aliases.
+    Each chunk is encoded by DataFrame.to_csv, for 'chunksize' rows at a
+    time: strings are quoted and numbers not, datetimes are ISO-8601,
+    and missing cells are empty, which Crunch interprets as {"?": -1}.
+    The columns of categorical variables (per the given 'metadata' of
+    Crunch variable definitions, as in dataframe()) are converted to
+    category ids; see category_ids. That is done before this returns, so
+    that any ValueError is raised before the first chunk is encoded.
+    """
+    by_alias = dict(
+        (vardef['alias'], vardef) for vardef in six.itervalues(metadata or {})
+    )
+    columns = collections.OrderedDict()
+    for alias in df.columns:
+        vardef = by_alias.get(alias)
+        if vardef is not None and vardef['type'] == 'categorical':
+            columns[alias] = category_ids(df[alias], vardef)
+        else:
+            columns[alias] = df[alias].values
+    return _csv_chunks(DataFrame(columns, copy=False), chunksize)
+
+
+def _csv_chunks(df, chunksize):
+    quoted_na = '"%s"' % _NA_SENTINEL
+    for start in six.moves.range(0, max(len(df), 1), chunksize):
+        out = io.StringIO()
+        df.iloc[start:start + chunksize].to_csv(
+            out, header=(start == 0), index=False,
+            quoting=csv.QUOTE_NONNUMERIC, na_rep=_NA_SENTINEL,
+            date_format='%Y-%m-%dT%H:%M:%S.%f', **_TO_CSV_LINETERMINATOR
+        )
+        yield out.getvalue().replace(quoted_na, '').encode('utf-8')
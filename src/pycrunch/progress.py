@@ -5,11 +5,41 @@ DEFAULT_PROGRESS_TIMEOUT = 30
 DEFAULT_PROGRESS_INTERVAL = 0.5
 
 
+def backoff_intervals(interval, backoff=1.0, max_interval=None):
+    """Yield the successive waits of a polling loop, forever.
+
+    The first wait is 'interval' seconds, and each one after that is
+    'backoff' times the previous one, up to 'max_interval' (if not None).
+    """
+    while True:
+        yield interval
+        interval *= backoff
+        if max_interval is not None and interval > max_interval:
+            interval = max_interval
+
+
+def poll_intervals(tracker):
+    """Yield the successive waits between progress polls for the given tracker."""
+    return backoff_intervals(
+        tracker.interval,
+        getattr(tracker, "backoff", 1.0),
+        getattr(tracker, "max_interval", None),
+    )
+
+
 class _ProgressTrackingConfig(object):
-    """Base class for all progress tracking configurations."""
-    def __init__(self, timeout, interval):
+    """Base class for all progress tracking configurations.
+
+    Progress is polled every `interval` seconds, unless `backoff` is given:
+    then polls start `interval` seconds apart, and the wait grows by that
+    factor after each poll, up to `max_interval` seconds. Short tasks then
+    complete with little delay, while long ones are polled less often.
+    """
+    def __init__(self, timeout, interval, backoff=1.0, max_interval=None):
         self.timeout = timeout
         self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
 
     def start_progress(self):
         raise NotImplementedError
@@ -25,8 +55,11 @@ class DefaultProgressTracking(_ProgressTrackingConfig):
     does not report progress in any way.
     """
     def __init__(self, timeout=DEFAULT_PROGRESS_TIMEOUT,
-                 interval=DEFAULT_PROGRESS_INTERVAL):
-        super(DefaultProgressTracking, self).__init__(timeout, interval)
+                 interval=DEFAULT_PROGRESS_INTERVAL, backoff=1.0,
+                 max_interval=None):
+        super(DefaultProgressTracking, self).__init__(
+            timeout, interval, backoff, max_interval
+        )
 
     def start_progress(self):
         return None
@@ -35,6 +68,19 @@ class DefaultProgressTracking(_ProgressTrackingConfig):
         pass
 
 
+class AdaptiveProgressTracking(DefaultProgressTracking):
+    """Progress tracking configuration with adaptive backoff.
+
+    Waits for 30 seconds, polls after 0.1 seconds, then 1.5 times
+    less often after each poll, up to every 5 seconds.
+    """
+    def __init__(self, timeout=DEFAULT_PROGRESS_TIMEOUT, interval=0.1,
+                 backoff=1.5, max_interval=5.0):
+        super(AdaptiveProgressTracking, self).__init__(
+            timeout, interval, backoff, max_interval
+        )
+
+
 class SimpleTextBarProgressTracking(DefaultProgressTracking):
     """Progress tracking config that displays a progress bar on stdout.
 
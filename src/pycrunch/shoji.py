@@ -4,18 +4,24 @@ See https://bitbucket.org/fumanchu/shoji/src/tip/spec.txt?at=default
 for the latest Shoji specification.
 """
 
-import json
-
+import concurrent.futures
+import heapq
+import itertools
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from six.moves import urllib
 
 import six
 
-from pycrunch import elements
+from pycrunch import elements, jsoncodec, progress
 from pycrunch.lemonpy import URL, ClientError, ServerError
 
 # Shoji helper functions."""
 
+# requests pools 10 connections per host by default; stay within that.
+DEFAULT_MAX_WORKERS = 8
+
 
 def as_catalog(x, **kwargs):  # -> dict:
     """Format and return `x` as a shoji catalog dictionary"""
@@ -59,6 +65,7 @@ class Tuple(elements.JSONObject):
 
     def copy(self):
         """Return a (shallow) copy of self."""
+        self._parse_members()
         return self.__class__(self.session, self.entity_url, **self)
 
     def fetch(self, *args, **kwargs):
@@ -142,9 +149,38 @@ class Index(elements.JSONObject):
         for k, v in mapping.items():
             self[k] = v  # To go through __setitem__'s logic
 
+    def prefetch(self, keys=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Fetch the Entities of many Tuples concurrently.
+
+        Each Tuple for the given keys (default: all of them) whose .entity
+        has not been fetched yet is fetched by a pool of `max_workers`
+        threads, and the result is cached as its .entity. A failure to
+        fetch one Entity does not abort the others; instead, a dict of
+        {entity_url: exception} for each failed Tuple is returned.
+        """
+        if keys is None:
+            tuples = six.itervalues(self)
+        else:
+            tuples = (self[key] for key in keys)
+        tuples = [tupl for tupl in tuples if tupl is not None and tupl._entity is None]
+
+        failures = {}
+        if not tuples:
+            return failures
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict((executor.submit(tupl.fetch), tupl) for tupl in tuples)
+            for future in concurrent.futures.as_completed(futures):
+                tupl = futures[future]
+                try:
+                    tupl._entity = future.result()
+                except Exception as exc:
+                    failures[tupl.entity_url] = exc
+        return failures
+
 
 class CreateMixin(object):
-    def create(self, entity=None, progress_tracker=None):
+    def create(self, entity=None, progress_tracker=None, wait=True):
         """POST the given Entity to this catalog to create a new resource.
 
         The 'entity' arg may be a complete shoji.Entity, in which case
@@ -163,7 +199,15 @@ class CreateMixin(object):
         configuration provided by session.
         See ``Entity.wait_progress`` for details.
 
-        An entity is returned.
+        An entity is returned. If `wait` is False, a PendingEntity is
+        returned instead, as soon as the resource is created: a Future of
+        the entity, which completes when its progress does. The progress
+        of all such entities is tracked by a single background thread
+        (see ProgressMultiplexer), so that many of them can be created
+        at once and then waited for together:
+
+            pending = [ds.variables.create(var, wait=False) for var in defs]
+            variables = shoji.wait_all(pending)
         """
         if entity is None:
             entity = Entity(self.session)
@@ -178,7 +222,11 @@ class CreateMixin(object):
                 # We got a See Other response, this means the resource
                 # was not created because an equivalent one is already available.
                 entity["self"] = URL(seeother[-1].headers["Location"], "")
+                if not wait:
+                    return PendingEntity.completed(entity)
                 return entity
+        if not wait:
+            return self._pending_progress(entity, response, progress_tracker)
         return self._wait_for_progress(entity, response, progress_tracker)
 
     def _wait_for_progress(self, entity, r, progress_tracker):
@@ -195,6 +243,21 @@ class CreateMixin(object):
                 entity.wait_progress(r, progress_tracker)
         return entity
 
+    def _pending_progress(self, entity, r, progress_tracker):
+        entity["self"] = URL(r.headers["Location"], "")
+        if r.status_code == 202:
+            try:
+                progress_url = r.payload["value"]
+            except Exception:
+                # Not a progress API: the incomplete entity is the result.
+                pass
+            else:
+                pending = PendingEntity(entity, progress_url)
+                return progress_multiplexer.add(
+                    r, self.session, progress_tracker, entity, future=pending
+                )
+        return PendingEntity.completed(entity)
+
     def by(self, attr):
         """Return the Tuples of self.index indexed by the given 'attr' instead.
 
@@ -224,6 +287,25 @@ class Catalog(elements.Document, CreateMixin):
                 members["index"] = Index(session, members["self"], **members["index"])
         super(Catalog, __this__).__init__(session, **members)
 
+    def fetch_all(self, keys=None, max_workers=DEFAULT_MAX_WORKERS):
+        """Fetch the Entities of many index Tuples concurrently.
+
+        Return a ({entity_url: Entity}, {entity_url: exception}) pair for
+        the given index keys (default: the whole index). See Index.prefetch.
+        """
+        index = self.index
+        failures = index.prefetch(keys, max_workers=max_workers)
+        if keys is None:
+            tuples = six.itervalues(index)
+        else:
+            tuples = (index[key] for key in keys)
+        entities = dict(
+            (tupl.entity_url, tupl._entity)
+            for tupl in tuples
+            if tupl is not None and tupl._entity is not None
+        )
+        return entities, failures
+
     def add(self, entity_url, attrs=None, **kwargs):
         """Add the given entity, plus any spurious index attributes (ICK), to self.
 
@@ -231,7 +313,9 @@ class Catalog(elements.Document, CreateMixin):
         where non-tuples are included in a Catalog.index.
         """
         kwargs[entity_url] = attrs or {}
-        p = json.dumps(dict(element="shoji:catalog", self=self.self, index=kwargs))
+        p = jsoncodec.session_codec(self.session).dumps(
+            dict(element="shoji:catalog", self=self.self, index=kwargs)
+        )
         return self.patch(data=p).payload
 
     def edit(self, entity_url, **attrs):
@@ -302,28 +386,212 @@ def wait_progress(r, session, progress_tracker=None, entity=None):
     `pycrunch.progress.SimpleTextBarProgressTracking` for documentation
     regarding progress trackers.
     """
-    progress_url = r.payload["value"]
-
-    if progress_tracker is None:
-        progress_tracker = session.progress_tracking
-
-    timeout = progress_tracker.timeout
-    progress_state = progress_tracker.start_progress()
-    begin = time.time()
-    while timeout is None or time.time() - begin < timeout:
-        prog_r = session.get(progress_url)
-        progress = prog_r.payload["value"]
-        progress_tracker.on_progress(progress_state, progress)
-        if progress["progress"] == -1:
-            # Completed due to error
-            raise TaskError(progress["message"])
-        elif progress["progress"] == 100:
+    wait = ProgressWait(r, session, progress_tracker, entity)
+    while not wait.expired():
+        delay = wait.poll()
+        if delay is None:
             # Completed with success
-            break
-        time.sleep(progress_tracker.interval)
-    else:
-        # Loop completed due to timeout
-        raise TaskProgressTimeoutError(entity, r, timeout=timeout)
+            return
+        time.sleep(delay)
+    # Loop completed due to timeout
+    raise wait.timeout_error()
+
+
+def retry_after(r):
+    """Return the seconds of the Retry-After header of response r, or None.
+
+    Only the delay-seconds form of the header is supported.
+    """
+    value = r.headers.get("Retry-After") if r.headers else None
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ProgressWait(object):
+    """The state of a wait for the progress URL of a 202 response.
+
+    Used by wait_progress, and by ProgressMultiplexer for many at once.
+    Polls are spaced by the intervals of the progress tracker (see
+    progress.poll_intervals), or by the Retry-After header of the last
+    progress response, if the server sent one.
+    """
+
+    def __init__(self, r, session, progress_tracker=None, entity=None):
+        self.response = r
+        self.session = session
+        self.entity = entity
+        self.progress_url = r.payload["value"]
+        if progress_tracker is None:
+            progress_tracker = session.progress_tracking
+        self.progress_tracker = progress_tracker
+        self.timeout = progress_tracker.timeout
+        self.state = progress_tracker.start_progress()
+        self.intervals = progress.poll_intervals(progress_tracker)
+        self.begin = time.time()
+
+    def expired(self):
+        return self.timeout is not None and time.time() - self.begin >= self.timeout
+
+    def timeout_error(self):
+        return TaskProgressTimeoutError(self.entity, self.response, timeout=self.timeout)
+
+    def poll(self):
+        """GET the progress once.
+
+        Return None if the task completed, or else the seconds to wait
+        before the next poll. Raise TaskError if the task failed.
+        """
+        prog_r = self.session.get(self.progress_url)
+        value = prog_r.payload["value"]
+        self.progress_tracker.on_progress(self.state, value)
+        if value["progress"] == -1:
+            # Completed due to error
+            raise TaskError(value["message"])
+        elif value["progress"] == 100:
+            return None
+        delay = next(self.intervals)
+        server_delay = retry_after(prog_r)
+        if server_delay is not None:
+            delay = server_delay
+        return delay
+
+
+class ProgressMultiplexer(object):
+    """Wait for the progress of many tasks from a single thread.
+
+    Each call to add() returns a concurrent.futures.Future, which the
+    thread resolves when that task completes: with the given entity (if
+    any) as its result, or with TaskError or TaskProgressTimeoutError as
+    its exception. The progress URLs are polled one at a time, each on its
+    own schedule (see ProgressWait); the thread runs only while there are
+    tasks to wait for.
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, r, session, progress_tracker=None, entity=None, future=None):
+        """Return a Future for the progress of the given 202 response.
+
+        That is the given `future`, if any: a new, pending Future.
+        """
+        if future is None:
+            future = Future()
+        wait = ProgressWait(r, session, progress_tracker, entity)
+        with self._cond:
+            self._push(time.time(), wait, future)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return future
+
+    def _push(self, when, wait, future):
+        heapq.heappush(self._queue, (when, next(self._counter), wait, future))
+        self._cond.notify()
+
+    def _run(self):
+        try:
+            self._serve()
+        finally:
+            with self._cond:
+                # Should it die, the next add() starts another.
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _serve(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._queue:
+                        self._thread = None
+                        return
+                    when = self._queue[0][0]
+                    now = time.time()
+                    if when <= now:
+                        break
+                    self._cond.wait(when - now)
+                when, count, wait, future = heapq.heappop(self._queue)
+
+            if future.cancelled():
+                continue
+            try:
+                if wait.expired():
+                    raise wait.timeout_error()
+                delay = wait.poll()
+            except Exception as exc:
+                # The future may have been cancelled during the poll.
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(exc)
+                continue
+            if delay is None:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(wait.entity)
+            else:
+                with self._cond:
+                    self._push(time.time() + delay, wait, future)
+
+
+progress_multiplexer = ProgressMultiplexer()
+"""A default ProgressMultiplexer."""
+
+
+class PendingEntity(Future):
+    """A Future of an Entity being created; see CreateMixin.create(wait=False).
+
+    Its .entity is the new Entity, whose "self" is already known, and its
+    .progress_url that of the task creating it (None if the entity was
+    complete as soon as created). result() returns the entity once the
+    task completes, and raises TaskError if the task failed or
+    TaskProgressTimeoutError if it did not complete in time. Being a
+    concurrent.futures.Future, it can also be polled with done(), given
+    callbacks, or, in a coroutine, awaited.
+    """
+
+    def __init__(self, entity, progress_url=None):
+        super(PendingEntity, self).__init__()
+        self.entity = entity
+        self.progress_url = progress_url
+
+    @classmethod
+    def completed(cls, entity):
+        """Return a PendingEntity which is already resolved to the given entity."""
+        pending = cls(entity)
+        pending.set_result(entity)
+        return pending
+
+    def __await__(self):
+        import asyncio
+        return asyncio.wrap_future(self).__await__()
+
+
+def wait_all(pending, timeout=None):
+    """Return the results of the given futures (e.g. PendingEntities), in order.
+
+    Wait for all of them to complete, for up to `timeout` seconds in all
+    (concurrent.futures.TimeoutError otherwise); the first exception of any
+    of them, in order, is raised.
+    """
+    pending = list(pending)
+    done, not_done = concurrent.futures.wait(pending, timeout=timeout)
+    if not_done:
+        raise concurrent.futures.TimeoutError(
+            "%d of %d tasks did not complete" % (len(not_done), len(pending))
+        )
+    return [future.result() for future in pending]
+
+
+def as_completed(pending, timeout=None):
+    """Yield the given futures (e.g. PendingEntities) as they complete.
+
+    See concurrent.futures.as_completed.
+    """
+    return concurrent.futures.as_completed(pending, timeout=timeout)
 
 
 class View(elements.Document):
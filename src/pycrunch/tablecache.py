@@ -0,0 +1,169 @@
+"""An on-disk, memory-mapped cache of the columns of dataset tables.
+
+Each cached table is a directory of NumPy .npy files, one per array,
+plus an "info.json" file of whatever JSON the caller stores with them:
+
+    <path>/<dataset id>/<version>/info.json
+    <path>/<dataset id>/<version>/0.npy
+    <path>/<dataset id>/<version>/1.json
+    ...
+
+The version is a digest of the dataset entity's modification info, as
+read afresh from the server, so that a dataset which has changed in any
+way since it was cached is a cache miss; the stale versions of a dataset
+are deleted as soon as a new one is stored. Arrays are opened with
+copy-on-write memory mapping, so that loading a cached table reads next
+to nothing until its values are actually used, and writing to them
+changes only the loaded copy. Arrays of Python objects (e.g. text) are
+stored as JSON lists, never pickled, since the cache directory may be
+shared; they cannot be memory-mapped, and are loaded in full instead.
+
+pandaslib.dataframe consults such a cache when given one:
+
+    >>> cache = TableCache(os.path.expanduser("~/.cache/pycrunch/tables"))
+    >>> df = pandaslib.dataframe(dataset, cache=cache)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from pycrunch.elements import JSONObject
+
+# The members of a dataset entity's body which change with its data.
+VERSION_ATTRIBUTES = ("modification_time", "size")
+
+
+def dataset_version(body):
+    """Return a version string for the given dataset entity body, or None.
+
+    Return None if the body has no modification_time: without one, there
+    is no telling whether a cached copy of the dataset is stale.
+    """
+    if body.get("modification_time") is None:
+        return None
+    info = dict((attr, body.get(attr)) for attr in VERSION_ATTRIBUTES)
+    return hashlib.sha1(
+        json.dumps(info, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class TableCache(object):
+    """A directory of cached tables, keyed by dataset id and version."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, dataset):
+        """Return the (id, version) cache key of the given dataset, or None.
+
+        The dataset entity is fetched again for its current modification
+        info; None means the dataset cannot be cached (see dataset_version).
+        """
+        body = dataset.session.get(dataset.self).payload.body
+        version = dataset_version(body)
+        if version is None:
+            return None
+        return body.id, version
+
+    def _dir(self, key):
+        return os.path.join(self.path, *key)
+
+    def find(self, dataset_id):
+        """Return the key of the version stored for the given dataset id, or None.
+
+        That is whatever version was stored last, current or not.
+        """
+        try:
+            names = os.listdir(os.path.join(self.path, dataset_id))
+        except OSError:
+            return None
+        for name in names:
+            if not name.startswith(".tmp-"):
+                return dataset_id, name
+        return None
+
+    def get(self, key):
+        """Return the (arrays, info) stored under the given key, or None.
+
+        The arrays are a dict of {name: ndarray}, memory-mapped copy-on-write.
+        """
+        if key is None:
+            return None
+        dirname = self._dir(key)
+        try:
+            with open(os.path.join(dirname, "info.json")) as f:
+                stored = json.load(f, object_pairs_hook=JSONObject)
+        except (IOError, OSError, ValueError):
+            return None
+
+        arrays = {}
+        try:
+            for name, filename in stored["files"].items():
+                filename = os.path.join(dirname, filename)
+                if filename.endswith(".json"):
+                    with open(filename) as f:
+                        values = json.load(f)
+                    arrays[name] = np.empty(len(values), dtype=object)
+                    arrays[name][:] = values
+                else:
+                    arrays[name] = np.load(filename, mmap_mode="c")
+        except (IOError, OSError, ValueError):
+            return None
+        return arrays, stored["info"]
+
+    def set(self, key, arrays, info):
+        """Store the given {name: ndarray} and JSON info under the given key.
+
+        The entry is written to a temporary directory first, and renamed
+        into place when complete; other versions of the dataset are removed.
+        """
+        if key is None:
+            return
+        dataset_id, version = key
+        parent = os.path.join(self.path, dataset_id)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        tmpdir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        try:
+            files = {}
+            for i, (name, arr) in enumerate(arrays.items()):
+                arr = np.asarray(arr)
+                if arr.dtype == object:
+                    files[name] = "%d.json" % i
+                    with open(os.path.join(tmpdir, files[name]), "w") as f:
+                        json.dump(arr.tolist(), f)
+                else:
+                    files[name] = "%d.npy" % i
+                    np.save(os.path.join(tmpdir, files[name]), arr,
+                            allow_pickle=False)
+            with open(os.path.join(tmpdir, "info.json"), "w") as f:
+                json.dump({"files": files, "info": info}, f)
+        except Exception:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmpdir, os.path.join(parent, version))
+        except OSError:
+            # Most likely stored concurrently under the same version.
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        for name in os.listdir(parent):
+            if name != version and not name.startswith(".tmp-"):
+                shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+    def delete(self, dataset_id):
+        """Remove all cached versions of the given dataset id."""
+        shutil.rmtree(os.path.join(self.path, dataset_id), ignore_errors=True)
+
+    def clear(self):
+        """Remove all cached tables."""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
@@ -0,0 +1,180 @@
+"""Helpers for reading the rows of a dataset's crunch:table fragment.
+
+The table fragment returns the data of a dataset a page of rows at a time,
+via its "offset" and "limit" query parameters. TablePager requests those
+pages concurrently and hands them back in row order.
+
+Each page holds one list of values per variable, in the Crunch I/O format:
+category ids, numbers, strings... or {"?": code} dicts for missing cells.
+The *_array functions convert such columns to typed NumPy arrays, at C
+speed when the column has no missing cells and in a single pass otherwise.
+"""
+
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Marks the missing cells of id_array() results; never a category id.
+MISSING_ID = np.iinfo(np.int64).min
+
+
+# The slow paths below test v.__class__ inline: no function call per cell.
+
+
+def id_array(col):
+    """Return the given column of category ids as an int64 array.
+
+    Missing cells become MISSING_ID.
+    """
+    try:
+        return np.array(col, dtype=np.int64)
+    except (TypeError, ValueError):
+        return np.fromiter(
+            (v if v.__class__ is int else MISSING_ID for v in col),
+            dtype=np.int64, count=len(col)
+        )
+
+
+def float_array(col):
+    """Return the given numeric column as a float64 array; missing cells are NaN."""
+    try:
+        return np.array(col, dtype=np.float64)
+    except (TypeError, ValueError):
+        nan = np.nan
+        return np.fromiter(
+            (v if v.__class__ is float or v.__class__ is int else nan for v in col),
+            dtype=np.float64, count=len(col)
+        )
+
+
+def object_array(col):
+    """Return the given column as an object array; missing cells are None."""
+    arr = np.empty(len(col), dtype=object)
+    arr[:] = [None if isinstance(v, dict) else v for v in col]
+    return arr
+
+
+def missing_codes(col, mask):
+    """Return the missing code of each cell of col, or 0 for valid cells.
+
+    The `mask` is a boolean array of the cells known to be missing (from
+    the null mask of a converted column, say); only those cells are read
+    again. The code of a {"?": code} cell is its code, and that of any
+    other missing cell is its value: the id of a missing category.
+
+    The result has the smallest of the int8/int16/int32 dtypes which holds
+    all codes. Since 0 may itself be a missing code (or category id), use
+    it together with the mask rather than testing for 0.
+    """
+    codes = np.zeros(len(col), dtype=np.int64)
+    positions = np.flatnonzero(mask)
+    if len(positions):
+        cells = [col[i] for i in positions]
+        codes[positions] = [v["?"] if isinstance(v, dict) else v for v in cells]
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not len(positions) or (
+            codes.min() >= info.min and codes.max() <= info.max
+        ):
+            return codes.astype(dtype)
+    return codes
+
+
+def category_codes(ids, category_ids):
+    """Return the index in category_ids of each of the given ids, or -1.
+
+    Both arguments are sequences of category ids; `ids` is typically
+    an id_array(), in which MISSING_ID (as any absent id) gets -1.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    category_ids = np.asarray(category_ids, dtype=np.int64)
+    if not len(category_ids):
+        return np.full(len(ids), -1, dtype=np.int64)
+    order = np.argsort(category_ids, kind="mergesort")
+    sorted_ids = category_ids[order]
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[pos] == ids, order[pos], -1)
+
+
+class TablePager(object):
+    """Iterate over the pages of a dataset's crunch:table fragment, in order.
+
+    Pages of `chunksize` rows are requested from `offset` on, until `limit`
+    rows (default: all remaining rows) have been requested. Up to `window`
+    requests are in flight at once, each on its own thread, and each
+    crunch:table payload is yielded in row order as soon as it and all the
+    pages before it have arrived. At least one page is always requested,
+    so that the table metadata is available even for an empty dataset.
+
+    If `adaptive` is True, the size of each page still to be requested is
+    adjusted from the response time and size of the pages received so far:
+    it aims for pages taking `target_seconds` to arrive, and no larger than
+    `max_page_bytes`, within [min_chunksize, max_chunksize] rows. Growth is
+    limited to doubling per page, so that one fast page does not lead to a
+    huge one.
+    """
+
+    def __init__(self, dataset, chunksize=1000, window=4, offset=0, limit=None,
+                 adaptive=False, min_chunksize=100, max_chunksize=20000,
+                 target_seconds=1.0, max_page_bytes=32 * 1024 * 1024):
+        self.dataset = dataset
+        self.chunksize = chunksize
+        self.window = window
+        self.offset = offset
+        self.limit = limit
+        self.adaptive = adaptive
+        self.min_chunksize = min_chunksize
+        self.max_chunksize = max_chunksize
+        self.target_seconds = target_seconds
+        self.max_page_bytes = max_page_bytes
+
+    @property
+    def numrows(self):
+        """The total number of rows in the dataset."""
+        return self.dataset.summary.value.unweighted.total
+
+    def __iter__(self):
+        end = self.numrows
+        if self.limit is not None:
+            end = min(end, self.offset + self.limit)
+
+        offset = self.offset
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.window) as executor:
+            while True:
+                while len(pending) < self.window and (offset < end or offset == self.offset):
+                    size = max(min(self.chunksize, end - offset), 1)
+                    pending.append(executor.submit(self.fetch, offset, size))
+                    offset += size
+                if not pending:
+                    break
+                page, elapsed, nbytes, nrows = pending.popleft().result()
+                if self.adaptive:
+                    self.adapt(elapsed, nbytes, nrows)
+                yield page
+
+    def fetch(self, offset, limit):
+        """Return (page, seconds, bytes, rows) for the given rows of the table."""
+        begin = time.time()
+        r = self.dataset.session.get(
+            "%s?offset=%d&limit=%d" % (self.dataset.fragments['table'], offset, limit),
+            stream=True
+        )
+        elapsed = time.time() - begin
+        if r._content_consumed:
+            nbytes = len(r.content)
+        else:
+            # Parsed as it streamed in; the (possibly compressed) length will do.
+            nbytes = int(r.headers.get("Content-Length") or 0)
+        return r.payload, elapsed, nbytes, limit
+
+    def adapt(self, elapsed, nbytes, nrows):
+        """Set self.chunksize from the observed cost of a page of nrows."""
+        size = self.chunksize * 2
+        if elapsed > 0:
+            size = min(size, int(nrows * self.target_seconds / elapsed))
+        if nbytes > 0:
+            size = min(size, int(nrows * self.max_page_bytes / nbytes))
+        self.chunksize = max(self.min_chunksize, min(size, self.max_chunksize))
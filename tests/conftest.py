@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # async/await syntax: the module cannot even be parsed.
+    collect_ignore.append("test_aio.py")
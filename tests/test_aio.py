@@ -0,0 +1,136 @@
+import asyncio
+import json
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from pycrunch import aio, shoji
+from pycrunch.progress import DefaultProgressTracking
+
+
+def run(coro):
+    return asyncio.get_event_loop_policy().new_event_loop().run_until_complete(coro)
+
+
+async def serve(routes, test):
+    app = web.Application()
+    app.add_routes(routes)
+    server = TestServer(app, host="localhost")
+    await server.start_server()
+    try:
+        return await test(str(server.make_url("/")))
+    finally:
+        await server.close()
+
+
+def json_response(payload, status=200, **kwargs):
+    return web.Response(
+        status=status, text=json.dumps(payload),
+        content_type="application/json", **kwargs
+    )
+
+
+def test_get_parses_elements_and_follows_links():
+    async def root(request):
+        return json_response({
+            "element": "shoji:catalog",
+            "self": str(request.url),
+            "index": {"ds/1/": {"name": "One"}},
+            "catalogs": {"datasets": str(request.url.join(request.app.router["ds"].url_for()))},
+        })
+
+    async def datasets(request):
+        return json_response({
+            "element": "shoji:entity", "self": str(request.url), "body": {"name": "One"},
+        })
+
+    routes = [
+        web.get("/", root),
+        web.get("/ds/1/", datasets, name="ds"),
+    ]
+
+    async def test(url):
+        async with aio.AsyncElementSession(token="abc", site_url=url) as session:
+            root = await session.root
+            assert isinstance(root, shoji.Catalog)
+            assert root.session is session
+
+            entity = await aio.follow(root, "datasets")
+            assert isinstance(entity, shoji.Entity)
+            assert entity.body.name == "One"
+
+            tupl = root.index["ds/1/"]
+            fetched = await aio.fetch(tupl)
+            assert fetched.body.name == "One"
+
+    run(serve(routes, test))
+
+
+def test_401_logs_in_and_repeats():
+    logins = []
+
+    async def protected(request):
+        if request.cookies.get("session") != "yes":
+            login_url = str(request.url.join(request.app.router["login"].url_for()))
+            return json_response({"urls": {"login_url": login_url}}, status=401)
+        return json_response({"ok": True})
+
+    async def login(request):
+        logins.append(await request.json())
+        response = web.Response(status=204)
+        response.set_cookie("session", "yes")
+        return response
+
+    routes = [
+        web.get("/protected/", protected),
+        web.post("/login/", login, name="login"),
+    ]
+
+    async def test(url):
+        async with aio.AsyncElementSession("me@example.com", "pw", site_url=url) as session:
+            r = await session.get(url + "protected/")
+            assert r.status_code == 200
+            assert r.payload == {"ok": True}
+            assert [h.status_code for h in r.history] == [401, 204]
+
+    run(serve(routes, test))
+    assert logins == [{"email": "me@example.com", "password": "pw"}]
+
+
+def test_wait_progress():
+    polls = []
+
+    async def progress(request):
+        polls.append(1)
+        return json_response({
+            "element": "shoji:view",
+            "value": {"progress": 100 if len(polls) == 3 else 50},
+        })
+
+    async def create(request):
+        progress_url = str(request.url.join(request.app.router["progress"].url_for()))
+        return json_response(
+            {"element": "shoji:view", "value": progress_url},
+            status=202, headers={"Location": str(request.url) + "new/"},
+        )
+
+    routes = [
+        web.get("/progress/", progress, name="progress"),
+        web.post("/catalog/", create),
+    ]
+
+    async def test(url):
+        async with aio.AsyncElementSession(token="abc", site_url=url) as session:
+            catalog = shoji.Catalog(session, self=url + "catalog/")
+            r = await aio.post(catalog, {"body": {}})
+            assert r.status_code == 202
+            await aio.wait_progress(
+                r, session, DefaultProgressTracking(timeout=5, interval=0.01)
+            )
+
+    run(serve(routes, test))
+    assert len(polls) == 3
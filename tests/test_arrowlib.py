@@ -0,0 +1,80 @@
+import io
+from unittest import TestCase
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+import pyarrow.parquet as pq
+
+from pycrunch import arrowlib
+from pycrunch.elements import JSONObject
+
+from .test_pandaslib import fake_dataset, vardef
+
+METADATA = {
+    'v1': vardef(id='v1', alias='gender', type='categorical', categories=[
+        {'id': 1, 'name': 'M', 'missing': False},
+        {'id': 2, 'name': 'F', 'missing': False},
+        {'id': -1, 'name': 'No Data', 'missing': True},
+    ]),
+    'v2': vardef(id='v2', alias='age', type='numeric'),
+    'v3': vardef(id='v3', alias='born', type='datetime'),
+    'v4': vardef(id='v4', alias='name', type='text'),
+}
+
+DATA = {
+    'v1': [1, 2, -1, 2, 1],
+    'v2': [20, {'?': -1}, 31.5, 40, {'?': -2}],
+    'v3': ['2000-01-02', '1990-05', {'?': -1}, '1980-01-01T12:30:00', '1970'],
+    'v4': ['a', 'b', {'?': -1}, 'd', 'e'],
+}
+
+
+class TestArrays(TestCase):
+
+    def test_record_batch(self):
+        page = JSONObject(data=JSONObject(DATA), metadata=JSONObject(METADATA))
+        batch = arrowlib.record_batch(page)
+        self.assertEqual(batch.schema.names, ['gender', 'age', 'born', 'name'])
+        self.assertEqual(batch.schema.field('age').metadata, {b'crunch:id': b'v2'})
+
+        gender = batch.column(0)
+        self.assertTrue(gender.type.ordered)
+        self.assertEqual(gender.dictionary.to_pylist(), ['M', 'F'])
+        self.assertEqual(gender.to_pylist(), ['M', 'F', None, 'F', 'M'])
+        self.assertEqual(batch.column(1).to_pylist(), [20.0, None, 31.5, 40.0, None])
+        self.assertEqual(batch.column(1).null_count, 2)
+        self.assertEqual(batch.column(2).type, pa.timestamp('ms'))
+        self.assertEqual(
+            [str(v) if v else v for v in batch.column(2).to_pylist()],
+            ['2000-01-02 00:00:00', '1990-05-01 00:00:00', None,
+             '1980-01-01 12:30:00', '1970-01-01 00:00:00']
+        )
+        self.assertEqual(batch.column(3).to_pylist(), ['a', 'b', None, 'd', 'e'])
+
+
+class TestDataset(TestCase):
+
+    def test_table(self):
+        dataset = fake_dataset(DATA, METADATA)
+        batches = list(arrowlib.iter_record_batches(dataset, chunksize=2))
+        self.assertEqual([b.num_rows for b in batches], [2, 2, 1])
+        self.assertTrue(all(b.schema == batches[0].schema for b in batches))
+
+        t = arrowlib.table(dataset, chunksize=3)
+        self.assertEqual(t.num_rows, 5)
+        self.assertEqual(t.column('age').to_pylist()[2:4], [31.5, 40.0])
+
+    def test_write_parquet(self):
+        out = io.BytesIO()
+        numrows = arrowlib.write_parquet(
+            fake_dataset(DATA, METADATA), out, chunksize=2
+        )
+        self.assertEqual(numrows, 5)
+        out.seek(0)
+        t = pq.read_table(out)
+        self.assertEqual(t.column('name').to_pylist(), ['a', 'b', None, 'd', 'e'])
+        self.assertEqual(
+            t.column('gender').to_pylist(), ['M', 'F', None, 'F', 'M']
+        )
@@ -2,6 +2,7 @@
 
 from __future__ import unicode_literals
 
+import datetime
 from unittest import TestCase
 
 import six
@@ -32,3 +33,49 @@ class TestCSV(TestCase):
         rows = [[0, 1, None, "bananas"]]
         fp = csvlib.rows_as_csv_file_clean(rows)
         self.assertEqual(fp.read(), b'0,1,"","bananas"\n')
+
+    def test_dates_are_quoted(self):
+        fp = csvlib.rows_as_csv_file([[datetime.date(2020, 1, 2), None, 1]])
+        self.assertEqual(fp.read(), b'"2020-01-02",,1\n')
+
+    def test_single_column_none(self):
+        fp = csvlib.rows_as_csv_file([[None], [1], [None]])
+        self.assertEqual(fp.read(), b'\n1\n\n')
+        fp = csvlib.rows_as_csv_file_clean([[None], [1]])
+        self.assertEqual(fp.read(), b'""\n1\n')
+
+    def test_unicode_bytes(self):
+        fp = csvlib.rows_as_csv_file([['☃', None, 1.5]])
+        self.assertEqual(fp.read(), '"☃",,1.5\n'.encode('utf-8'))
+
+    def test_no_rows(self):
+        self.assertEqual(csvlib.rows_as_csv_file([]).read(), b'')
+
+    def test_rows_are_encoded_lazily(self):
+        consumed = []
+
+        def rows():
+            for i in range(10000):
+                consumed.append(i)
+                yield [i, None, "x" * 10]
+
+        fp = csvlib.rows_as_csv_file(rows())
+        self.assertEqual(consumed, [])
+        self.assertEqual(fp.readline(), b'0,,"xxxxxxxxxx"\n')
+        self.assertLess(len(consumed), 10000)
+        rest = fp.read()
+        self.assertEqual(len(consumed), 10000)
+        self.assertEqual(rest.count(b'\n'), 9999)
+        self.assertTrue(rest.endswith(b'9999,,"xxxxxxxxxx"\n'))
+
+    def test_chunks(self):
+        rows = [[i, "row %d" % i, None] for i in range(1000)]
+        chunks = list(csvlib.iter_csv_chunks(rows, chunksize=1000))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            # Whole rows only, and bounded.
+            self.assertTrue(chunk.endswith(b'\n'))
+            self.assertLess(len(chunk), 1000 + csvlib.ROWS_PER_WRITE * 20)
+        self.assertEqual(
+            b''.join(chunks).splitlines()[-1], b'999,"row 999",'
+        )
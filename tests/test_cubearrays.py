@@ -0,0 +1,95 @@
+from unittest import TestCase
+
+import mock
+import numpy as np
+
+from pycrunch import cubes
+from pycrunch.cubearrays import Cube
+from pycrunch.elements import JSONObject
+from pycrunch.shoji import View
+
+
+GENDER = {
+    "references": {"alias": "gender", "name": "Gender"},
+    "type": {
+        "class": "categorical",
+        "categories": [
+            {"id": 1, "name": "Male", "missing": False},
+            {"id": 2, "name": "Female", "missing": False},
+            {"id": -1, "name": "No Data", "missing": True},
+        ],
+    },
+}
+AGE = {
+    "references": {"alias": "age", "name": "Age"},
+    "type": {
+        "class": "enum",
+        "subtype": {"class": "numeric"},
+        "elements": [
+            {"id": 0, "value": [0, 30], "missing": False},
+            {"id": 1, "value": [30, 60], "missing": False},
+            {"id": 2, "value": {"?": -1}, "missing": True},
+        ],
+    },
+}
+RESULT = {
+    "dimensions": [GENDER, AGE],
+    "counts": [5, 3, 0, 4, 6, 1, 0, 0, 2],
+    "n": 21,
+    "measures": {
+        "count": {"data": [5, 3, 0, 4, 6, 1, 0, 0, 2], "n_missing": 3},
+        "mean": {
+            "data": [1.5, 2.0, {"?": -8}, 2.5, 1.0, 3.0, {"?": -8}, {"?": -8}, 4.0],
+            "n_missing": 3,
+        },
+    },
+}
+
+
+class TestCube(TestCase):
+
+    def test_dimensions(self):
+        cube = Cube(RESULT)
+        self.assertEqual(cube.shape, (3, 3))
+        gender, age = cube.dimensions
+        self.assertEqual((gender.alias, gender.name, gender.type),
+                         ("gender", "Gender", "categorical"))
+        self.assertEqual(gender.labels, ["Male", "Female", "No Data"])
+        self.assertEqual(gender.ids.tolist(), [1, 2, -1])
+        self.assertEqual(gender.missing.tolist(), [False, False, True])
+        self.assertEqual(age.type, "numeric")
+        self.assertEqual(age.labels, ["0-30", "30-60", None])
+        self.assertEqual(age.missing.tolist(), [False, False, True])
+
+    def test_measures(self):
+        cube = Cube(RESULT)
+        self.assertEqual(cube.n, 21)
+        self.assertEqual(cube.counts.dtype, np.int64)
+        self.assertEqual(cube.counts.tolist(), [[5, 3, 0], [4, 6, 1], [0, 0, 2]])
+        np.testing.assert_array_equal(
+            cube.measures["count"], [[5, 3, 0], [4, 6, 1], [0, 0, 2]]
+        )
+        mean = cube.measures["mean"]
+        self.assertEqual(mean.dtype, np.float64)
+        self.assertEqual(mean[1, 0], 2.5)
+        self.assertEqual(
+            cube.missing["mean"].tolist(),
+            [[False, False, True], [False, False, False], [True, True, False]]
+        )
+        self.assertEqual(cube.valid_counts.tolist(), [[5, 3], [4, 6]])
+        np.testing.assert_array_equal(cube.valid(mean), [[1.5, 2.0], [2.5, 1.0]])
+
+    def test_fetch_cube(self):
+        dataset = mock.Mock()
+        dataset.views.cube = "cube/"
+        view = View(dataset.session, **{
+            "self": "cube/", "value": JSONObject(query={}, result=RESULT)
+        })
+        dataset.session.get.return_value = mock.Mock(payload=view)
+
+        self.assertIs(cubes.fetch_cube(dataset, [{"variable": "v1/"}]), view)
+        cube = cubes.fetch_cube(
+            dataset, [{"variable": "v1/"}], as_cube=True, count=cubes.count()
+        )
+        self.assertIsInstance(cube, Cube)
+        self.assertEqual(cube.shape, (3, 3))
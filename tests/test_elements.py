@@ -4,7 +4,7 @@ from unittest import TestCase
 
 import requests
 
-from pycrunch import elements, shoji
+from pycrunch import elements, jsoncodec, shoji
 
 try:
     # Python 2
@@ -85,6 +85,52 @@ class TestParseElement(TestCase):
             self.assertTrue(isinstance(element, self.Shape))
         self.assertEqual(result, data)
 
+    def test_lazy(self):
+        data = {
+            'element': 'shoji:shape',
+            'name': 'circle',
+            'center': {'x': 1, 'y': 2},
+            'sides': [{'name': 'edge', 'element': 'shoji:shape'}, 3],
+        }
+        result = elements.parse_element(session='sess', j=data, lazy=True)
+        self.assertTrue(isinstance(result, self.Shape))
+        # Nested members stay as decoded until read...
+        self.assertIs(type(dict.__getitem__(result, 'center')), dict)
+        # ...and are then parsed to the same types as an eager parse.
+        self.assertTrue(isinstance(result.center, elements.JSONObject))
+        self.assertEqual(result.center.x, 1)
+        self.assertTrue(isinstance(result['sides'][0], self.Shape))
+        self.assertEqual(result['sides'][0].session, 'sess')
+        self.assertEqual(result, data)
+
+    def test_lazy_refresh(self):
+        session = mock.MagicMock()
+        session.get.return_value.payload = elements.parse_element(session, {
+            'element': 'shoji:entity',
+            'self': 'http://x/',
+            'catalogs': {'variables': 'http://x/variables/'},
+        }, lazy=True)
+        entity = shoji.Entity(session, self='http://x/').refresh()
+        self.assertEqual(entity.catalogs.variables, 'http://x/variables/')
+
+    def test_lazy_values_and_items(self):
+        data = {'a': {'b': {'c': 1}}}
+        result = elements.parse_element(session=None, j=data, lazy=True)
+        for value in result.values():
+            self.assertTrue(isinstance(value, elements.JSONObject))
+        for key, value in result['a'].items():
+            self.assertTrue(isinstance(value, elements.JSONObject))
+
+    def test_lazy_constructed_members(self):
+        data = {
+            'element': 'shoji:entity',
+            'self': 'http://x/',
+            'body': {'nested': {'a': 1}},
+        }
+        result = elements.parse_element(session=None, j=data, lazy=True)
+        self.assertTrue(isinstance(result.body, shoji.Tuple))
+        self.assertTrue(isinstance(result.body.nested, elements.JSONObject))
+
 
 class TestDocument(TestCase):
 
@@ -302,3 +348,44 @@ class TestElementSession(TestCase):
         assert session.site_url is None
         assert session.email is email
 
+
+class TestJSONCodec(TestCase):
+
+    class Recorder(jsoncodec.JSONCodec):
+        def __init__(self):
+            super(TestJSONCodec.Recorder, self).__init__()
+            self.calls = []
+
+        def loads(self, s):
+            self.calls.append(('loads', s))
+            return super(TestJSONCodec.Recorder, self).loads(s)
+
+        def dumps(self, obj, separators=None):
+            self.calls.append(('dumps', obj))
+            return super(TestJSONCodec.Recorder, self).dumps(obj, separators)
+
+    def test_decodes_response_bytes_with_session_codec(self):
+        session = elements.ElementSession(token="abc", site_url="https://example.com/api/")
+        session.json_codec = self.Recorder()
+        r = requests.Response()
+        r._content = b'{"element": "shoji:view", "value": 1}'
+        result = elements.parse_json_element_from_response(session, r)
+        self.assertTrue(isinstance(result, shoji.View))
+        self.assertEqual(session.json_codec.calls, [('loads', r._content)])
+
+    def test_encodes_with_session_codec(self):
+        session = mock.MagicMock()
+        session.json_codec = self.Recorder()
+        view = shoji.View(session, self='some uri')
+        view.post({'a': 1})
+        self.assertEqual(view.json, '{"self":"some uri","element":"shoji:view"}')
+        self.assertEqual(
+            [name for name, obj in session.json_codec.calls], ['dumps', 'dumps']
+        )
+
+    def test_get_codec(self):
+        codec = jsoncodec.get_codec("auto")
+        self.assertTrue(isinstance(codec, jsoncodec.JSONCodec))
+        self.assertEqual(codec.loads(b'{"a": [1, "\xc3\xa9"]}'), {"a": [1, u"\xe9"]})
+        self.assertEqual(codec.loads(codec.dumps({"a": "/b"})), {"a": "/b"})
+        self.assertTrue(isinstance(jsoncodec.get_codec("json"), jsoncodec.JSONCodec))
@@ -0,0 +1,263 @@
+import csv
+import gzip
+import io
+import os
+import re
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+from requests import Response
+
+from pycrunch import exporting
+from pycrunch.jsoncodec import JSONCodec
+from pycrunch.progress import DefaultProgressTracking
+from pycrunch.shoji import TaskError
+
+
+CONTENT = b''.join(b'%04d,' % i for i in range(25))
+CSV = b'id,name\n' + b''.join(b'%d,"name %d"\n' % (i, i) for i in range(100))
+
+
+class FakeFiles(object):
+    """A fake session.get for files, with or without Range support."""
+
+    def __init__(self, files, ranges=True, fail=()):
+        self.files = files
+        self.ranges = ranges
+        self.fail = set(fail)
+        self.requests = []
+
+    def get(self, url, stream=False, headers=None):
+        content = self.files[url]
+        byte_range = (headers or {}).get('Range')
+        self.requests.append((url, byte_range))
+        r = Response()
+        r.url = url
+        r.headers['Content-Type'] = 'application/octet-stream'
+        if byte_range and self.ranges:
+            start, end = map(int, re.match(r'bytes=(\d+)-(\d+)', byte_range).groups())
+            end = min(end, len(content) - 1)
+            r.status_code = 206
+            r.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(content))
+            content = content[start:end + 1]
+            if start in self.fail:
+                # The connection drops halfway through the part.
+                content = content[:len(content) // 2]
+        else:
+            r.status_code = 200
+        r._content = content
+        r._content_consumed = True
+        return r
+
+
+class TestDownload(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'export.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ranges(self):
+        session = FakeFiles({'file/': CONTENT})
+        path = exporting.download(
+            session, 'file/', self.path, parallel=3, part_size=40
+        )
+        self.assertEqual(path, self.path)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(set(session.requests), set([
+            ('file/', 'bytes=0-39'),
+            ('file/', 'bytes=40-79'),
+            ('file/', 'bytes=80-119'),
+            ('file/', 'bytes=120-124'),
+        ]))
+        self.assertEqual(len(session.requests), 4)
+        self.assertEqual(os.listdir(self.tmpdir), ['export.csv'])
+
+    def test_no_ranges(self):
+        session = FakeFiles({'file/': CONTENT}, ranges=False)
+        exporting.download(session, 'file/', self.path, parallel=3, part_size=40)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(len(session.requests), 1)
+
+    def test_resume(self):
+        session = FakeFiles({'file/': CONTENT}, fail=[40])
+        with self.assertRaises(exporting.DownloadError) as cm:
+            exporting.download(
+                session, 'file/', self.path, part_size=40, retries=1
+            )
+        self.assertEqual(list(cm.exception.failures), [1])
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(
+            session.requests.count(('file/', 'bytes=40-79')), 2
+        )
+
+        session.fail = set()
+        session.requests = []
+        exporting.download(session, 'file/', self.path, part_size=40)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        # Only the probe for the length, and the missing part.
+        self.assertEqual(session.requests, [
+            ('file/', 'bytes=0-39'), ('file/', 'bytes=40-79')
+        ])
+        self.assertEqual(os.listdir(self.tmpdir), ['export.csv'])
+
+    def test_resume_complete(self):
+        # Interrupted after the last part was written, before the rename.
+        with open(self.path + '.part', 'wb') as f:
+            f.write(CONTENT)
+        journal = exporting.DownloadJournal(self.path + '.part.json')
+        journal.reset('file/', len(CONTENT), 40)
+        journal.done = set(range(4))
+        journal.save()
+
+        session = FakeFiles({})
+        exporting.download(session, 'file/', self.path, part_size=40)
+        self.assertEqual(session.requests, [])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(os.listdir(self.tmpdir), ['export.csv'])
+
+
+class TestExportManager(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _dataset(self, session, dsid):
+        ds = mock.Mock(session=session)
+        ds.body.id = dsid
+        ds.export.views = {'csv': '%s/export/csv/' % dsid}
+        return ds
+
+    def _session(self, progress):
+        files = FakeFiles(dict(
+            ('%s/file/' % dsid, CONTENT + dsid.encode('ascii')) for dsid in progress
+        ))
+
+        def post(url, data):
+            dsid = url.split('/')[0]
+            r = Response()
+            r.status_code = 202
+            r.headers['Location'] = '%s/file/' % dsid
+            r.payload = {'value': '%s/progress/' % dsid}
+            return r
+
+        def get(url, **kwargs):
+            if url.endswith('/progress/'):
+                r = Response()
+                r.status_code = 200
+                r.payload = {'value': progress[url.split('/')[0]]}
+                return r
+            return files.get(url, **kwargs)
+
+        session = mock.Mock()
+        session.post.side_effect = post
+        session.get.side_effect = get
+        session.progress_tracking = DefaultProgressTracking(timeout=5, interval=0.01)
+        return session
+
+    def test_run(self):
+        session = self._session({
+            'ds1': {'progress': 100},
+            'ds2': {'progress': 100},
+            'ds3': {'progress': -1, 'message': 'Export failed'},
+        })
+        manager = exporting.ExportManager(self.tmpdir, parallel=2, part_size=40)
+        paths = [
+            manager.add(self._dataset(session, dsid), {'where': {}})
+            for dsid in ('ds1', 'ds2', 'ds3')
+        ]
+        self.assertEqual(paths[0], os.path.join(self.tmpdir, 'ds1.csv'))
+
+        with self.assertRaises(exporting.ExportError) as cm:
+            manager.run()
+        self.assertEqual(sorted(cm.exception.paths), paths[:2])
+        self.assertEqual(list(cm.exception.failures), [paths[2]])
+        self.assertIsInstance(cm.exception.failures[paths[2]], TaskError)
+        for dsid, path in zip(('ds1', 'ds2'), paths):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT + dsid.encode('ascii'))
+
+        # The failed export stays queued.
+        self.assertEqual([export[3] for export in manager.exports], [paths[2]])
+
+    def test_session_codec(self):
+        session = self._session({'ds1': {'progress': 100}})
+        session.json_codec = mock.Mock(spec=JSONCodec)
+        session.json_codec.dumps.return_value = '{"where": {}}'
+        url = exporting.export_dataset(self._dataset(session, 'ds1'), {'where': {}})
+        self.assertEqual(url, 'ds1/file/')
+        session.json_codec.dumps.assert_called_once_with({'where': {}})
+
+
+class TestStreamingExport(TestCase):
+
+    def _session(self, content, **headers):
+        def get(url, stream=False):
+            r = Response()
+            r.status_code = 200
+            r.url = url
+            r.headers.update(headers)
+            r.raw = io.BytesIO(content)
+            return r
+        return mock.Mock(get=mock.Mock(side_effect=get))
+
+    def _gzip(self, data):
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(data)
+        return out.getvalue()
+
+    def test_plain(self):
+        session = self._session(CSV, **{'Content-Length': str(len(CSV))})
+        f = exporting.open_export(session, 'file/', chunk_size=7)
+        rows = list(csv.reader(io.TextIOWrapper(f, encoding='utf-8')))
+        self.assertEqual(rows[0], ['id', 'name'])
+        self.assertEqual(len(rows), 101)
+        session.get.assert_called_once_with('file/', stream=True)
+
+    def test_gzipped(self):
+        # Two gzip members, as concatenated by parallel compressors.
+        content = self._gzip(CSV[:500]) + self._gzip(CSV[500:])
+        session = self._session(content, **{'Content-Length': str(len(content))})
+        self.assertEqual(
+            b''.join(exporting.iter_export(session, 'file/', chunk_size=16)), CSV
+        )
+        self.assertEqual(
+            b''.join(exporting.iter_export(session, 'file/', decompress=False)),
+            content
+        )
+
+    def test_short_body(self):
+        session = self._session(CSV, **{'Content-Length': str(len(CSV) + 10)})
+        f = exporting.open_export(session, 'file/')
+        self.assertRaises(IOError, f.read)
+
+    def test_truncated_gzip(self):
+        content = self._gzip(CSV)[:-20]
+        session = self._session(content)
+        self.assertRaises(IOError, b''.join, exporting.iter_export(session, 'file/'))
+
+    def test_download_export(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'export.csv')
+        session = self._session(self._gzip(CSV))
+        self.assertEqual(exporting.download_export(session, 'file/', path), len(CSV))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), CSV)
+        self.assertEqual(os.listdir(tmpdir), ['export.csv'])
+
+        out = io.BytesIO()
+        exporting.download_export(session, 'file/', out)
+        self.assertEqual(out.getvalue(), CSV)
@@ -1,10 +1,16 @@
+import base64
+import io
+import json
+import os
+import shutil
+import tempfile
 from unittest import TestCase
 
 import pytest
 import requests
 
 from pycrunch import connect, connect_with_token, Session, __version__
-from pycrunch.lemonpy import ServerError
+from pycrunch.lemonpy import ClientError, DiskCache, MemoryCache, ServerError
 
 try:
     from requests.packages.urllib3.response import HTTPResponse
@@ -70,7 +76,7 @@ class TestHTTPResponses(TestCase):
         sess.post = lambda slf, *args, **kwargs: mock.MagicMock(headers=headers)
         sess.send = mock.MagicMock()
         url_401 = 'http://example.com/401'
-        fake_request = mock.MagicMock(url=url_401)
+        fake_request = mock.MagicMock(url=url_401, body=None)
         r = mock.MagicMock(
             request=fake_request,
             json=lambda: {'urls': {'login_url': 'http://www.httpbin.org/post'}}
@@ -84,6 +90,24 @@ class TestHTTPResponses(TestCase):
         gep.assert_called_once_with(url_401, no_proxy=None)
         sess.send.assert_called_with(fake_request, proxies={})
 
+    def test_401_streamed_body_is_not_replayed(self):
+        sess = Session("not an email", "not a password", site_url="https://app.crunch.io/api/")
+        sess.post = mock.MagicMock(return_value=mock.MagicMock(headers={'Set-Cookie': 'abx'}))
+        sess.send = mock.MagicMock()
+        fake_request = mock.MagicMock(url='http://example.com/401', body=iter([b'a']))
+        r = mock.MagicMock(
+            request=fake_request, headers={},
+            json=lambda: {'urls': {'login_url': 'http://www.httpbin.org/post'}}
+        )
+
+        from pycrunch.elements import ElementResponseHandler
+        handler = ElementResponseHandler(sess)
+        with self.assertRaises(ClientError):
+            handler.status_401(r)
+        # Logged in again, but the used-up body was not sent again.
+        sess.post.assert_called_once()
+        sess.send.assert_not_called()
+
 
 @pytest.fixture
 def mock_sess():
@@ -171,3 +195,165 @@ def test_connect_with_token(mock_sess):
         site_url="https://app.crunch.io/api/",
         progress_tracking=None,
     )
+
+
+class TestResponseCache(TestCase):
+
+    def _session(self, responses, cache):
+        sent = []
+
+        def _resp(adapter, request, *args, **kwargs):
+            sent.append(request.copy())
+            status, headers, body = responses.pop(0)
+            response = HTTPResponse(
+                status=status, body=io.BytesIO(body), headers=headers,
+                preload_content=False,
+            )
+            return adapter.build_response(request, response)
+
+        patch = mock.patch('requests.adapters.HTTPAdapter.send', _resp)
+        patch.start()
+        self.addCleanup(patch.stop)
+        s = Session("not an email", "not a password", site_url="https://app.crunch.io/api/")
+        s.cache = cache
+        return s, sent
+
+    def test_not_modified_reuses_body(self):
+        body = b'{"element": "shoji:catalog", "self": "http://x/", "index": {}}'
+        headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+        s, sent = self._session([
+            (200, headers, body),
+            (304, {'ETag': '"v1"'}, b''),
+        ], MemoryCache())
+
+        first = s.get("http://x/").payload
+        second = s.get("http://x/").payload
+
+        assert 'If-None-Match' not in sent[0].headers
+        assert sent[1].headers['If-None-Match'] == '"v1"'
+        assert second == first
+        assert second is not first
+        assert second.__class__ is first.__class__
+
+    def test_cached_payload_is_not_shared(self):
+        body = b'{"element": "shoji:entity", "self": "http://x/", "body": {"name": "a"}}'
+        headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+        s, sent = self._session([
+            (200, headers, body),
+            (304, {'ETag': '"v1"'}, b''),
+            (304, {'ETag': '"v1"'}, b''),
+        ], MemoryCache())
+
+        s.get("http://x/").payload.body['name'] = 'x'
+        second = s.get("http://x/").payload
+        assert second.body['name'] == 'a'
+        assert second.session is s
+        second.body['name'] = 'y'
+        assert s.get("http://x/").payload.body['name'] == 'a'
+
+    def test_lazy_parsing(self):
+        body = b'{"a": {"b": 1}}'
+        headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+        s, sent = self._session([
+            (200, headers, body),
+            (304, {'ETag': '"v1"'}, b''),
+        ], MemoryCache())
+        s.lazy_parsing = True
+
+        s.get("http://x/")
+        payload = s.get("http://x/").payload
+        assert type(dict.__getitem__(payload, 'a')) is dict
+        assert payload.a.b == 1
+
+    def test_disk_cache_reparses_body(self):
+        body = b'{"a": {"b": 1}}'
+        headers = {
+            'Content-Type': 'application/json',
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        }
+        cache = DiskCache(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache.path)
+        s, sent = self._session([
+            (200, headers, body),
+            (304, {}, b''),
+        ], cache)
+
+        s.get("http://x/")
+        payload = s.get("http://x/").payload
+        assert sent[1].headers['If-Modified-Since'] == headers['Last-Modified']
+        assert payload == {"a": {"b": 1}}
+        assert payload.a.b == 1
+        # Entries are plain JSON.
+        for name in os.listdir(cache.path):
+            with open(os.path.join(cache.path, name)) as f:
+                assert json.load(f)["content"] == base64.b64encode(body).decode()
+
+    def test_disk_cache_with_stream_parsing(self):
+        pytest.importorskip("ijson")
+        body = b'{"a": {"b": 1}}'
+        headers = {'Content-Type': 'application/json', 'ETag': '"v1"'}
+        cache = DiskCache(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache.path)
+        s, sent = self._session([
+            (200, headers, body),
+            (304, {}, b''),
+        ], cache)
+        s.stream_parsing = True
+
+        s.get("http://x/")
+        payload = s.get("http://x/", stream=True).payload
+        assert payload.a.b == 1
+
+    def test_unvalidated_responses_are_not_cached(self):
+        cache = MemoryCache()
+        s, sent = self._session([
+            (200, {'Content-Type': 'application/json'}, b'{}'),
+        ], cache)
+        s.get("http://x/")
+        assert len(cache) == 0
+
+    def test_memory_cache_evicts_least_recently_used(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', {'content': b'12345'})
+        cache.set('b', {'content': b'12345'})
+        cache.get('a')
+        cache.set('c', {'content': b'123'})
+        assert cache.get('b') is None
+        assert cache.get('a')['content'] == b'12345'
+        assert cache.get('c')['content'] == b'123'
+        assert cache.size == 8
+
+
+class TestStreamParsing(TestCase):
+
+    def setUp(self):
+        pytest.importorskip("ijson")
+        body = b'{"element": "crunch:table", "data": {"a": [1, 2.5, {"?": -1}]}}'
+
+        def _resp(adapter, request, *args, **kwargs):
+            response = HTTPResponse(
+                status=200, body=io.BytesIO(body),
+                headers={'Content-Type': 'application/json'},
+                preload_content=False,
+            )
+            return adapter.build_response(request, response)
+
+        patch = mock.patch('requests.adapters.HTTPAdapter.send', _resp)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.s = Session("not an email", "not a password", site_url="https://app.crunch.io/api/")
+
+    def test_streamed_response_is_parsed_incrementally(self):
+        self.s.stream_parsing = True
+        with mock.patch('pycrunch.elements.jsoncodec.JSONCodec.loads') as loads:
+            r = self.s.get("http://x/table/", stream=True)
+        loads.assert_not_called()
+        assert not r._content_consumed
+        assert r.payload.__class__.__name__ == 'CrunchTable'
+        assert r.payload.data.a == [1, 2.5, {"?": -1}]
+        assert isinstance(r.payload.data.a[1], float)
+
+    def test_stream_parsing_is_opt_in(self):
+        r = self.s.get("http://x/table/", stream=True)
+        assert r._content_consumed
+        assert r.payload.data.a == [1, 2.5, {"?": -1}]
@@ -0,0 +1,405 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import mock
+import pytest
+
+from pycrunch import importing
+from pycrunch.elements import JSONObject
+
+CSV = b'id,name\n1,"a"\n2,"b\nc"\n3,"d ""e"""\n4,"f"\n5,"g"\n'
+
+
+def uploaded_file(body):
+    """Return the (filename, content) of a streamed multipart_body."""
+    head, rest = b''.join(body).split(b'\r\n\r\n', 1)
+    filename = head.split(b'filename="')[1].split(b'"')[0].decode('utf-8')
+    return filename, rest.rsplit(b'\r\n--', 1)[0]
+
+
+class TestCSVShards(TestCase):
+
+    def test_rows_are_never_split(self):
+        for size in (1, 5, 10, 1000):
+            shards = list(importing.iter_csv_shards(CSV, shard_size=size))
+            for shard in shards:
+                self.assertTrue(shard.startswith(b'id,name\n'))
+            self.assertEqual(
+                b'id,name\n' + b''.join(shard[8:] for shard in shards), CSV
+            )
+        self.assertEqual(len(list(importing.iter_csv_shards(CSV, 1))), 5)
+
+    def test_open_file(self):
+        with mock.patch.object(importing, 'READ_SIZE', 3):
+            shards = list(importing.iter_csv_shards(io.BytesIO(CSV), 12))
+        self.assertEqual(shards, [
+            b'id,name\n1,"a"\n2,"b\nc"\n',
+            b'id,name\n3,"d ""e"""\n4,"f"\n',
+            b'id,name\n5,"g"\n',
+        ])
+
+    def test_header_only(self):
+        self.assertEqual(list(importing.iter_csv_shards(b'id,name\n')), [])
+
+
+class TestShardedAppend(TestCase):
+
+    def setUp(self):
+        self.ds = mock.Mock()
+        self.ds.user_url.catalogs = {'sources': 'http://x/sources/'}
+        self.uploads = []
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def post(self, fail):
+        def post(url, data=None, headers=None):
+            filename, shard = uploaded_file(data)
+            with self.lock:
+                self.shards[filename] = shard
+                self.uploads.append(filename)
+                attempts = self.uploads.count(filename)
+            if fail(filename, attempts):
+                raise IOError("Connection reset")
+            index = int(filename.split('.part')[1][:4])
+            return mock.Mock(headers={'Location': 'http://x/sources/%d/' % index})
+        return post
+
+    def test_append_csv_sharded(self):
+        # The second shard fails once, and is retried.
+        self.ds.session.post.side_effect = self.post(
+            lambda filename, attempts: '0001' in filename and attempts == 1
+        )
+        importer = importing.Importer()
+        with mock.patch.object(importer, 'create_batch_from_source') as create:
+            create.side_effect = lambda ds, url: url
+            batches = importer.append_csv_sharded(
+                self.ds, CSV, filename='data.csv', shard_size=1, max_workers=3
+            )
+
+        self.assertEqual(batches, ['http://x/sources/%d/' % i for i in range(5)])
+        self.assertEqual(sorted(self.uploads), [
+            'data.part0000.csv', 'data.part0001.csv', 'data.part0001.csv',
+            'data.part0002.csv', 'data.part0003.csv', 'data.part0004.csv',
+        ])
+        self.assertEqual(self.shards['data.part0001.csv'], b'id,name\n2,"b\nc"\n')
+
+    def test_failed_shard(self):
+        self.ds.session.post.side_effect = self.post(
+            lambda filename, attempts: '0002' in filename
+        )
+        importer = importing.Importer()
+        with mock.patch.object(importer, 'create_batch_from_source') as create:
+            with pytest.raises(importing.UploadError) as exc_info:
+                importer.append_csv_sharded(
+                    self.ds, CSV, shard_size=1, shard_retries=1
+                )
+        create.assert_not_called()
+        self.assertEqual(list(exc_info.value.failures), [2])
+        self.assertEqual(exc_info.value.sources[2], None)
+        self.assertEqual(exc_info.value.sources[3], 'http://x/sources/3/')
+        self.assertEqual(self.uploads.count('upload.part0002.csv'), 2)
+
+
+class TestCompressedUpload(TestCase):
+
+    def test_gzip_chunks(self):
+        chunks = [b'id,name\n', b'1,"a"\n' * 1000, b'', b'2,"b"\n']
+        compressed = b''.join(importing.gzip_chunks(iter(chunks)))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(),
+                         b''.join(chunks))
+        self.assertLess(len(compressed), 100)
+
+    def test_compressed_source(self):
+        ds = mock.Mock()
+        ds.user_url.catalogs = {'sources': 'http://x/sources/'}
+        sent = {}
+
+        def post(url, data=None, headers=None):
+            sent['content_type'] = headers['Content-Type']
+            sent['body'] = b''.join(data)
+            return mock.Mock(headers={'Location': 'http://x/sources/1/'})
+
+        ds.session.post.side_effect = post
+        importer = importing.Importer(compress=True)
+        url = importer.add_source(ds, 'upload.csv', io.BytesIO(CSV), 'text/csv')
+        self.assertEqual(url, 'http://x/sources/1/')
+
+        boundary = sent['content_type'].split('boundary=')[1].encode('ascii')
+        head, rest = sent['body'].split(b'\r\n\r\n', 1)
+        self.assertIn(b'filename="upload.csv.gz"\r\nContent-Type: application/gzip',
+                      head)
+        content = rest[:-len(b'\r\n--' + boundary + b'--\r\n')]
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(content)).read(), CSV)
+
+    def test_text_mode_file(self):
+        ds = mock.Mock()
+        ds.user_url.catalogs = {'sources': 'http://x/sources/'}
+        sent = []
+
+        def post(url, data=None, headers=None):
+            sent.append(uploaded_file(data))
+            return mock.Mock(headers={'Location': 'http://x/sources/1/'})
+
+        ds.session.post.side_effect = post
+        importer = importing.Importer(compress=True)
+        text = io.StringIO(CSV.decode('utf-8') + u'6,"\u2603"\n')
+        importer.add_source(ds, 'upload.csv', text, 'text/csv')
+        filename, content = sent[0]
+        self.assertEqual(filename, 'upload.csv.gz')
+        self.assertEqual(
+            gzip.GzipFile(fileobj=io.BytesIO(content)).read(),
+            CSV + u'6,"\u2603"\n'.encode('utf-8')
+        )
+
+    def test_other_sources_are_not_compressed(self):
+        ds = mock.Mock()
+        ds.user_url.catalogs = {'sources': 'http://x/sources/'}
+        ds.session.post.return_value.headers = {'Location': 'http://x/sources/1/'}
+        importer = importing.Importer(compress=True)
+        importer.add_source(ds, 'data.sav', b'SPSS', 'application/x-spss-sav')
+        files = ds.session.post.call_args[1]['files']
+        self.assertEqual(
+            files['uploaded_file'],
+            ('data.sav', b'SPSS', 'application/x-spss-sav')
+        )
+
+
+class TestResumableAppend(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmpdir, 'upload.journal')
+        self.ds = mock.Mock()
+        self.ds.user_url.catalogs = {'sources': 'http://x/sources/'}
+        self.ds.session.post.side_effect = self.post
+        self.ds.session.get.side_effect = lambda url: mock.Mock(payload=url)
+        self.uploads = []
+        self.batches = []
+        self.failing = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def post(self, url, data=None, headers=None):
+        filename, shard = uploaded_file(data)
+        self.uploads.append(filename)
+        if filename in self.failing:
+            raise IOError("Connection reset")
+        index = int(filename.split('.part')[1][:4])
+        return mock.Mock(headers={'Location': 'http://x/sources/%d/' % index})
+
+    def create_batch(self, ds, source_url):
+        if source_url in self.failing:
+            raise IOError("Connection reset")
+        self.batches.append(source_url)
+        return JSONObject(self=source_url.replace('sources', 'batches'))
+
+    def append(self, csv=CSV):
+        importer = importing.Importer()
+        with mock.patch.object(importer, 'create_batch_from_source',
+                               side_effect=self.create_batch):
+            return importer.append_csv_sharded(
+                self.ds, csv, shard_size=1, shard_retries=0,
+                journal=self.journal
+            )
+
+    def test_resume_uploads(self):
+        self.failing = {'upload.part0003.csv'}
+        with pytest.raises(importing.UploadError):
+            self.append()
+        self.assertEqual(self.batches, [])
+        self.assertTrue(os.path.exists(self.journal))
+
+        # After a restart, only the failed shard is sent again.
+        self.failing = set()
+        self.uploads = []
+        batches = self.append()
+        self.assertEqual(self.uploads, ['upload.part0003.csv'])
+        self.assertEqual(
+            self.batches, ['http://x/sources/%d/' % i for i in range(5)]
+        )
+        self.assertEqual(len(batches), 5)
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_resume_batches(self):
+        self.failing = {'http://x/sources/2/'}
+        with pytest.raises(IOError):
+            self.append()
+        self.assertEqual(self.batches, ['http://x/sources/0/', 'http://x/sources/1/'])
+
+        self.failing = set()
+        self.uploads = []
+        self.batches = []
+        batches = self.append()
+        self.assertEqual(self.uploads, [])
+        self.assertEqual(
+            self.batches, ['http://x/sources/%d/' % i for i in (2, 3, 4)]
+        )
+        # Batches created by the first run are fetched, not created again.
+        self.assertEqual(batches[0], 'http://x/batches/0/')
+
+    def test_changed_file(self):
+        self.failing = {'upload.part0003.csv'}
+        with pytest.raises(importing.UploadError):
+            self.append()
+        self.failing = set()
+        with pytest.raises(ValueError) as exc_info:
+            self.append(CSV.replace(b'"a"', b'"z"'))
+        self.assertIn('has changed', str(exc_info.value))
+
+    def test_journal_is_replaced(self):
+        journal = importing.UploadJournal(self.journal)
+        journal.save()
+        journal.shards['0'] = {'source': 'http://x/sources/0/'}
+        # Replaced by the rename itself, so it is never missing.
+        with mock.patch.object(importing.os, 'remove') as remove:
+            journal.save()
+        remove.assert_not_called()
+        self.assertEqual(
+            importing.UploadJournal(self.journal).shards, journal.shards
+        )
+
+    def test_journal_is_replaced_on_windows(self):
+        # Where a rename never replaces an existing file.
+        rename = os.rename
+
+        def no_replace(src, dst):
+            if os.path.exists(dst):
+                raise OSError("File exists: %r" % dst)
+            rename(src, dst)
+
+        journal = importing.UploadJournal(self.journal)
+        with mock.patch.object(importing.os, 'rename', side_effect=no_replace), \
+                mock.patch.object(importing.os, 'name', 'nt'):
+            journal.save()
+            journal.shards['0'] = {'source': 'http://x/sources/0/'}
+            journal.save()
+        self.assertEqual(
+            importing.UploadJournal(self.journal).shards, journal.shards
+        )
+
+
+class TestStreamWriter(TestCase):
+
+    def setUp(self):
+        self.ds = mock.Mock()
+        self.ds.fragments.stream = 'http://x/stream/'
+        self.ds.session.json_codec = None
+        self.bodies = []
+        self.failing = False
+
+        def post(url, data=None, headers=None):
+            if self.failing:
+                raise IOError("Connection reset")
+            if headers.get('Content-Encoding') == 'gzip':
+                data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+            self.bodies.append([json.loads(line) for line in data.split(b'\n')])
+
+        self.ds.session.post.side_effect = post
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_flush_by_count(self):
+        with importing.StreamWriter(self.ds, max_rows=10, max_age=60) as writer:
+            writer.write_rows({'a': i} for i in range(25))
+            self.wait_for(lambda: len(self.bodies) == 2)
+            self.assertEqual(
+                [len(body) for body in self.bodies], [10, 10]
+            )
+        self.assertEqual(sum(self.bodies, []), [{'a': i} for i in range(25)])
+
+    def test_flush_by_age(self):
+        writer = importing.StreamWriter(self.ds, max_age=0.05, compress=True)
+        writer.write({'a': 1})
+        self.wait_for(lambda: self.bodies)
+        self.assertEqual(self.bodies, [[{'a': 1}]])
+        writer.close()
+        with pytest.raises(ValueError):
+            writer.write({'a': 2})
+
+    def test_errors_keep_rows(self):
+        self.failing = True
+        writer = importing.StreamWriter(self.ds, max_rows=2)
+        writer.write_rows([{'a': 1}, {'a': 2}])
+        self.wait_for(lambda: writer._error is not None)
+        # The row is buffered all the same.
+        with pytest.raises(IOError):
+            writer.write({'a': 3})
+        self.failing = False
+        writer.close()
+        self.assertEqual(sum(self.bodies, []), [{'a': 1}, {'a': 2}, {'a': 3}])
+
+    def test_close_retries(self):
+        self.failing = True
+        writer = importing.StreamWriter(self.ds, max_rows=2)
+        writer.write_rows([{'a': 1}, {'a': 2}, {'a': 3}])
+        self.wait_for(lambda: writer._error is not None)
+        with pytest.raises(IOError):
+            writer.close()
+        self.assertEqual(self.bodies, [])
+
+        # Once the connection is back, closing again sends every row.
+        self.failing = False
+        writer.close()
+        self.assertEqual(sum(self.bodies, []), [{'a': 1}, {'a': 2}, {'a': 3}])
+        writer.close()
+        self.assertEqual(len(self.bodies), 2)
+        with pytest.raises(ValueError):
+            writer.write({'a': 4})
+
+    def test_append_every(self):
+        importer = importing.Importer()
+        with mock.patch.object(importer, 'append_pending_stream') as append:
+            writer = importer.stream_writer(
+                self.ds, max_age=0.01, append_every=0.05
+            )
+            writer.write({'a': 1})
+            self.wait_for(lambda: append.called)
+            append.assert_called_once_with(self.ds)
+            writer.write({'a': 2})
+            writer.close()
+        self.assertEqual(append.call_count, 2)
+
+
+class TestWaitForBatchStatus(TestCase):
+
+    def test_backoff_does_not_change_frequency(self):
+        statuses = ['importing', 'importing', 'importing', 'ready']
+        session = mock.Mock()
+        session.get.side_effect = lambda url: mock.Mock(
+            payload=JSONObject(body={'status': statuses.pop(0)})
+        )
+        batch = JSONObject(session=session, self='batch/')
+        importer = importing.Importer(frequency=1, backoff_rate=2, backoff_max=3)
+        with mock.patch('pycrunch.importing.time.sleep') as sleep:
+            importer.wait_for_batch_status(batch, 'ready')
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2, 3])
+        self.assertEqual(importer.frequency, 1)
+
+
+class TestAppendRows(TestCase):
+
+    def test_rows_are_streamed(self):
+        importer = importing.Importer()
+        uploaded = []
+
+        def add_source(ds, filename, fp, mimetype):
+            self.assertFalse(hasattr(fp, 'read'))
+            uploaded.append(b''.join(fp))
+            return 'source/'
+
+        with mock.patch.object(importer, 'add_source', side_effect=add_source), \
+                mock.patch.object(importer, 'create_batch_from_source') as create:
+            importer.append_rows(mock.Mock(), [[1, 'a', None], [2, 'b', 3.5]])
+        self.assertEqual(uploaded, [b'1,"a",\n2,"b",3.5\n'])
+        create.assert_called_once_with(mock.ANY, 'source/')
@@ -0,0 +1,396 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+import pytest
+
+pandas = pytest.importorskip("pandas")
+
+import numpy
+
+from pycrunch import pandaslib
+from pycrunch.elements import JSONObject
+from pycrunch.tablecache import TableCache
+
+
+def vardef(**attrs):
+    return JSONObject(**attrs)
+
+
+METADATA = {
+    'v1': vardef(id='v1', alias='gender', type='categorical', categories=[
+        {'id': 1, 'name': 'M', 'missing': False},
+        {'id': 2, 'name': 'F', 'missing': False},
+        {'id': -1, 'name': 'No Data', 'missing': True},
+    ]),
+    'v2': vardef(id='v2', alias='age', type='numeric'),
+}
+
+DATA = {
+    'v1': [1, 2, -1, 2, 1],
+    'v2': [20, {'?': -1}, 31.5, 40, {'?': -2}],
+}
+
+
+def fake_dataset(data=DATA, metadata=METADATA, body=None, batches=(0,)):
+    """Return a mock dataset whose table fragment serves the given columns."""
+    numrows = len(next(iter(data.values())))
+
+    def get(url, stream=False):
+        if url == dataset.self:
+            return mock.Mock(payload=JSONObject(body=JSONObject(body or {})))
+        if url.endswith('/values/'):
+            varid = url.split('/')[-3]
+            return mock.Mock(payload=JSONObject(value=data[varid]))
+        query = dict(kv.split('=') for kv in url.split('?', 1)[1].split('&'))
+        offset, limit = int(query['offset']), int(query['limit'])
+        page = JSONObject(
+            data=JSONObject(
+                (k, v[offset:offset + limit]) for k, v in data.items()
+            ),
+            metadata=JSONObject(metadata),
+        )
+        return mock.Mock(payload=page, content=b'', _content_consumed=True)
+
+    dataset = mock.Mock()
+    dataset.summary.value.unweighted.total = numrows
+    dataset.self = 'http://x/'
+    dataset.fragments = {'table': 'http://x/table/'}
+    dataset.session.get = mock.Mock(side_effect=get)
+    tuples = {}
+    for varid, vardef in metadata.items():
+        tupl = mock.Mock()
+        tupl.entity.body = vardef
+        tupl.entity.views = {'values': 'http://x/variables/%s/values/' % varid}
+        tuples[vardef.alias] = tupl
+    dataset.variables.by.return_value = tuples
+    dataset.batches.index = dict(
+        ('http://x/batches/%d/' % batch, {}) for batch in batches
+    )
+    return dataset
+
+
+class TestSeriesFromVariable(TestCase):
+
+    def test_categorical(self):
+        var = vardef(type='categorical', categories=[
+            {'id': 2, 'name': 'B', 'missing': False},
+            {'id': 1, 'name': 'A', 'missing': False},
+            {'id': -1, 'name': 'No Data', 'missing': True},
+        ])
+        cat = pandaslib.series_from_variable([1, 2, {'?': -1}, -1, 2], var)
+        self.assertEqual(list(cat.categories), ['B', 'A'])
+        self.assertTrue(cat.ordered)
+        self.assertEqual(
+            [None if pandas.isnull(v) else v for v in cat],
+            ['A', 'B', None, None, 'B']
+        )
+
+    def test_numeric(self):
+        series = pandaslib.series_from_variable(
+            [1, 2.5, {'?': -1}], vardef(type='numeric')
+        )
+        self.assertEqual(series.dtype, 'float64')
+        self.assertEqual(list(series[:2]), [1.0, 2.5])
+        self.assertTrue(pandas.isnull(series[2]))
+
+    def test_datetime(self):
+        series = pandaslib.series_from_variable(
+            ['2014-01-01T00:00:00', {'?': -1}, '2020-03'], vardef(type='datetime')
+        )
+        self.assertEqual(series.dtype, 'datetime64[ns]')
+        self.assertEqual(series[0], pandas.Timestamp('2014-01-01'))
+        self.assertTrue(pandas.isnull(series[1]))
+        self.assertEqual(series[2], pandas.Timestamp('2020-03-01'))
+
+    def test_datetime_with_offset(self):
+        series = pandaslib.series_from_variable(
+            ['2014-01-01T00:00:00Z', {'?': -1}, '2020-03-01T05:00:00+02:00'],
+            vardef(type='datetime')
+        )
+        self.assertEqual(series.dtype, 'datetime64[ns, UTC]')
+        self.assertEqual(series[0], pandas.Timestamp('2014-01-01', tz='UTC'))
+        self.assertTrue(pandas.isnull(series[1]))
+        self.assertEqual(series[2], pandas.Timestamp('2020-03-01T03:00', tz='UTC'))
+
+    def test_text(self):
+        series = pandaslib.series_from_variable(
+            ['a', {'?': -1}], vardef(type='text')
+        )
+        self.assertEqual(series[0], 'a')
+        self.assertTrue(pandas.isnull(series[1]))
+
+
+class TestMissingCodes(TestCase):
+
+    def test_categorical(self):
+        var = vardef(type='categorical', categories=[
+            {'id': 1, 'name': 'A', 'missing': False},
+            {'id': 8, 'name': 'Skipped', 'missing': True},
+        ])
+        col = [1, {'?': -1}, 8, 1]
+        series = pandaslib.series_from_variable(col, var)
+        codes = pandaslib.missing_codes_from_variable(col, series)
+        self.assertEqual(codes.dtype, 'int8')
+        self.assertEqual(list(codes), [0, -1, 8, 0])
+
+    def test_numeric(self):
+        col = [1.5, {'?': -1}, {'?': 300}]
+        series = pandaslib.series_from_variable(col, vardef(type='numeric'))
+        codes = pandaslib.missing_codes_from_variable(col, series)
+        self.assertEqual(codes.dtype, 'int16')
+        self.assertEqual(list(codes), [0, -1, 300])
+
+
+class TestDataFrame(TestCase):
+
+    def test_all_variables(self):
+        df = pandaslib.dataframe(fake_dataset(), chunksize=2, missing_codes=True)
+        self.assertEqual(sorted(df.columns), ['age', 'gender'])
+        self.assertEqual(list(df['gender'][:2]), ['M', 'F'])
+        self.assertTrue(pandas.isnull(df['gender'][2]))
+        self.assertEqual(df['age'][2], 31.5)
+        self.assertEqual(list(df.missing_codes['age']), [0, -1, 0, 0, -2])
+        self.assertEqual(set(df.metadata), {'v1', 'v2'})
+
+    def test_selected_variables(self):
+        dataset = fake_dataset()
+        df = pandaslib.dataframe(dataset, variables=['age', 'gender'],
+                                 missing_codes=True)
+        self.assertEqual(list(df.columns), ['age', 'gender'])
+        self.assertEqual(list(df['gender'][:2]), ['M', 'F'])
+        self.assertEqual(list(df.missing_codes['gender']), [0, 0, -1, 0, 0])
+        self.assertEqual(set(df.metadata), {'v1', 'v2'})
+        dataset.variables.by.assert_called_once_with('alias')
+
+        df = pandaslib.dataframe(dataset, variables='age')
+        self.assertEqual(list(df.columns), ['age'])
+        with pytest.raises(KeyError):
+            pandaslib.dataframe(dataset, variables=['age', 'nope'])
+
+    def test_iter_dataframes(self):
+        frames = list(pandaslib.iter_dataframes(fake_dataset(), chunksize=2))
+        self.assertEqual([len(df) for df in frames], [2, 2, 1])
+        self.assertEqual(list(frames[1].index), [2, 3])
+        self.assertEqual(set(frames[2].metadata), {'v1', 'v2'})
+        df = pandas.concat(frames)
+        self.assertEqual(str(df['gender'].dtype), 'category')
+        self.assertEqual(list(df['age'].dropna()), [20, 31.5, 40])
+
+    def test_iter_dataframes_variables(self):
+        frames = list(pandaslib.iter_dataframes(
+            fake_dataset(), variables=['age', 'gender'], chunksize=3,
+            missing_codes=True
+        ))
+        self.assertEqual(list(frames[0].columns), ['age', 'gender'])
+        self.assertEqual(list(frames[1].missing_codes['age']), [0, -2])
+        frames = list(pandaslib.iter_dataframes(fake_dataset(), variables='age'))
+        self.assertEqual(list(frames[0].columns), ['age'])
+        self.assertEqual(set(frames[0].metadata), {'v2'})
+        with pytest.raises(KeyError):
+            list(pandaslib.iter_dataframes(fake_dataset(), variables=['nope']))
+
+
+class TestTableCache(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = TableCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def table_gets(self, dataset):
+        return [
+            c for c in dataset.session.get.call_args_list
+            if c[0][0].startswith('http://x/table/')
+        ]
+
+    def test_cached_dataframe(self):
+        body = {'id': 'ds1', 'modification_time': '2020-01-01T00:00:00'}
+        dataset = fake_dataset(body=body)
+        df1 = pandaslib.dataframe(dataset, cache=self.cache, missing_codes=True)
+        self.assertTrue(self.table_gets(dataset))
+
+        dataset = fake_dataset(body=body)
+        df2 = pandaslib.dataframe(dataset, cache=self.cache, missing_codes=True)
+        self.assertEqual(self.table_gets(dataset), [])
+        pandas.testing.assert_frame_equal(df1, df2)
+        self.assertEqual(df2.metadata['v1'].alias, 'gender')
+        self.assertEqual(list(df2.missing_codes['age']), [0, -1, 0, 0, -2])
+        self.assertIsInstance(df2['age'].values.base, numpy.memmap)
+
+        df3 = pandaslib.dataframe(dataset, variables='age', cache=self.cache)
+        self.assertEqual(list(df3.columns), ['age'])
+        self.assertEqual(set(df3.metadata), {'v2'})
+        self.assertEqual(self.table_gets(dataset), [])
+
+        # Cached frames are writable, without changing the cache.
+        age = df2.loc[0, 'age']
+        df2.loc[0, 'age'] = age + 1
+        df4 = pandaslib.dataframe(dataset, cache=self.cache)
+        self.assertEqual(df4.loc[0, 'age'], age)
+
+    def test_object_arrays(self):
+        text = numpy.array(['a', None, 'c'], dtype=object)
+        key = ('ds1', 'v1')
+        self.cache.set(key, {'text': text, 'ids': numpy.arange(3)}, {'n': 3})
+        files = sorted(os.listdir(os.path.join(self.path, 'ds1', 'v1')))
+        self.assertEqual(files, ['0.json', '1.npy', 'info.json'])
+
+        arrays, info = self.cache.get(key)
+        self.assertEqual(info, {'n': 3})
+        self.assertEqual(arrays['text'].dtype, object)
+        self.assertEqual(list(arrays['text']), ['a', None, 'c'])
+        self.assertEqual(list(arrays['ids']), [0, 1, 2])
+
+    def test_modified_dataset(self):
+        body = {'id': 'ds1', 'modification_time': '2020-01-01T00:00:00'}
+        pandaslib.dataframe(fake_dataset(body=body), cache=self.cache)
+
+        body['modification_time'] = '2020-01-02T00:00:00'
+        dataset = fake_dataset(body=body)
+        pandaslib.dataframe(dataset, cache=self.cache)
+        self.assertTrue(self.table_gets(dataset))
+        self.assertEqual(len(os.listdir(os.path.join(self.path, 'ds1'))), 1)
+
+    def test_uncacheable_dataset(self):
+        pandaslib.dataframe(fake_dataset(body={'id': 'ds1'}), cache=self.cache)
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class TestSyncDataFrame(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = TableCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def table_offsets(self, dataset):
+        return [
+            int(c[0][0].split('offset=')[1].split('&')[0])
+            for c in dataset.session.get.call_args_list
+            if c[0][0].startswith('http://x/table/')
+        ]
+
+    def test_appended_rows(self):
+        body = {'id': 'ds1', 'modification_time': '2020-01-01T00:00:00'}
+        dataset = fake_dataset(body=body)
+        pandaslib.sync_dataframe(dataset, self.cache, missing_codes=True)
+        self.assertEqual(self.table_offsets(dataset), [0])
+
+        # Unchanged: straight from the cache.
+        dataset = fake_dataset(body=body)
+        pandaslib.sync_dataframe(dataset, self.cache, missing_codes=True)
+        self.assertEqual(self.table_offsets(dataset), [])
+
+        data = {
+            'v1': DATA['v1'] + [2, 1],
+            'v2': DATA['v2'] + [{'?': -1}, 50],
+        }
+        body = {'id': 'ds1', 'modification_time': '2020-01-02T00:00:00'}
+        dataset = fake_dataset(data, body=body, batches=(0, 1))
+        df = pandaslib.sync_dataframe(dataset, self.cache, missing_codes=True)
+        self.assertEqual(self.table_offsets(dataset), [5])
+        expected = pandaslib.dataframe(fake_dataset(data), missing_codes=True)
+        pandas.testing.assert_frame_equal(df[expected.columns], expected)
+        self.assertEqual(
+            list(df.missing_codes['age']), [0, -1, 0, 0, -2, -1, 0]
+        )
+
+        dataset = fake_dataset(data, body=body, batches=(0, 1))
+        cached = pandaslib.sync_dataframe(dataset, self.cache)
+        self.assertEqual(self.table_offsets(dataset), [])
+        pandas.testing.assert_frame_equal(cached, df)
+
+    def test_deleted_batch(self):
+        body = {'id': 'ds1', 'modification_time': '2020-01-01T00:00:00'}
+        pandaslib.sync_dataframe(
+            fake_dataset(body=body, batches=(0, 1)), self.cache
+        )
+
+        body = {'id': 'ds1', 'modification_time': '2020-01-02T00:00:00'}
+        dataset = fake_dataset(body=body, batches=(0, 2))
+        pandaslib.sync_dataframe(dataset, self.cache)
+        self.assertEqual(self.table_offsets(dataset), [0])
+
+    def test_changed_metadata(self):
+        body = {'id': 'ds1', 'modification_time': '2020-01-01T00:00:00'}
+        pandaslib.sync_dataframe(fake_dataset(body=body), self.cache)
+
+        metadata = dict(METADATA, v2=vardef(id='v2', alias='years', type='numeric'))
+        body = {'id': 'ds1', 'modification_time': '2020-01-02T00:00:00'}
+        dataset = fake_dataset(metadata=metadata, body=body, batches=(0, 1))
+        df = pandaslib.sync_dataframe(dataset, self.cache)
+        self.assertEqual(self.table_offsets(dataset), [5, 0])
+        self.assertEqual(sorted(df.columns), ['gender', 'years'])
+
+
+class TestCSVUpload(TestCase):
+
+    frame = pandas.DataFrame({
+        'gender': pandas.Categorical(['M', None, 'F']),
+        'age': [20, numpy.nan, 31.5],
+        'name': ['a', None, ''],
+    })
+
+    def test_iter_dataframe_csv_chunks(self):
+        chunks = list(
+            pandaslib.iter_dataframe_csv_chunks(self.frame, METADATA, chunksize=2)
+        )
+        self.assertEqual(chunks, [
+            b'"gender","age","name"\n1,20.0,"a"\n,,\n',
+            b'2,31.5,""\n',
+        ])
+
+        df = self.frame.assign(gender=['M', None, 'F'])
+        self.assertEqual(
+            b''.join(pandaslib.iter_dataframe_csv_chunks(df, METADATA)),
+            b''.join(chunks)
+        )
+        with pytest.raises(ValueError):
+            pandaslib.iter_dataframe_csv_chunks(
+                self.frame.assign(gender=['M', 'X', 'Y']), METADATA
+            )
+
+        # Categories of the dtype which no cell uses need not be known.
+        df = self.frame.assign(gender=pandas.Categorical(
+            ['M', None, 'F'], categories=['F', 'M', 'X']
+        ))
+        self.assertEqual(
+            b''.join(pandaslib.iter_dataframe_csv_chunks(df, METADATA)),
+            b''.join(chunks)
+        )
+
+    def test_append_dataframe(self):
+        from pycrunch import importing
+
+        ds = mock.Mock()
+        ds.fragments = {'table': 'http://x/table/'}
+        ds.user_url.catalogs = {'sources': 'http://x/sources/'}
+        ds.session.get.return_value.payload = {'metadata': METADATA}
+        bodies = []
+
+        def post(url, data=None, headers=None, **kwargs):
+            bodies.append((headers['Content-Type'], b''.join(data)))
+            return mock.Mock(headers={'Location': 'http://x/sources/1/'})
+
+        ds.session.post.side_effect = post
+        importer = importing.Importer()
+        with mock.patch.object(importer, 'create_batch_from_source') as create:
+            importer.append_dataframe(ds, self.frame, chunksize=1)
+
+        ds.session.get.assert_called_once_with('http://x/table/?limit=0')
+        create.assert_called_once_with(ds, 'http://x/sources/1/')
+        content_type, body = bodies[0]
+        boundary = content_type.split('boundary=')[1].encode('ascii')
+        self.assertTrue(body.startswith(b'--' + boundary + b'\r\n'))
+        self.assertIn(
+            b'filename="upload.csv"\r\nContent-Type: text/csv\r\n\r\n'
+            b'"gender","age","name"\n1,20.0,"a"\n,,\n2,31.5,""\n\r\n--' + boundary
+            + b'--\r\n', body
+        )
@@ -2,14 +2,22 @@
 import json
 
 import mock
+import pytest
 from six.moves.urllib_parse import urljoin
 from unittest import TestCase
 
 import sys
+import threading
 from requests import Response
 
-from pycrunch.progress import DefaultProgressTracking, SimpleTextBarProgressTracking
-from pycrunch.shoji import Catalog, CreateMixin, TaskProgressTimeoutError, TaskError, Index, Order, Entity
+from pycrunch.progress import (
+    AdaptiveProgressTracking, DefaultProgressTracking, SimpleTextBarProgressTracking,
+    backoff_intervals, poll_intervals
+)
+from pycrunch.shoji import (
+    Catalog, CreateMixin, TaskProgressTimeoutError, TaskError, Index, Order, Entity,
+    ProgressMultiplexer, as_completed, wait_all, wait_progress
+)
 from pycrunch.lemonpy import URL
 
 
@@ -346,6 +354,39 @@ class TestIndex(TestCase):
         self.assertEqual(list(rel_index.normalized_keys.keys()), [rel_url])
         self.assertEqual(list(abs_index.normalized_keys.keys()), [rel_url])
 
+    def test_prefetch_and_fetch_all(self):
+        base_url = URL('http://host.name/catalog/', None)
+        ok_url = urljoin(base_url, 'ok/')
+        bad_url = urljoin(base_url, 'bad/')
+        error = ValueError('boom')
+        fetches = []
+
+        def _get(ent_url, *args, **kwargs):
+            fetches.append(ent_url)
+            if ent_url == bad_url:
+                raise error
+            return mock.Mock(payload={'name': 'fetched'})
+
+        session = mock.MagicMock()
+        session.get = _get
+        catalog = Catalog(session, **{
+            'self': base_url,
+            'index': {'ok/': {'name': 'ok'}, 'bad/': {'name': 'bad'}},
+        })
+
+        entities, failures = catalog.fetch_all(max_workers=2)
+        # Results are keyed like the index.
+        self.assertEqual(entities, {'ok/': {'name': 'fetched'}})
+        self.assertEqual(failures, {'bad/': error})
+        self.assertEqual(catalog.index['ok/']._entity, {'name': 'fetched'})
+        self.assertIsNone(catalog.index['bad/']._entity)
+
+        # Cached entities are not fetched again.
+        del fetches[:]
+        self.assertEqual(catalog.index.prefetch([ok_url, bad_url]), {'bad/': error})
+        self.assertEqual(fetches, [bad_url])
+
+
 class TestOrders(TestCase):
     def test_follows_catalogs(self):
         catal_url = '/catalog/url/'
@@ -392,3 +433,203 @@ class TestCreateMixin(TestCase):
         obj.index = {'url1/': tuple1, 'url2/': tuple2}
 
         self.assertEqual(obj.by('id'), {1: tuple1, 2: tuple2})
+
+
+class ProgressResponses(object):
+
+    def _mkresp(self, **attrs):
+        resp = Response()
+        for n in attrs:
+            setattr(resp, n, attrs[n])
+        return resp
+
+    def _progress(self, *values, **kwargs):
+        return [
+            self._mkresp(status_code=200, headers=kwargs.get('headers', {}),
+                         payload={'value': value})
+            for value in values
+        ]
+
+    def _accepted(self, progress_url='http://host.com/progress/1'):
+        return self._mkresp(
+            status_code=202,
+            headers={'Location': 'http://host.com/somewhere'},
+            payload={"value": progress_url}
+        )
+
+
+class TestProgressWaiting(ProgressResponses, TestCase):
+
+    def test_backoff_intervals(self):
+        intervals = backoff_intervals(0.1, 2, 0.5)
+        self.assertEqual([next(intervals) for i in range(5)],
+                         [0.1, 0.2, 0.4, 0.5, 0.5])
+        intervals = poll_intervals(DefaultProgressTracking(interval=0.3))
+        self.assertEqual([next(intervals) for i in range(3)], [0.3, 0.3, 0.3])
+
+    def test_adaptive_backoff(self):
+        sess = mock.MagicMock()
+        sess.get = mock.MagicMock(side_effect=self._progress(
+            {'progress': 10}, {'progress': 20}, {'progress': 30}, {'progress': 100}
+        ))
+        tracker = AdaptiveProgressTracking(interval=0.1, backoff=2, max_interval=0.3)
+        with mock.patch('pycrunch.shoji.time.sleep') as sleep:
+            wait_progress(self._accepted(), sess, tracker)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.1, 0.2, 0.3])
+
+    def test_retry_after(self):
+        sess = mock.MagicMock()
+        sess.progress_tracking = DefaultProgressTracking(interval=0.1)
+        sess.get = mock.MagicMock(side_effect=self._progress(
+            {'progress': 10}, headers={'Retry-After': '2'}
+        ) + self._progress({'progress': 100}))
+        with mock.patch('pycrunch.shoji.time.sleep') as sleep:
+            wait_progress(self._accepted(), sess)
+        sleep.assert_called_once_with(2.0)
+
+    def test_multiplexer(self):
+        responses = {
+            'http://host.com/progress/1': self._progress(
+                {'progress': 10}, {'progress': 50}, {'progress': 100}
+            ),
+            'http://host.com/progress/2': self._progress(
+                {'progress': -1, 'message': 'Some Failure'}
+            ),
+            'http://host.com/progress/3': self._progress({'progress': 100}),
+        }
+        threads = set()
+
+        def get(url):
+            threads.add(threading.current_thread())
+            return responses[url].pop(0)
+
+        sess = mock.MagicMock()
+        sess.get = mock.MagicMock(side_effect=get)
+        tracker = DefaultProgressTracking(timeout=5, interval=0.01)
+        multiplexer = ProgressMultiplexer()
+        entity = Entity(sess, self='http://host.com/somewhere')
+        futures = [
+            multiplexer.add(
+                self._accepted('http://host.com/progress/%d' % i), sess, tracker,
+                entity=entity if i == 1 else None
+            )
+            for i in (1, 2, 3)
+        ]
+
+        self.assertIs(futures[0].result(timeout=5), entity)
+        self.assertRaises(TaskError, futures[1].result, timeout=5)
+        self.assertIs(futures[2].result(timeout=5), None)
+        self.assertEqual(len(threads), 1)
+        self.assertEqual(sess.get.call_count, 5)
+
+    def test_multiplexer_timeout(self):
+        sess = mock.MagicMock()
+        sess.get = mock.MagicMock(side_effect=lambda url: self._progress(
+            {'progress': 10}
+        )[0])
+        tracker = DefaultProgressTracking(timeout=0.05, interval=0.01)
+        future = ProgressMultiplexer().add(self._accepted(), sess, tracker)
+        self.assertRaises(TaskProgressTimeoutError, future.result, timeout=5)
+
+    def test_multiplexer_cancel(self):
+        polling = threading.Event()
+        cancelled = threading.Event()
+
+        def get(url):
+            if url.endswith('/1'):
+                polling.set()
+                cancelled.wait(5)
+            return self._progress({'progress': 100})[0]
+
+        sess = mock.MagicMock()
+        sess.get = mock.MagicMock(side_effect=get)
+        tracker = DefaultProgressTracking(timeout=5, interval=0.01)
+        multiplexer = ProgressMultiplexer()
+        future = multiplexer.add(self._accepted(), sess, tracker)
+        # Cancelled while its progress is being polled.
+        self.assertTrue(polling.wait(5))
+        self.assertTrue(future.cancel())
+        cancelled.set()
+
+        other = multiplexer.add(
+            self._accepted('http://host.com/progress/2'), sess, tracker
+        )
+        self.assertIs(other.result(timeout=5), None)
+        self.assertTrue(future.cancelled())
+
+
+class TestPendingEntity(ProgressResponses, TestCase):
+
+    def _session(self, progress):
+        responses = dict(
+            ('http://host.com/progress/%d' % i, self._progress(*values))
+            for i, values in enumerate(progress, 1)
+        )
+        posts = ['http://host.com/progress/%d' % i
+                 for i in range(1, len(progress) + 1)]
+
+        sess = mock.MagicMock()
+        sess.progress_tracking = DefaultProgressTracking(timeout=5, interval=0.01)
+        sess.post = mock.MagicMock(
+            side_effect=lambda *args, **kwargs: self._accepted(posts.pop(0))
+        )
+        sess.get = mock.MagicMock(side_effect=lambda url: responses[url].pop(0))
+        return sess
+
+    def test_create_without_waiting(self):
+        sess = self._session([
+            [{'progress': 50}, {'progress': 100}],
+            [{'progress': 100}],
+        ])
+        c = Catalog(self='http://host.com/catalog', session=sess)
+
+        pending = [c.create({'body': {'name': name}}, wait=False)
+                   for name in ('a', 'b')]
+        self.assertEqual(sess.post.call_count, 2)
+        self.assertEqual(
+            [p.progress_url for p in pending],
+            ['http://host.com/progress/1', 'http://host.com/progress/2']
+        )
+        self.assertEqual(pending[0].entity.self, 'http://host.com/somewhere')
+
+        entities = wait_all(pending)
+        self.assertEqual([e['body']['name'] for e in entities], ['a', 'b'])
+        self.assertEqual(set(as_completed(pending)), set(pending))
+        self.assertEqual(sess.get.call_count, 3)
+
+    def test_create_failure(self):
+        sess = self._session([
+            [{'progress': 100}],
+            [{'progress': -1, 'message': 'Some Failure'}],
+        ])
+        c = Catalog(self='http://host.com/catalog', session=sess)
+
+        pending = [c.create({'somedata': 1}, wait=False) for i in range(2)]
+        self.assertRaises(TaskError, wait_all, pending)
+        self.assertIs(pending[0].result(), pending[0].entity)
+
+    def test_created_at_once(self):
+        sess = mock.MagicMock()
+        sess.post = mock.MagicMock(return_value=self._mkresp(
+            status_code=201, headers={'Location': 'http://host.com/somewhere'}
+        ))
+        c = Catalog(self='http://host.com/catalog', session=sess)
+
+        pending = c.create({'somedata': 1}, wait=False)
+        self.assertTrue(pending.done())
+        self.assertIsNone(pending.progress_url)
+        self.assertEqual(pending.result().self, 'http://host.com/somewhere')
+
+    @pytest.mark.skipif(sys.version_info < (3, 5), reason="requires async/await")
+    def test_await(self):
+        import asyncio
+        sess = self._session([[{'progress': 10}, {'progress': 100}]])
+        c = Catalog(self='http://host.com/catalog', session=sess)
+
+        namespace = {}
+        exec("async def wait(pending):\n    return await pending", namespace)
+        pending = c.create({'somedata': 1}, wait=False)
+        entity = asyncio.new_event_loop().run_until_complete(
+            namespace['wait'](pending)
+        )
+        self.assertIs(entity, pending.entity)
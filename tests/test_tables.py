@@ -0,0 +1,96 @@
+import threading
+import time
+from unittest import TestCase
+
+import mock
+import numpy as np
+
+from pycrunch import tables
+from pycrunch.tables import TablePager
+
+
+class FakeTable(object):
+    """A dataset whose table fragment serves `numrows` rows of one column."""
+
+    def __init__(self, numrows, delays=None):
+        self.numrows = numrows
+        self.delays = delays or {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.dataset = mock.Mock()
+        self.dataset.summary.value.unweighted.total = numrows
+        self.dataset.fragments = {'table': 'http://x/table/'}
+        self.dataset.session.get = self.get
+
+    def get(self, url, stream=False):
+        query = dict(kv.split('=') for kv in url.split('?', 1)[1].split('&'))
+        offset, limit = int(query['offset']), int(query['limit'])
+        with self.lock:
+            self.requests.append((offset, limit))
+        time.sleep(self.delays.get(offset, 0))
+        rows = list(range(offset, min(offset + limit, self.numrows)))
+        return mock.Mock(
+            payload=mock.Mock(data={'a': rows}, metadata={}),
+            content=b'x' * len(rows), _content_consumed=True,
+        )
+
+
+class TestTablePager(TestCase):
+
+    def test_pages_in_order(self):
+        # The first page is the slowest; it must still come out first.
+        table = FakeTable(25, delays={0: 0.05})
+        pager = TablePager(table.dataset, chunksize=10, window=3)
+        rows = []
+        for page in pager:
+            rows.extend(page.data['a'])
+        self.assertEqual(rows, list(range(25)))
+        self.assertEqual(sorted(table.requests), [(0, 10), (10, 10), (20, 5)])
+
+    def test_empty_table_fetches_one_page(self):
+        table = FakeTable(0)
+        pages = list(TablePager(table.dataset, chunksize=10))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(table.requests, [(0, 1)])
+
+    def test_offset_and_limit(self):
+        table = FakeTable(100)
+        pager = TablePager(table.dataset, chunksize=10, offset=90, limit=50)
+        rows = [row for page in pager for row in page.data['a']]
+        self.assertEqual(rows, list(range(90, 100)))
+
+    def test_adapt(self):
+        pager = TablePager(None, chunksize=1000, adaptive=True,
+                           target_seconds=1.0, max_page_bytes=1000000)
+        # Fast, small pages grow at most twofold per page...
+        pager.adapt(0.01, 1000, 1000)
+        self.assertEqual(pager.chunksize, 2000)
+        # ...slow pages shrink towards target_seconds...
+        pager.adapt(4.0, 1000, 2000)
+        self.assertEqual(pager.chunksize, 500)
+        # ...and large pages towards max_page_bytes.
+        pager.adapt(0.01, 2000000, 500)
+        self.assertEqual(pager.chunksize, 250)
+
+
+class TestColumnArrays(TestCase):
+
+    def test_id_array(self):
+        self.assertEqual(list(tables.id_array([1, 2])), [1, 2])
+        self.assertEqual(
+            list(tables.id_array([1, {'?': -1}, None])),
+            [1, tables.MISSING_ID, tables.MISSING_ID]
+        )
+
+    def test_float_array(self):
+        arr = tables.float_array([1, {'?': -1}, 2.5])
+        self.assertEqual(arr[0], 1.0)
+        self.assertTrue(np.isnan(arr[1]))
+        self.assertEqual(arr[2], 2.5)
+
+    def test_category_codes(self):
+        codes = tables.category_codes(
+            [5, 1, tables.MISSING_ID, 9, -1], [1, 9, 5]
+        )
+        self.assertEqual(list(codes), [2, 0, -1, 1, -1])
+        self.assertEqual(list(tables.category_codes([1], [])), [-1])